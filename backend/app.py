@@ -1,25 +1,69 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+import asyncio
+import atexit
+import hashlib
 import os
-import json
+import numpy as np
+import orjson
+import pandas as pd
+import shutil
+import sys
+import tempfile
+import threading
+import zipfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
+try:
+    from flask_compress import Compress
+except ImportError:  # gzip of JSON responses is optional
+    Compress = None
+
 from services.shapefile_service import ShapefileService
 from services.gpx_service import GPXService
 from services.analysis_service import AnalysisService
 from services.export_service import ExportService
-from services.service_area_analyzer import ServiceAreaAnalyzer
+from services.service_area_analyzer import get_service_area_analyzer
+from services.route_cache import LRUCache
 from services.gpx_extractor import GPXExtractor
-from shapely.ops import unary_union
+import shapely
+from shapely import wkb
+
+# orjson options shared by the routes DB and the Flask JSON provider
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+class OrjsonProvider(JSONProvider):
+    """Serialize API responses with orjson instead of stdlib json"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str, option=ORJSON_OPTIONS | orjson.OPT_SORT_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
+if Compress is not None:
+    Compress(app)
 
 # Configuration
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+GPX_FOLDER = os.path.join(DATA_FOLDER, 'gpx')
+SHAPEFILES_FOLDER = os.path.join(DATA_FOLDER, 'shapefiles')
+
+VALID_SHAPEFILE_TYPES = frozenset({
+    'road_network', 'municipalities', 'localities', 'manzanas', 'sites_public', 'sites_private'
+})
 
 for folder in [UPLOAD_FOLDER, DATA_FOLDER, RESULTS_FOLDER]:
     os.makedirs(folder, exist_ok=True)
@@ -31,7 +75,7 @@ app.config['DATA_FOLDER'] = DATA_FOLDER
 app.config['RESULTS_FOLDER'] = RESULTS_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  # 2GB max for large shapefiles
 
-# Cache for manzanas GeoJSON (by municipio)
+# Cache for manzanas GeoJSON bytes (by municipio)
 _unserved_manzanas_cache = {}
 _served_manzanas_cache = {}
 
@@ -45,29 +89,160 @@ export_service = ExportService(RESULTS_FOLDER)
 ROUTES_DB = os.path.join(DATA_FOLDER, 'routes.json')
 CONFIG_DB = os.path.join(DATA_FOLDER, 'config.json')
 
+# Cache for shapefile preview GeoJSON bytes (type -> {mtime, geojson})
+_preview_cache = {}
+
 # Cache for dashboard calculations (municipio -> {hash, stats})
 _dashboard_cache = {}
 
+# LRU of combined service areas ((municipio, frozenset of route ids) -> result)
+SERVICE_AREA_CACHE_SIZE = 32
+_service_area_cache = LRUCache(SERVICE_AREA_CACHE_SIZE)
+
+# Parsed routes/config JSON, reused while the file mtime is unchanged
+_db_lock = threading.Lock()
+_routes_cache = {'mtime': None, 'data': None, 'dirty': False, 'index': {}, 'by_municipio': {},
+                 'analyzed_ids': [], 'municipio_counts': {}}
+
+# routes.json writes are debounced: bursts of saves are coalesced into one write
+ROUTES_DB_FLUSH_DELAY = 0.2
+_routes_flush_timer = None
+
+# Per-route numeric fields aggregated by the dashboards (columns of _routes_cache['metrics'])
+METRIC_FIELDS = ('km', 'duracion_min', 'velocidad_kmh', 'pavimentado', 'terraceria', 'superficie_na',
+                 'federal', 'estatal', 'municipal', 'administracion_na')
+_config_cache = {'mtime': None, 'data': None}
+
 def _get_routes_hash(routes):
     """Generate a hash based on analyzed routes to detect changes"""
-    import hashlib
     route_data = [(r['id'], r.get('analyzed', False), r.get('analysis', {}).get('distancia_km', 0)) for r in routes]
     return hashlib.md5(str(sorted(route_data)).encode()).hexdigest()
 
+def _read_json_cached(path, cache, on_load=None):
+    """Return parsed JSON from path, re-reading only when its mtime changes"""
+    mtime = os.stat(path).st_mtime_ns
+    with _db_lock:
+        if cache['mtime'] != mtime:
+            with open(path, 'rb') as f:
+                cache['data'] = orjson.loads(f.read())
+            cache['mtime'] = mtime
+            if on_load:
+                on_load(cache)
+        return cache['data']
+
+def _dump_json(path, data, default=None):
+    """Write data as JSON to path and return the new file mtime"""
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(data, default=default, option=ORJSON_OPTIONS | orjson.OPT_INDENT_2))
+    return os.stat(path).st_mtime_ns
+
+def _write_json_cached(path, cache, data, default=None):
+    """Write data as JSON to path and keep it as the cached copy"""
+    with _db_lock:
+        cache['mtime'] = _dump_json(path, data, default)
+        cache['data'] = data
+
+def _route_metrics(analysis):
+    """Numeric dashboard fields of one analysis, in METRIC_FIELDS order"""
+    surface = analysis.get('superficie', {})
+    admin = analysis.get('administracion', {})
+    return (
+        # Usar distancia_rnc_km (distancia alineada a RNC) como base para totales
+        analysis.get('distancia_rnc_km', analysis.get('distancia_km', 0)),
+        analysis.get('duracion_min', 0),
+        analysis.get('velocidad_promedio_kmh', 0),
+        surface.get('Con pavimento', 0) + surface.get('pavimentado_km', 0),
+        surface.get('Sin pavimento', 0) + surface.get('terraceria_km', 0),
+        surface.get('N/A', 0) + surface.get('na_km', 0),
+        admin.get('Federal', 0) + admin.get('federal_km', 0),
+        admin.get('Estatal', 0) + admin.get('estatal_km', 0),
+        admin.get('Municipal', 0) + admin.get('municipal_km', 0),
+        admin.get('N/A', 0) + admin.get('na_km', 0)
+    )
+
+def _sum_metrics(rows):
+    """Column totals of a metrics array as {field: float}"""
+    return dict(zip(METRIC_FIELDS, rows.sum(axis=0).tolist()))
+
+def _index_routes(cache):
+    """Rebuild the id, municipio and analyzed indexes for the cached routes"""
+    index = {}
+    by_municipio = {}
+    analyzed_ids = []
+    counts = {}
+    metrics = []
+    metrics_municipio = []
+    modalidades = []
+    for i, r in enumerate(cache['data']['routes']):
+        # Interned keys make the municipio/modalidad dict lookups cheaper
+        for key in ('municipio', 'modalidad'):
+            if isinstance(r.get(key), str):
+                r[key] = sys.intern(r[key])
+        route_id = r['id']
+        index[route_id] = i
+        by_municipio.setdefault(r.get('municipio'), []).append(route_id)
+        mun_counts = counts.setdefault(r.get('municipio', 'Sin especificar'), {'total': 0, 'analyzed': 0})
+        mun_counts['total'] += 1
+        if r.get('analyzed', False):
+            analyzed_ids.append(route_id)
+            mun_counts['analyzed'] += 1
+            metrics.append(_route_metrics(r.get('analysis', {})))
+            metrics_municipio.append(r.get('municipio'))
+            modalidades.append(r.get('modalidad', 'Sin especificar'))
+    cache.update(index=index, by_municipio=by_municipio, analyzed_ids=analyzed_ids, municipio_counts=counts,
+                 metrics=np.array(metrics, dtype=float).reshape(-1, len(METRIC_FIELDS)),
+                 metrics_municipio=np.array(metrics_municipio, dtype=object),
+                 routes_by_modalidad=dict(Counter(modalidades)))
+
 def load_routes_db():
+    if _routes_cache['dirty']:
+        # Pending write-behind: the in-memory copy is newer than the file
+        return _routes_cache['data']
     if os.path.exists(ROUTES_DB):
-        with open(ROUTES_DB, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {'routes': []}
+        return _read_json_cached(ROUTES_DB, _routes_cache, _index_routes)
+    with _db_lock:
+        _routes_cache.update(mtime=None, data={'routes': []})
+        _index_routes(_routes_cache)
+        return _routes_cache['data']
 
 def save_routes_db(data):
-    with open(ROUTES_DB, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    """Update the cached routes now and schedule a debounced write of routes.json"""
+    global _routes_flush_timer
+    with _db_lock:
+        _routes_cache['data'] = data
+        _routes_cache['dirty'] = True
+        _index_routes(_routes_cache)
+        if _routes_flush_timer is not None:
+            _routes_flush_timer.cancel()
+        _routes_flush_timer = threading.Timer(ROUTES_DB_FLUSH_DELAY, _flush_routes_db)
+        _routes_flush_timer.daemon = True
+        _routes_flush_timer.start()
+
+def _flush_routes_db():
+    """Write pending route changes to routes.json"""
+    with _db_lock:
+        if not _routes_cache['dirty']:
+            return
+        _routes_cache['mtime'] = _dump_json(ROUTES_DB, _routes_cache['data'], default=str)
+        _routes_cache['dirty'] = False
+
+atexit.register(_flush_routes_db)
+
+def get_route_by_id(route_id, db=None):
+    """Return the route with route_id (or None) using the id index"""
+    if db is None:
+        db = load_routes_db()
+    idx = _routes_cache['index'].get(route_id)
+    return db['routes'][idx] if idx is not None else None
+
+def get_routes_by_ids(route_ids, db):
+    """Return the routes for route_ids, in the given order"""
+    index = _routes_cache['index']
+    return [db['routes'][index[i]] for i in route_ids]
 
 def load_config():
     if os.path.exists(CONFIG_DB):
-        with open(CONFIG_DB, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return _read_json_cached(CONFIG_DB, _config_cache)
     return {
         'road_network': None,
         'municipalities': None,
@@ -76,8 +251,29 @@ def load_config():
     }
 
 def save_config(config):
-    with open(CONFIG_DB, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+    _write_json_cached(CONFIG_DB, _config_cache, config)
+
+# Raw (non-multipart) uploads are streamed straight to disk in 1MB chunks
+RAW_UPLOAD_MIMETYPES = ('application/octet-stream', 'application/zip')
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _is_raw_upload():
+    return request.mimetype in RAW_UPLOAD_MIMETYPES
+
+def _stream_upload_to_disk(suffix=''):
+    """Copy the raw request body to a temp file in UPLOAD_FOLDER and return its path"""
+    with tempfile.NamedTemporaryFile(delete=False, dir=UPLOAD_FOLDER, suffix=suffix) as tmp:
+        shutil.copyfileobj(request.stream, tmp, length=UPLOAD_CHUNK_SIZE)
+    return tmp.name
+
+def _geojson_response(payload):
+    """Serve pre-serialized GeoJSON bytes with an ETag, answering 304 if the client has them"""
+    response = Response(payload, mimetype='application/json')
+    response.set_etag(hashlib.blake2b(payload, digest_size=8).hexdigest())
+    # no-cache: browsers keep the body but revalidate every time, since the layers
+    # change when routes are re-analyzed or a shapefile is re-uploaded
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 # ============== CONFIGURATION ENDPOINTS ==============
 
@@ -99,16 +295,29 @@ def set_buffer():
 @app.route('/api/config/shapefile/<shapefile_type>', methods=['POST'])
 def upload_shapefile(shapefile_type):
     """Upload a base shapefile (road_network, municipalities, localities, manzanas, sites)"""
-    valid_types = ['road_network', 'municipalities', 'localities', 'manzanas', 'sites_public', 'sites_private']
-    if shapefile_type not in valid_types:
+    if shapefile_type not in VALID_SHAPEFILE_TYPES:
         return jsonify({'error': 'Invalid shapefile type'}), 400
     
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
-    
-    files = request.files.getlist('file')
+    raw_path = None
+    archive = None
+    files = []
     
     try:
+        if _is_raw_upload():
+            # Raw body: a .kml file or a .zip with the shapefile components (?filename=...)
+            filename = request.args.get('filename', 'upload.zip')
+            raw_path = _stream_upload_to_disk(os.path.splitext(filename)[1])
+            if filename.lower().endswith('.zip'):
+                archive = zipfile.ZipFile(raw_path)
+                files = [FileStorage(archive.open(info), filename=os.path.basename(info.filename))
+                         for info in archive.infolist() if not info.is_dir()]
+            else:
+                files = [FileStorage(open(raw_path, 'rb'), filename=filename)]
+        elif 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        else:
+            files = request.files.getlist('file')
+        
         result = shapefile_service.save_shapefile(files, shapefile_type)
         
         if result['success']:
@@ -122,16 +331,26 @@ def upload_shapefile(shapefile_type):
                 'uploaded_at': datetime.now().isoformat()
             }
             save_config(config)
+            # New base layers change every service area
+            _service_area_cache.clear()
         
         return jsonify(result)
+    except zipfile.BadZipFile:
+        return jsonify({'error': 'Uploaded file is not a valid ZIP archive'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if raw_path:
+            for f in files:
+                f.close()
+            if archive:
+                archive.close()
+            os.remove(raw_path)
 
 @app.route('/api/config/shapefile/<shapefile_type>/preview', methods=['GET'])
 def preview_shapefile(shapefile_type):
     """Get GeoJSON preview of a shapefile"""
-    valid_types = ['road_network', 'municipalities', 'localities', 'manzanas', 'sites_public', 'sites_private']
-    if shapefile_type not in valid_types:
+    if shapefile_type not in VALID_SHAPEFILE_TYPES:
         return jsonify({'error': 'Invalid shapefile type'}), 400
     
     config = load_config()
@@ -139,8 +358,14 @@ def preview_shapefile(shapefile_type):
         return jsonify({'error': 'Shapefile not loaded'}), 404
     
     try:
-        geojson = shapefile_service.get_geojson(shapefile_type)
-        return jsonify(geojson)
+        shp_path = os.path.join(SHAPEFILES_FOLDER, shapefile_type, f'{shapefile_type}.shp')
+        mtime = os.stat(shp_path).st_mtime_ns if os.path.exists(shp_path) else None
+        cached = _preview_cache.get(shapefile_type)
+        if cached is None or cached['mtime'] != mtime:
+            # Pre-baked FeatureCollection bytes, no dict round-trip
+            cached = {'mtime': mtime, 'geojson': shapefile_service.get_geojson_bytes(shapefile_type)}
+            _preview_cache[shapefile_type] = cached
+        return _geojson_response(cached['geojson'])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -170,21 +395,23 @@ def get_routes():
     modalidad = request.args.get('modalidad')
     analyzed = request.args.get('analyzed')
     
+    # Start from the municipio index, then apply the remaining filters in one pass
     if municipio:
-        routes = [r for r in routes if r.get('municipio') == municipio]
-    if modalidad:
-        routes = [r for r in routes if r.get('modalidad') == modalidad]
-    if analyzed is not None:
-        is_analyzed = analyzed.lower() == 'true'
-        routes = [r for r in routes if r.get('analyzed', False) == is_analyzed]
+        routes = get_routes_by_ids(_routes_cache['by_municipio'].get(municipio, ()), db)
+    is_analyzed = analyzed.lower() == 'true' if analyzed is not None else None
+    if modalidad or is_analyzed is not None:
+        routes = [
+            r for r in routes
+            if (not modalidad or r.get('modalidad') == modalidad)
+            and (is_analyzed is None or r.get('analyzed', False) == is_analyzed)
+        ]
     
     return jsonify({'routes': routes, 'total': len(routes)})
 
 @app.route('/api/routes/<route_id>', methods=['GET'])
 def get_route(route_id):
     """Get a specific route by ID"""
-    db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
@@ -221,17 +448,26 @@ def upload_route():
 @app.route('/api/routes/batch', methods=['POST'])
 def upload_routes_batch():
     """Upload multiple GPX files via ZIP with optional CSV metadata"""
-    if 'file' not in request.files:
+    raw_path = None
+    
+    if _is_raw_upload():
+        # Raw ZIP body, default metadata comes in the query string
+        raw_path = _stream_upload_to_disk('.zip')
+        zip_file = raw_path
+        csv_file = None
+        form = request.args
+    elif 'file' not in request.files:
         return jsonify({'error': 'No ZIP file provided'}), 400
-    
-    zip_file = request.files['file']
-    csv_file = request.files.get('metadata')
+    else:
+        zip_file = request.files['file']
+        csv_file = request.files.get('metadata')
+        form = request.form
     
     # Get default metadata from form
     default_metadata = {
-        'municipio': request.form.get('municipio', ''),
-        'modalidad': request.form.get('modalidad', ''),
-        'clave_mnemotecnica': request.form.get('clave_mnemotecnica', '')
+        'municipio': form.get('municipio', ''),
+        'modalidad': form.get('modalidad', ''),
+        'clave_mnemotecnica': form.get('clave_mnemotecnica', '')
     }
     
     try:
@@ -245,18 +481,20 @@ def upload_routes_batch():
         return jsonify(result)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if raw_path:
+            os.remove(raw_path)
 
 @app.route('/api/routes/<route_id>', methods=['PUT'])
 def update_route(route_id):
     """Update route metadata"""
     db = load_routes_db()
-    route_idx = next((i for i, r in enumerate(db['routes']) if r['id'] == route_id), None)
+    route = get_route_by_id(route_id, db)
     
-    if route_idx is None:
+    if route is None:
         return jsonify({'error': 'Route not found'}), 404
     
     data = request.json
-    route = db['routes'][route_idx]
     
     # Update allowed fields
     if 'nombre' in data:
@@ -268,7 +506,6 @@ def update_route(route_id):
     if 'clave_mnemotecnica' in data:
         route['clave_mnemotecnica'] = data['clave_mnemotecnica']
     
-    db['routes'][route_idx] = route
     save_routes_db(db)
     
     return jsonify({'success': True, 'route': route})
@@ -277,13 +514,15 @@ def update_route(route_id):
 def delete_route(route_id):
     """Delete a route"""
     db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    idx = _routes_cache['index'].get(route_id)
     
-    if not route:
+    if idx is None:
         return jsonify({'error': 'Route not found'}), 404
     
-    db['routes'] = [r for r in db['routes'] if r['id'] != route_id]
+    # Index lookup instead of a scan; save_routes_db rebuilds the index for the shifted routes
+    del db['routes'][idx]
     save_routes_db(db)
+    _invalidate_service_area_cache(route_id)
     
     # Delete associated files
     gpx_service.delete_gpx(route_id)
@@ -293,25 +532,30 @@ def delete_route(route_id):
 @app.route('/api/routes/<route_id>/gpx', methods=['GET'])
 def get_route_gpx(route_id):
     """Get GPX file as GeoJSON for map display"""
-    db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
     
     try:
-        geojson = gpx_service.get_gpx_geojson(route_id)
-        return jsonify(geojson)
+        gpx_path = os.path.join(GPX_FOLDER, f'{route_id}.gpx')
+        mtime = os.stat(gpx_path).st_mtime_ns if os.path.exists(gpx_path) else None
+        return _geojson_response(_route_geojson_bytes(route_id, mtime))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@lru_cache(maxsize=256)
+def _route_geojson_bytes(route_id, gpx_mtime_ns):
+    """Serialized GPX GeoJSON of a route, cached per GPX mtime"""
+    return orjson.dumps(gpx_service.get_gpx_geojson(route_id), default=str, option=ORJSON_OPTIONS)
+
 # ============== ANALYSIS ENDPOINTS ==============
 
 @app.route('/api/analysis/<route_id>', methods=['POST'])
-def analyze_route(route_id):
+async def analyze_route(route_id):
     """Analyze a single route"""
     db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id, db)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
@@ -319,17 +563,15 @@ def analyze_route(route_id):
     config = load_config()
     
     try:
-        result = analysis_service.analyze_route(route, config)
+        result = await asyncio.to_thread(analysis_service.analyze_route, route, config)
         
         if result['success']:
             # Update route with analysis results
-            for r in db['routes']:
-                if r['id'] == route_id:
-                    r['analyzed'] = True
-                    r['analysis'] = result['analysis']
-                    r['analyzed_at'] = datetime.now().isoformat()
-                    break
+            route['analyzed'] = True
+            route['analysis'] = result['analysis']
+            route['analyzed_at'] = datetime.now().isoformat()
             save_routes_db(db)
+            _invalidate_service_area_cache(route_id)
         
         return jsonify(result)
     except Exception as e:
@@ -340,8 +582,7 @@ def analyze_route(route_id):
 @app.route('/api/analysis/<route_id>/results', methods=['GET'])
 def get_analysis_results(route_id):
     """Get analysis results for a route"""
-    db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
@@ -356,7 +597,7 @@ def get_analysis_results(route_id):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/analysis/batch', methods=['POST'])
-def analyze_batch():
+async def analyze_batch():
     """Analyze all pending routes"""
     db = load_routes_db()
     pending_routes = [r for r in db['routes'] if not r.get('analyzed', False)]
@@ -366,22 +607,26 @@ def analyze_batch():
     
     config = load_config()
     results = []
+    analyzed_at = datetime.now().isoformat()
     
-    for route in pending_routes:
-        try:
-            result = analysis_service.analyze_route(route, config)
-            if result['success']:
-                for r in db['routes']:
-                    if r['id'] == route['id']:
-                        r['analyzed'] = True
-                        r['analysis'] = result['analysis']
-                        r['analyzed_at'] = datetime.now().isoformat()
-                        break
-                results.append({'id': route['id'], 'success': True})
-            else:
-                results.append({'id': route['id'], 'success': False, 'error': result.get('error')})
-        except Exception as e:
-            results.append({'id': route['id'], 'success': False, 'error': str(e)})
+    # Routes are independent, analyze them in parallel across CPU cores
+    outcomes = await asyncio.to_thread(analysis_service.analyze_routes, pending_routes, config)
+    
+    for route, result in zip(pending_routes, outcomes):
+        route_id = route['id']
+        if result['success']:
+            r = get_route_by_id(route_id, db)
+            if r is None:
+                # Deleted while the batch was running
+                results.append({'id': route_id, 'success': False, 'error': 'Route deleted'})
+                continue
+            r['analyzed'] = True
+            r['analysis'] = result['analysis']
+            r['analyzed_at'] = analyzed_at
+            _invalidate_service_area_cache(route_id)
+            results.append({'id': route_id, 'success': True})
+        else:
+            results.append({'id': route_id, 'success': False, 'error': result.get('error')})
     
     save_routes_db(db)
     
@@ -398,129 +643,130 @@ def analyze_batch():
 def get_global_dashboard():
     """Get global statistics"""
     db = load_routes_db()
-    routes = db['routes']
-    analyzed_routes = [r for r in routes if r.get('analyzed', False)]
+    total_routes = len(db['routes'])
+    analyzed_count = len(_routes_cache['analyzed_ids'])
+    totals = _sum_metrics(_routes_cache['metrics'])
     
     stats = {
-        'total_routes': len(routes),
-        'analyzed_routes': len(analyzed_routes),
-        'pending_routes': len(routes) - len(analyzed_routes),
-        'total_km': 0,
-        'municipalities_with_routes': len(set(r.get('municipio') for r in routes if r.get('municipio'))),
-        'routes_by_modalidad': {},
-        'surface_distribution': {'pavimentado': 0, 'terraceria': 0, 'na': 0},
-        'admin_distribution': {'federal': 0, 'estatal': 0, 'municipal': 0, 'na': 0}
+        'total_routes': total_routes,
+        'analyzed_routes': analyzed_count,
+        'pending_routes': total_routes - analyzed_count,
+        'total_km': totals['km'],
+        'municipalities_with_routes': len([m for m in _routes_cache['by_municipio'] if m]),
+        'routes_by_modalidad': dict(_routes_cache['routes_by_modalidad']),
+        'surface_distribution': {
+            'pavimentado': totals['pavimentado'],
+            'terraceria': totals['terraceria'],
+            'na': totals['superficie_na']
+        },
+        'admin_distribution': {
+            'federal': totals['federal'],
+            'estatal': totals['estatal'],
+            'municipal': totals['municipal'],
+            'na': totals['administracion_na']
+        }
     }
     
-    for route in analyzed_routes:
-        analysis = route.get('analysis', {})
-        # Usar distancia_rnc_km (distancia alineada a RNC) como base para totales
-        stats['total_km'] += analysis.get('distancia_rnc_km', analysis.get('distancia_km', 0))
-        
-        modalidad = route.get('modalidad', 'Sin especificar')
-        stats['routes_by_modalidad'][modalidad] = stats['routes_by_modalidad'].get(modalidad, 0) + 1
-        
-        surface = analysis.get('superficie', {})
-        stats['surface_distribution']['pavimentado'] += surface.get('Con pavimento', 0) + surface.get('pavimentado_km', 0)
-        stats['surface_distribution']['terraceria'] += surface.get('Sin pavimento', 0) + surface.get('terraceria_km', 0)
-        stats['surface_distribution']['na'] += surface.get('N/A', 0) + surface.get('na_km', 0)
-        
-        admin = analysis.get('administracion', {})
-        stats['admin_distribution']['federal'] += admin.get('Federal', 0) + admin.get('federal_km', 0)
-        stats['admin_distribution']['estatal'] += admin.get('Estatal', 0) + admin.get('estatal_km', 0)
-        stats['admin_distribution']['municipal'] += admin.get('Municipal', 0) + admin.get('municipal_km', 0)
-        stats['admin_distribution']['na'] += admin.get('N/A', 0) + admin.get('na_km', 0)
-    
     return jsonify(stats)
 
+@lru_cache(maxsize=1024)
+def _load_route_linestring(route_id, gpx_mtime_ns):
+    """Route LineString from its .wkb sidecar, re-extracting from the GPX when stale"""
+    gpx_path = os.path.join(GPX_FOLDER, f"{route_id}.gpx")
+    wkb_path = os.path.join(GPX_FOLDER, f"{route_id}.wkb")
+    
+    if os.path.exists(wkb_path) and os.stat(wkb_path).st_mtime_ns >= gpx_mtime_ns:
+        with open(wkb_path, 'rb') as f:
+            return wkb.loads(f.read())
+    
+    with open(gpx_path, 'rb') as f:
+        gpx_bytes = f.read()
+    extractor = GPXExtractor(gpx_bytes)
+    extractor.analyze()
+    linestring = extractor.get_linestring()
+    if linestring:
+        with open(wkb_path, 'wb') as f:
+            f.write(wkb.dumps(linestring))
+    return linestring
+
+def _extract_linestring(route):
+    """Route LineString (cached), or None if the GPX is missing or unreadable"""
+    gpx_path = os.path.join(GPX_FOLDER, f"{route['id']}.gpx")
+    if not os.path.exists(gpx_path):
+        return None
+    try:
+        return _load_route_linestring(route['id'], os.stat(gpx_path).st_mtime_ns)
+    except:
+        return None
+
+# Shared (read-only) stats returned when there is no service area to compute
+_EMPTY_SERVICE_STATS = {
+    'poblacion_total': 0,
+    'poblacion_femenina': 0,
+    'poblacion_masculina': 0,
+    'manzanas_count': 0,
+    'piramide_poblacional': {
+        '0-14': {'total': 0, 'label': '0-14 años'},
+        '15-29': {'total': 0, 'label': '15-29 años'},
+        '30-59': {'total': 0, 'label': '30-59 años'},
+        '60+': {'total': 0, 'label': '60 años y más'}
+    },
+    'discapacidad': {'total': 0, 'porcentaje': 0}
+}
+
+def _invalidate_service_area_cache(route_id):
+    """Drop cached service areas that include route_id"""
+    _service_area_cache.discard(lambda key: route_id in key[1])
+
 def _calculate_combined_service_area(analyzed_routes, municipio_name=None):
     """Calculate combined service area for multiple routes with deduplicated manzanas"""
     if not analyzed_routes:
-        return {
-            'poblacion_total': 0,
-            'poblacion_femenina': 0,
-            'poblacion_masculina': 0,
-            'manzanas_count': 0,
-            'piramide_poblacional': {
-                '0-14': {'total': 0, 'label': '0-14 años'},
-                '15-29': {'total': 0, 'label': '15-29 años'},
-                '30-59': {'total': 0, 'label': '30-59 años'},
-                '60+': {'total': 0, 'label': '60 años y más'}
-            },
-            'discapacidad': {'total': 0, 'porcentaje': 0}
-        }
+        return _EMPTY_SERVICE_STATS
+    
+    cache_key = (municipio_name, frozenset(r['id'] for r in analyzed_routes))
+    cached = _service_area_cache.get(cache_key)
+    if cached is not None:
+        return cached
     
     try:
-        # Collect all route geometries
-        geometries = []
-        gpx_folder = os.path.join(DATA_FOLDER, 'gpx')
-        
-        for route in analyzed_routes:
-            gpx_path = os.path.join(gpx_folder, f"{route['id']}.gpx")
-            if os.path.exists(gpx_path):
-                try:
-                    with open(gpx_path, 'rb') as f:
-                        gpx_bytes = f.read()
-                    extractor = GPXExtractor(gpx_bytes)
-                    extractor.analyze()
-                    linestring = extractor.get_linestring()
-                    if linestring:
-                        geometries.append(linestring)
-                except:
-                    pass
+        # Collect all route geometries, parsing GPX files in parallel
+        with ThreadPoolExecutor(max_workers=min(8, len(analyzed_routes))) as executor:
+            geometries = [g for g in executor.map(_extract_linestring, analyzed_routes) if g]
         
         if not geometries:
-            return {
-                'poblacion_total': 0,
-                'poblacion_femenina': 0,
-                'poblacion_masculina': 0,
-                'manzanas_count': 0,
-                'piramide_poblacional': {
-                    '0-14': {'total': 0, 'label': '0-14 años'},
-                    '15-29': {'total': 0, 'label': '15-29 años'},
-                    '30-59': {'total': 0, 'label': '30-59 años'},
-                    '60+': {'total': 0, 'label': '60 años y más'}
-                },
-                'discapacidad': {'total': 0, 'porcentaje': 0}
-            }
+            return _EMPTY_SERVICE_STATS
         
         # Merge all geometries into one
-        combined_geometry = unary_union(geometries)
+        combined_geometry = shapely.union_all(np.asarray(geometries, dtype=object))
         
         # Run service area analysis on combined geometry (filtered by municipality)
-        service_analyzer = ServiceAreaAnalyzer(DATA_FOLDER)
+        service_analyzer = get_service_area_analyzer(DATA_FOLDER)
         result = service_analyzer.analyze(combined_geometry, buffer_distance_m=700, municipio_name=municipio_name)
         
         # Return both served and unserved stats
-        return {
+        combined = {
             'served': result.get('stats', {}),
             'unserved': result.get('unserved_stats', {}),
             'unserved_manzanas_gdf': result.get('unserved_manzanas_gdf'),
             'served_manzanas_gdf': result.get('served_manzanas_gdf')
         }
+        # Reproject and serialize the map layers once per cache entry
+        for kind in ('unserved', 'served'):
+            gdf = combined[f'{kind}_manzanas_gdf']
+            if gdf is not None and len(gdf) > 0:
+                combined[f'{kind}_geojson'] = _manzanas_geojson_bytes(gdf.to_crs(epsg=4326))
+        _service_area_cache.put(cache_key, combined)
+        return combined
         
     except Exception as e:
         print(f"Error calculating combined service area: {e}")
-        empty_stats = {
-            'poblacion_total': 0,
-            'poblacion_femenina': 0,
-            'poblacion_masculina': 0,
-            'manzanas_count': 0,
-            'piramide_poblacional': {
-                '0-14': {'total': 0, 'label': '0-14 años'},
-                '15-29': {'total': 0, 'label': '15-29 años'},
-                '30-59': {'total': 0, 'label': '30-59 años'},
-                '60+': {'total': 0, 'label': '60 años y más'}
-            },
-            'discapacidad': {'total': 0, 'porcentaje': 0}
-        }
-        return {'served': empty_stats, 'unserved': empty_stats, 'unserved_manzanas_gdf': None}
+        return {'served': _EMPTY_SERVICE_STATS, 'unserved': _EMPTY_SERVICE_STATS, 'unserved_manzanas_gdf': None}
 
 @app.route('/api/dashboard/municipio/<municipio>', methods=['GET'])
-def get_municipio_dashboard(municipio):
+async def get_municipio_dashboard(municipio):
     """Get statistics for a specific municipality with caching"""
     db = load_routes_db()
-    routes = [r for r in db['routes'] if r.get('municipio') == municipio]
+    routes = get_routes_by_ids(_routes_cache['by_municipio'].get(municipio, ()), db)
     analyzed_routes = [r for r in routes if r.get('analyzed', False)]
     
     # Check cache - only recalculate if routes changed
@@ -531,30 +777,34 @@ def get_municipio_dashboard(municipio):
     
     print(f"[Cache MISS] Calculating dashboard for {municipio}...")
     
+    totals = _sum_metrics(_routes_cache['metrics'][_routes_cache['metrics_municipio'] == municipio])
+    
     stats = {
         'municipio': municipio,
         'total_routes': len(routes),
         'analyzed_routes': len(analyzed_routes),
-        'total_km': 0,
+        'total_km': totals['km'],
         'avg_distance_km': 0,
         'avg_duration_min': 0,
         'avg_speed_kmh': 0,
         'total_localidades': set(),
         'localidades_urbanas': set(),
         'localidades_rurales': set(),
-        'surface_distribution': {'pavimentado': 0, 'terraceria': 0, 'na': 0},
-        'admin_distribution': {'federal': 0, 'estatal': 0, 'municipal': 0, 'na': 0}
+        'surface_distribution': {
+            'pavimentado': totals['pavimentado'],
+            'terraceria': totals['terraceria'],
+            'na': totals['superficie_na']
+        },
+        'admin_distribution': {
+            'federal': totals['federal'],
+            'estatal': totals['estatal'],
+            'municipal': totals['municipal'],
+            'na': totals['administracion_na']
+        }
     }
     
-    total_duration = 0
-    total_speed = 0
-    
     for route in analyzed_routes:
         analysis = route.get('analysis', {})
-        # Usar distancia_rnc_km (distancia alineada a RNC) como base para totales
-        stats['total_km'] += analysis.get('distancia_rnc_km', analysis.get('distancia_km', 0))
-        total_duration += analysis.get('duracion_min', 0)
-        total_speed += analysis.get('velocidad_promedio_kmh', 0)
         
         # Handle old format (localidades array)
         for loc in analysis.get('localidades', []):
@@ -577,44 +827,30 @@ def get_municipio_dashboard(municipio):
                 loc_id = loc.get('cvegeo') or loc.get('nombre')
                 stats['total_localidades'].add(loc_id)
                 stats['localidades_rurales'].add(loc_id)
-        
-        surface = analysis.get('superficie', {})
-        stats['surface_distribution']['pavimentado'] += surface.get('Con pavimento', 0) + surface.get('pavimentado_km', 0)
-        stats['surface_distribution']['terraceria'] += surface.get('Sin pavimento', 0) + surface.get('terraceria_km', 0)
-        stats['surface_distribution']['na'] += surface.get('N/A', 0) + surface.get('na_km', 0)
-        
-        admin = analysis.get('administracion', {})
-        stats['admin_distribution']['federal'] += admin.get('Federal', 0) + admin.get('federal_km', 0)
-        stats['admin_distribution']['estatal'] += admin.get('Estatal', 0) + admin.get('estatal_km', 0)
-        stats['admin_distribution']['municipal'] += admin.get('Municipal', 0) + admin.get('municipal_km', 0)
-        stats['admin_distribution']['na'] += admin.get('N/A', 0) + admin.get('na_km', 0)
     
     if analyzed_routes:
         stats['avg_distance_km'] = stats['total_km'] / len(analyzed_routes)
-        stats['avg_duration_min'] = total_duration / len(analyzed_routes)
-        stats['avg_speed_kmh'] = total_speed / len(analyzed_routes)
+        stats['avg_duration_min'] = totals['duracion_min'] / len(analyzed_routes)
+        stats['avg_speed_kmh'] = totals['velocidad_kmh'] / len(analyzed_routes)
     
     stats['total_localidades'] = len(stats['total_localidades'])
     stats['localidades_urbanas'] = len(stats['localidades_urbanas'])
     stats['localidades_rurales'] = len(stats['localidades_rurales'])
     
     # Calculate combined service area for all routes (deduplicated manzanas, filtered by municipio)
-    service_area_result = _calculate_combined_service_area(analyzed_routes, municipio_name=municipio)
+    service_area_result = await asyncio.to_thread(
+        _calculate_combined_service_area, analyzed_routes, municipio_name=municipio
+    )
     
     # Separate served and unserved stats
     stats['area_servicio'] = service_area_result.get('served', {})
     stats['area_no_atendida'] = service_area_result.get('unserved', {})
     
     # Store manzanas GeoJSON in cache for map endpoints
-    unserved_gdf = service_area_result.get('unserved_manzanas_gdf')
-    if unserved_gdf is not None and len(unserved_gdf) > 0:
-        unserved_gdf_wgs = unserved_gdf.to_crs(epsg=4326)
-        _unserved_manzanas_cache[municipio] = unserved_gdf_wgs
-    
-    served_gdf = service_area_result.get('served_manzanas_gdf')
-    if served_gdf is not None and len(served_gdf) > 0:
-        served_gdf_wgs = served_gdf.to_crs(epsg=4326)
-        _served_manzanas_cache[municipio] = served_gdf_wgs
+    if service_area_result.get('unserved_geojson') is not None:
+        _unserved_manzanas_cache[municipio] = service_area_result['unserved_geojson']
+    if service_area_result.get('served_geojson') is not None:
+        _served_manzanas_cache[municipio] = service_area_result['served_geojson']
     
     # Save to cache for future requests
     _dashboard_cache[municipio] = {
@@ -628,69 +864,57 @@ def get_municipio_dashboard(municipio):
 @app.route('/api/dashboard/municipios', methods=['GET'])
 def get_municipios_list():
     """Get list of municipalities with routes"""
-    db = load_routes_db()
-    municipios = {}
-    
-    for route in db['routes']:
-        mun = route.get('municipio', 'Sin especificar')
-        if mun not in municipios:
-            municipios[mun] = {'total': 0, 'analyzed': 0}
-        municipios[mun]['total'] += 1
-        if route.get('analyzed', False):
-            municipios[mun]['analyzed'] += 1
-    
-    return jsonify({'municipios': municipios})
+    load_routes_db()
+    return jsonify({'municipios': _routes_cache['municipio_counts']})
 
 def _manzanas_gdf_to_geojson(gdf):
     """Convert manzanas GeoDataFrame to GeoJSON"""
     if gdf is None or len(gdf) == 0:
         return {'type': 'FeatureCollection', 'features': []}
     
-    features = []
-    cols = list(gdf.columns)
+    # Population is the 7th column; '1,234' -> 1234, '*' (confidential) and invalid values -> 0
+    pob = gdf.iloc[:, 6].astype(str).str.replace(',', '', regex=False).str.replace('*', '0', regex=False)
+    pob = pd.to_numeric(pob, errors='coerce').to_numpy(dtype=float)
+    pob = np.where(np.isfinite(pob), pob, 0).astype(np.int64).tolist()
     
-    for idx, row in gdf.iterrows():
-        poblacion = 0
-        try:
-            poblacion = int(float(str(row[cols[6]]).replace(',', '').replace('*', '0') or 0))
-        except:
-            pass
-        
-        feature = {
+    if 'CVEGEO' in gdf.columns:
+        cvegeo = gdf['CVEGEO'].astype(str).tolist()
+    else:
+        cvegeo = [''] * len(gdf)
+    
+    features = [
+        {
             'type': 'Feature',
-            'geometry': row.geometry.__geo_interface__,
-            'properties': {
-                'poblacion': poblacion,
-                'cvegeo': str(row.get('CVEGEO', '')) if 'CVEGEO' in cols else ''
-            }
+            'geometry': geom.__geo_interface__,
+            'properties': {'poblacion': p, 'cvegeo': c}
         }
-        features.append(feature)
+        for geom, p, c in zip(gdf.geometry.values, pob, cvegeo)
+    ]
     
     return {'type': 'FeatureCollection', 'features': features}
 
+def _manzanas_geojson_bytes(gdf):
+    """Serialize manzanas GeoJSON once so the map endpoints can serve the bytes as-is"""
+    return orjson.dumps(_manzanas_gdf_to_geojson(gdf), default=str, option=ORJSON_OPTIONS)
+
+_EMPTY_FEATURE_COLLECTION = orjson.dumps({'type': 'FeatureCollection', 'features': []})
+
 @app.route('/api/dashboard/municipio/<municipio>/unserved-manzanas', methods=['GET'])
 def get_unserved_manzanas_geojson(municipio):
     """Get GeoJSON of unserved manzanas in municipality for map display"""
-    if municipio not in _unserved_manzanas_cache:
-        return jsonify({'type': 'FeatureCollection', 'features': []})
-    
-    return jsonify(_manzanas_gdf_to_geojson(_unserved_manzanas_cache[municipio]))
+    return _geojson_response(_unserved_manzanas_cache.get(municipio, _EMPTY_FEATURE_COLLECTION))
 
 @app.route('/api/dashboard/municipio/<municipio>/served-manzanas', methods=['GET'])
 def get_served_manzanas_geojson(municipio):
     """Get GeoJSON of served manzanas in municipality for map display"""
-    if municipio not in _served_manzanas_cache:
-        return jsonify({'type': 'FeatureCollection', 'features': []})
-    
-    return jsonify(_manzanas_gdf_to_geojson(_served_manzanas_cache[municipio]))
+    return _geojson_response(_served_manzanas_cache.get(municipio, _EMPTY_FEATURE_COLLECTION))
 
 # ============== EXPORT ENDPOINTS ==============
 
 @app.route('/api/export/route/<route_id>/json', methods=['GET'])
 def export_route_json(route_id):
     """Export route analysis as JSON"""
-    db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
@@ -700,8 +924,7 @@ def export_route_json(route_id):
 @app.route('/api/export/route/<route_id>/shapefile', methods=['GET'])
 def export_route_shapefile(route_id):
     """Export route as shapefile with attributes"""
-    db = load_routes_db()
-    route = next((r for r in db['routes'] if r['id'] == route_id), None)
+    route = get_route_by_id(route_id)
     
     if not route:
         return jsonify({'error': 'Route not found'}), 404
@@ -712,6 +935,20 @@ def export_route_shapefile(route_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/export/route/<route_id>/geopackage', methods=['GET'])
+def export_route_geopackage(route_id):
+    """Export route as GeoPackage with attributes"""
+    route = get_route_by_id(route_id)
+    
+    if not route:
+        return jsonify({'error': 'Route not found'}), 404
+    
+    try:
+        filepath = export_service.export_geopackage(route)
+        return send_file(filepath, as_attachment=True)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/export/routes/csv', methods=['GET'])
 def export_routes_csv():
     """Export all routes summary as CSV"""
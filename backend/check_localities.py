@@ -1,7 +1,8 @@
-import json
+import orjson
+import pandas as pd
 
-with open('data/routes.json', 'r', encoding='utf-8') as f:
-    data = json.load(f)
+with open('data/routes.json', 'rb') as f:
+    data = orjson.loads(f.read())
 
 routes = data['routes']
 print(f"Total routes: {len(routes)}")
@@ -22,24 +23,15 @@ for r in routes[:2]:
             print(f"      Sample urban loc: {urbs[0]}")
 
 # Check for duplicates across routes
-all_localities = {}
-for r in routes:
-    a = r.get('analysis', {})
-    for mun in a.get('municipios_atravesados', []):
-        for loc in mun.get('localidades_urbanas', []):
-            name = loc.get('nombre')
-            if name in all_localities:
-                all_localities[name].append(r.get('nombre'))
-            else:
-                all_localities[name] = [r.get('nombre')]
-        for loc in mun.get('localidades_rurales', []):
-            name = loc.get('nombre')
-            if name in all_localities:
-                all_localities[name].append(r.get('nombre'))
-            else:
-                all_localities[name] = [r.get('nombre')]
+municipios = [
+    {'ruta': r.get('nombre'), 'localidades': mun.get('localidades_urbanas', []) + mun.get('localidades_rurales', [])}
+    for r in routes
+    for mun in r.get('analysis', {}).get('municipios_atravesados', [])
+]
+localities = pd.json_normalize(municipios, record_path='localidades', meta='ruta')
 
 print("\n\nLocalities appearing in multiple routes:")
-for name, routes_list in all_localities.items():
-    if len(routes_list) > 1:
+if 'nombre' in localities.columns:
+    by_name = localities.groupby('nombre', sort=False, dropna=False)['ruta'].agg(list)
+    for name, routes_list in by_name[by_name.str.len() > 1].items():
         print(f"  {name}: {routes_list}")
@@ -1,44 +1,57 @@
-import json
+import sys
+
+import orjson
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Pass -v to list every locality per route
+verbose = '-v' in sys.argv[1:]
+
+
+def _iter_routes(path):
+    """Yield routes one at a time, streaming the file when ijson is available"""
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            yield from ijson.items(f, 'routes.item', use_float=True)
+        else:
+            yield from orjson.loads(f.read())['routes']
 
-with open('data/routes.json', 'r', encoding='utf-8') as f:
-    data = json.load(f)
 
 # Filter routes for Zapotlan de Juarez
-routes = [r for r in data['routes'] if r.get('municipio') == 'Zapotlán de Juárez']
+routes = [r for r in _iter_routes('data/routes.json') if r.get('municipio') == 'Zapotlán de Juárez']
 print(f"Routes in Zapotlan: {len(routes)}")
 
+
+def _collect(kind):
+    """(id, nombre, ruta) for every locality of the given kind across routes"""
+    return [
+        (loc.get('cvegeo') or loc.get('nombre'), loc.get('nombre'), r.get('nombre'))
+        for r in routes
+        for mun in r.get('analysis', {}).get('municipios_atravesados', [])
+        for loc in mun.get(kind, [])
+    ]
+
+
 # Collect all localities using sets (like the API does)
-total_localidades = set()
-localidades_urbanas = set()
-localidades_rurales = set()
+urbanas = _collect('localidades_urbanas')
+rurales = _collect('localidades_rurales')
+
+localidades_urbanas = {loc[0] for loc in urbanas}
+localidades_rurales = {loc[0] for loc in rurales}
+total_localidades = localidades_urbanas | localidades_rurales
 
 # Also track by name to see if cvegeo causes issues
-by_name_total = set()
-by_name_urbanas = set()
-by_name_rurales = set()
-
-for r in routes:
-    print(f"\nRoute: {r.get('nombre')}")
-    a = r.get('analysis', {})
-    
-    for mun in a.get('municipios_atravesados', []):
-        for loc in mun.get('localidades_urbanas', []):
-            loc_id = loc.get('cvegeo') or loc.get('nombre')
-            nombre = loc.get('nombre')
-            total_localidades.add(loc_id)
-            localidades_urbanas.add(loc_id)
-            by_name_total.add(nombre)
-            by_name_urbanas.add(nombre)
-            print(f"  [U] {nombre} (cvegeo: {loc.get('cvegeo')})")
-            
-        for loc in mun.get('localidades_rurales', []):
-            loc_id = loc.get('cvegeo') or loc.get('nombre')
-            nombre = loc.get('nombre')
-            total_localidades.add(loc_id)
-            localidades_rurales.add(loc_id)
-            by_name_total.add(nombre)
-            by_name_rurales.add(nombre)
-            print(f"  [R] {nombre} (cvegeo: {loc.get('cvegeo')})")
+by_name_urbanas = {loc[1] for loc in urbanas}
+by_name_rurales = {loc[1] for loc in rurales}
+by_name_total = by_name_urbanas | by_name_rurales
+
+if verbose:
+    for tag, locs in (('U', urbanas), ('R', rurales)):
+        for loc_id, nombre, ruta in locs:
+            print(f"  [{tag}] {ruta}: {nombre} (id: {loc_id})")
 
 print(f"\n=== By CVEGEO ===")
 print(f"Total: {len(total_localidades)}")
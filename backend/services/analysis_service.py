@@ -1,28 +1,127 @@
+import hashlib
 import os
-import json
-import math
-import numpy as np
+import shutil
+import tempfile
+import orjson
+import shapely
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from shapely.geometry import Point, LineString, MultiLineString
 from shapely.ops import nearest_points
-import geopandas as gpd
 
+from services import route_cache
 from services.gpx_extractor import GPXExtractor
 from services.map_matcher import MapMatcher
 from services.road_analyzer import RoadAnalyzer
 from services.locality_detector import LocalityDetector
 from services.segment_colorizer import SegmentColorizer
-from services.service_area_analyzer import ServiceAreaAnalyzer
+from services.shapefile_service import read_layer
+from services.service_area_analyzer import get_service_area_analyzer
 from services.network_analyzer import get_network_analyzer
 
+
+# Projected CRS (UTM 14N) used for metric buffers and lengths, same as the other services
+METRIC_CRS = 'EPSG:32614'
+
+# Pre-serialized JSON embedded as-is by orjson.dumps (orjson >= 3.9)
+OrjsonFragment = getattr(orjson, 'Fragment', None)
+
+
+def _clean_geometries(gdf):
+    """Drop null/empty geometries and repair invalid ones so spatial predicates never raise"""
+    geoms = gdf.geometry.values
+    gdf = gdf[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))]
+    invalid = ~shapely.is_valid(gdf.geometry.values)
+    if invalid.any():
+        gdf = gdf.copy()
+        gdf.loc[invalid, gdf.geometry.name] = shapely.make_valid(gdf.geometry.values[invalid])
+    return gdf.reset_index(drop=True)
+
+
+@lru_cache(maxsize=16)
+def _read_layer_cached(shp_path, shp_mtime_ns, crs=None):
+    """Load a base layer through a GeoParquet sidecar built from the .shp on first use"""
+    if crs is not None:
+        # Reprojected copy, cached alongside the original layer
+        gdf = _read_layer_cached(shp_path, shp_mtime_ns).to_crs(crs)
+        gdf.sindex
+        return gdf
+    
+    gdf = _clean_geometries(read_layer(shp_path))
+    
+    # Build the STRtree once, every analysis reuses it
+    gdf.sindex
+    return gdf
+
+
+@lru_cache(maxsize=4)
+def _road_attributes_cached(shp_path, shp_mtime_ns):
+    """RoadAnalyzer's normalized per-segment arrays for a road network layer, built once per file version"""
+    # The metric copy is already cached, so segment lengths need no reprojection
+    return RoadAnalyzer(_read_layer_cached(shp_path, shp_mtime_ns, METRIC_CRS)).segment_attributes()
+
+
+ANALYSIS_LAYERS = ('road_network', 'municipalities', 'localities')
+
+# Layers whose changes invalidate cached results; bump the version when the pipeline output changes
+RESULT_CACHE_LAYERS = ANALYSIS_LAYERS + ('manzanas',)
+RESULT_CACHE_VERSION = 2
+# Cached results kept for the current layers; older entries are deleted first
+RESULT_CACHE_SIZE = 1024
+
+
+def preload_analysis_layers(data_folder):
+    """Pool initializer: load the base layers and their STRtrees once per worker"""
+    for shapefile_type in ANALYSIS_LAYERS:
+        shp_path = os.path.join(data_folder, 'shapefiles', shapefile_type, f'{shapefile_type}.shp')
+        if os.path.exists(shp_path):
+            _read_layer_cached(shp_path, os.stat(shp_path).st_mtime_ns)
+            # Metric copy used by MapMatcher and LocalityDetector
+            _read_layer_cached(shp_path, os.stat(shp_path).st_mtime_ns, METRIC_CRS)
+    
+    # Segment attributes used by RoadAnalyzer
+    shp_path = os.path.join(data_folder, 'shapefiles', 'road_network', 'road_network.shp')
+    if os.path.exists(shp_path):
+        _road_attributes_cached(shp_path, os.stat(shp_path).st_mtime_ns)
+    
+    # Manzanas, network graph and population arrays used by the service area step
+    get_service_area_analyzer(data_folder)
+
+
+def analyze_route_worker(route, config, data_folder, results_folder):
+    """Picklable entry point to analyze a route in a worker process"""
+    return AnalysisService(data_folder, results_folder).analyze_route(route, config)
+
+
 class AnalysisService:
     def __init__(self, data_folder, results_folder):
         self.data_folder = data_folder
         self.results_folder = results_folder
         self.gpx_folder = os.path.join(data_folder, 'gpx')
+        self.cache_folder = os.path.join(results_folder, 'cache')
         
         os.makedirs(results_folder, exist_ok=True)
     
+    def analyze_routes(self, routes, config, max_workers=None):
+        """Analyze several routes in parallel worker processes, results in input order"""
+        if len(routes) <= 1:
+            return [self.analyze_route(route, config) for route in routes]
+        
+        max_workers = min(max_workers or os.cpu_count() or 1, len(routes))
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=preload_analysis_layers,
+                                 initargs=(self.data_folder,)) as executor:
+            futures = [executor.submit(analyze_route_worker, route, config, self.data_folder, self.results_folder)
+                       for route in routes]
+            results = []
+            for future in futures:
+                # A crashed worker fails only its own route
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append({'success': False, 'error': str(e)})
+            return results
+    
     def analyze_route(self, route, config):
         """Perform complete analysis of a route using the new services"""
         route_id = route['id']
@@ -37,6 +136,16 @@ class AnalysisService:
             with open(gpx_path, 'rb') as f:
                 gpx_bytes = f.read()
             
+            # Same GPX, config and layers as a previous run: reuse its results
+            cache_key = self._result_cache_key(gpx_bytes, config)
+            cached = self._load_cached_results(cache_key)
+            if cached is not None:
+                self._write_results(route_id, cached)
+                return {
+                    'success': True,
+                    'analysis': cached['analysis']
+                }
+            
             extractor = GPXExtractor(gpx_bytes)
             gpx_metrics = extractor.analyze()
             gpx_linestring = extractor.get_linestring()
@@ -56,17 +165,17 @@ class AnalysisService:
             matched_segments_gdf = None
             
             if road_network is not None:
-                matcher = MapMatcher(gpx_linestring, road_network, buffer_distance)
+                matcher = MapMatcher(gpx_linestring, road_network, buffer_distance,
+                                     rnc_projected=self._load_shapefile('road_network', METRIC_CRS))
                 matched_result = matcher.match()
                 
                 # 4. Analyze road attributes using RoadAnalyzer
                 if matched_result['matched_segments']:
-                    analyzer = RoadAnalyzer(road_network)
+                    analyzer = RoadAnalyzer(road_network, segment_attrs=self._load_road_attributes())
                     road_stats = analyzer.analyze(matched_result['matched_segments'], gpx_linestring)
                     
-                    # Get matched segments GeoDataFrame for colorization
-                    unique_indices = list(set([s['index'] for s in matched_result['matched_segments']]))
-                    matched_segments_gdf = road_network.loc[unique_indices]
+                    # Matched segments GeoDataFrame for colorization
+                    matched_segments_gdf = matched_result['matched_gdf']
             
             # 5. Detect localities and municipalities using LocalityDetector with network analysis
             locality_result = {'municipios': [], 'total_municipios': 0, 'total_urbanas': 0, 'total_rurales': 0}
@@ -78,12 +187,18 @@ class AnalysisService:
                 print(f"Warning: Could not initialize network analyzer: {e}")
                 network_analyzer = None
             
+            # Cached metric copies (with their STRtrees) instead of reprojecting per analysis
+            municipalities_projected = self._load_shapefile('municipalities', METRIC_CRS)
             if localities is not None:
-                detector = LocalityDetector(localities, municipalities, buffer_meters=700, network_analyzer=network_analyzer)
+                detector = LocalityDetector(localities, municipalities, buffer_meters=700, network_analyzer=network_analyzer,
+                                            marco_projected=self._load_shapefile('localities', METRIC_CRS),
+                                            municipios_projected=municipalities_projected)
                 locality_result = detector.detect(gpx_linestring, use_network=True)
             elif municipalities is not None:
                 # If no localities but we have municipalities, detect them directly
-                detector = LocalityDetector(municipalities, municipalities, buffer_meters=700, network_analyzer=network_analyzer)
+                detector = LocalityDetector(municipalities, municipalities, buffer_meters=700, network_analyzer=network_analyzer,
+                                            marco_projected=municipalities_projected,
+                                            municipios_projected=municipalities_projected)
                 locality_result = detector.detect(gpx_linestring, use_network=True)
             
             # 6. Generate colored segments for visualization
@@ -92,13 +207,17 @@ class AnalysisService:
             colored_by_slope = extractor.get_colored_segments_by_slope()
             
             if matched_segments_gdf is not None and len(matched_segments_gdf) > 0:
-                colored_by_surface = SegmentColorizer.colorize_by_surface(matched_segments_gdf)
-                colored_by_admin = SegmentColorizer.colorize_by_administration(matched_segments_gdf)
+                if OrjsonFragment is not None:
+                    # Only ever written to the results files, so skip the per-Feature dicts
+                    colored_by_surface, colored_by_admin = map(
+                        OrjsonFragment, SegmentColorizer.colorize_both_bytes(matched_segments_gdf))
+                else:
+                    colored_by_surface, colored_by_admin = SegmentColorizer.colorize_both(matched_segments_gdf)
             
             # 7. Service area analysis (manzanas within 700m walking distance)
             service_area_result = {'success': False, 'stats': {}}
             try:
-                service_analyzer = ServiceAreaAnalyzer(self.data_folder)
+                service_analyzer = get_service_area_analyzer(self.data_folder)
                 service_area_result = service_analyzer.analyze(gpx_linestring, buffer_distance_m=700)
             except Exception as e:
                 print(f"Service area analysis error: {e}")
@@ -149,11 +268,12 @@ class AnalysisService:
             }
             
             # Save results with visualization data
-            self._save_results(route_id, analysis, matched_result, {
+            results = self._save_results(route_id, analysis, matched_result, {
                 'colored_by_surface': colored_by_surface,
                 'colored_by_admin': colored_by_admin,
                 'colored_by_slope': colored_by_slope
             })
+            self._store_cached_results(cache_key, results)
             
             return {
                 'success': True,
@@ -165,319 +285,26 @@ class AnalysisService:
             traceback.print_exc()
             return {'success': False, 'error': str(e)}
     
-    def _calculate_basic_metrics(self, points):
-        """Calculate basic route metrics"""
-        total_distance = 0
-        total_time = 0
-        speeds = []
-        elevations = []
-        elevation_gains = []
-        elevation_losses = []
-        slopes_up = []
-        slopes_down = []
-        
-        prev_point = None
-        prev_time = None
-        
-        for point in points:
-            if point.get('ele') is not None:
-                elevations.append(point['ele'])
-            
-            if prev_point:
-                # Calculate distance using Haversine formula
-                dist = self._haversine(
-                    prev_point['lat'], prev_point['lon'],
-                    point['lat'], point['lon']
-                )
-                total_distance += dist
-                
-                # Calculate time difference
-                if point.get('time') and prev_point.get('time'):
-                    try:
-                        t1 = datetime.fromisoformat(prev_point['time'].replace('Z', '+00:00'))
-                        t2 = datetime.fromisoformat(point['time'].replace('Z', '+00:00'))
-                        time_diff = (t2 - t1).total_seconds()
-                        
-                        if time_diff > 0:
-                            total_time += time_diff
-                            speed = (dist / time_diff) * 3600  # km/h
-                            if speed < 200:  # Filter unrealistic speeds
-                                speeds.append(speed)
-                    except:
-                        pass
-                
-                # Calculate elevation changes
-                if point.get('ele') is not None and prev_point.get('ele') is not None:
-                    ele_diff = point['ele'] - prev_point['ele']
-                    if ele_diff > 0:
-                        elevation_gains.append(ele_diff)
-                        if dist > 0:
-                            slope = (ele_diff / (dist * 1000)) * 100
-                            slopes_up.append(slope)
-                    elif ele_diff < 0:
-                        elevation_losses.append(abs(ele_diff))
-                        if dist > 0:
-                            slope = (abs(ele_diff) / (dist * 1000)) * 100
-                            slopes_down.append(slope)
-            
-            prev_point = point
-        
-        return {
-            'distance_km': round(total_distance, 3),
-            'duration_min': round(total_time / 60, 2) if total_time > 0 else 0,
-            'avg_speed_kmh': round(np.mean(speeds), 2) if speeds else 0,
-            'max_speed_kmh': round(max(speeds), 2) if speeds else 0,
-            'elevation_min': round(min(elevations), 1) if elevations else 0,
-            'elevation_max': round(max(elevations), 1) if elevations else 0,
-            'elevation_gain': round(sum(elevation_gains), 1) if elevation_gains else 0,
-            'elevation_loss': round(sum(elevation_losses), 1) if elevation_losses else 0,
-            'avg_slope_up': round(np.mean(slopes_up), 2) if slopes_up else 0,
-            'avg_slope_down': round(np.mean(slopes_down), 2) if slopes_down else 0
-        }
-    
-    def _haversine(self, lat1, lon1, lat2, lon2):
-        """Calculate distance in km between two points using Haversine formula"""
-        R = 6371  # Earth's radius in km
-        
-        lat1_rad = math.radians(lat1)
-        lat2_rad = math.radians(lat2)
-        delta_lat = math.radians(lat2 - lat1)
-        delta_lon = math.radians(lon2 - lon1)
-        
-        a = math.sin(delta_lat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        
-        return R * c
-    
-    def _load_shapefile(self, shapefile_type):
-        """Load a shapefile as GeoDataFrame with proper encoding"""
-        shp_path = os.path.join(self.data_folder, 'shapefiles', shapefile_type, f'{shapefile_type}.shp')
+    def _load_road_attributes(self):
+        """RoadAnalyzer's segment attribute arrays for the road network, cached per file version"""
+        shp_path = os.path.join(self.data_folder, 'shapefiles', 'road_network', 'road_network.shp')
         
         if not os.path.exists(shp_path):
             return None
         
-        # Try multiple encodings for Spanish characters
-        encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
-        for encoding in encodings:
-            try:
-                gdf = gpd.read_file(shp_path, encoding=encoding)
-                # Test if encoding worked by checking for garbled characters
-                sample = str(gdf.iloc[0].to_dict()) if len(gdf) > 0 else ''
-                if 'Ã' not in sample:  # Common sign of wrong encoding
-                    return gdf
-            except Exception:
-                continue
-        
-        # Fallback
-        return gpd.read_file(shp_path)
-    
-    def _map_matching(self, route_line, road_network, buffer_distance):
-        """Match GPX track to road network"""
-        if road_network is None:
-            return {
-                'matched_segments': None,
-                'matched_line': None,
-                'confidence': 0,
-                'matched_distance_km': 0
-            }
-        
-        # Convert buffer distance from meters to degrees (approximate)
-        buffer_deg = buffer_distance / 111000
-        
-        # Create buffer around route
-        route_buffer = route_line.buffer(buffer_deg)
-        
-        # Find road segments within buffer
-        road_network_copy = road_network.copy()
-        road_network_copy['intersects'] = road_network_copy.geometry.intersects(route_buffer)
-        nearby_roads = road_network_copy[road_network_copy['intersects']].copy()
-        
-        if len(nearby_roads) == 0:
-            return {
-                'matched_segments': None,
-                'matched_line': None,
-                'confidence': 0,
-                'matched_distance_km': 0
-            }
-        
-        # Calculate matched distance
-        matched_lines = []
-        for idx, road in nearby_roads.iterrows():
-            try:
-                intersection = road.geometry.intersection(route_buffer)
-                if not intersection.is_empty:
-                    matched_lines.append(intersection)
-            except:
-                pass
-        
-        # Calculate total matched distance
-        matched_distance = 0
-        for line in matched_lines:
-            if hasattr(line, 'length'):
-                matched_distance += line.length * 111  # Approximate conversion to km
-        
-        # Calculate confidence based on how much of the route is matched
-        route_length = route_line.length * 111
-        confidence = min(100, (matched_distance / route_length * 100)) if route_length > 0 else 0
-        
-        return {
-            'matched_segments': nearby_roads,
-            'matched_line': matched_lines,
-            'confidence': round(confidence, 1),
-            'matched_distance_km': round(matched_distance, 3)
-        }
+        return _road_attributes_cached(shp_path, os.stat(shp_path).st_mtime_ns)
     
-    def _calculate_road_stats(self, matched_segments):
-        """Calculate statistics from matched road segments"""
-        surface_stats = {'pavimentado_km': 0, 'terraceria_km': 0, 'na_km': 0}
-        admin_stats = {'federal_km': 0, 'estatal_km': 0, 'municipal_km': 0, 'na_km': 0}
-        
-        # Find relevant columns
-        surface_col = self._find_name_column(matched_segments, [
-            'CONDICION', 'TIPO_SUPER', 'SUPERFICIE', 'condicion', 'tipo_super',
-            'TIPO_PAVIM', 'PAVIMENTO', 'RECUBRIMIE', 'tipo_pav'
-        ])
-        
-        admin_col = self._find_name_column(matched_segments, [
-            'ADMINISTRA', 'TIPO_ADMIN', 'JURISDICCI', 'administra', 'tipo_admin',
-            'COMPETENCI', 'TIPO_VIA', 'JERARQUIA', 'jerarquia'
-        ])
-        
-        for idx, segment in matched_segments.iterrows():
-            try:
-                length_km = segment.geometry.length * 111  # Approximate km
-                
-                # Surface classification
-                if surface_col:
-                    surface_val = str(segment.get(surface_col, '')).lower()
-                    if any(s in surface_val for s in ['paviment', 'asfalto', 'concreto', 'pavimentad', 'revestid']):
-                        surface_stats['pavimentado_km'] += length_km
-                    elif any(s in surface_val for s in ['terraceria', 'tierra', 'brecha', 'terr', 'sin pavimento']):
-                        surface_stats['terraceria_km'] += length_km
-                    else:
-                        surface_stats['na_km'] += length_km
-                else:
-                    surface_stats['na_km'] += length_km
-                
-                # Admin classification
-                if admin_col:
-                    admin_val = str(segment.get(admin_col, '')).lower()
-                    if any(a in admin_val for a in ['federal', 'federales', 'fed']):
-                        admin_stats['federal_km'] += length_km
-                    elif any(a in admin_val for a in ['estatal', 'estatales', 'est']):
-                        admin_stats['estatal_km'] += length_km
-                    elif any(a in admin_val for a in ['municipal', 'municipales', 'mun', 'local']):
-                        admin_stats['municipal_km'] += length_km
-                    else:
-                        admin_stats['na_km'] += length_km
-                else:
-                    admin_stats['na_km'] += length_km
-                    
-            except Exception as e:
-                pass
-        
-        # Round values
-        for key in surface_stats:
-            surface_stats[key] = round(surface_stats[key], 3)
-        for key in admin_stats:
-            admin_stats[key] = round(admin_stats[key], 3)
+    def _load_shapefile(self, shapefile_type, crs=None):
+        """Load a shapefile as GeoDataFrame with proper encoding, optionally reprojected"""
+        shp_path = os.path.join(self.data_folder, 'shapefiles', shapefile_type, f'{shapefile_type}.shp')
         
-        return surface_stats, admin_stats
-    
-    def _find_name_column(self, gdf, possible_names):
-        """Find a column from a list of possible names"""
-        if gdf is None:
+        if not os.path.exists(shp_path):
             return None
         
-        columns = [c.upper() for c in gdf.columns]
-        for name in possible_names:
-            if name.upper() in columns:
-                idx = columns.index(name.upper())
-                return gdf.columns[idx]
-        return None
-    
-    def _find_intersecting_features(self, route_line, gdf, name_col, id_col):
-        """Find features that intersect with route"""
-        if gdf is None:
-            return []
-        
-        features = []
-        route_buffer = route_line.buffer(0.001)  # Small buffer
-        
-        for idx, feature in gdf.iterrows():
-            try:
-                if feature.geometry.intersects(route_buffer):
-                    name = feature.get(name_col, '') if name_col else ''
-                    feature_id = feature.get(id_col, '') if id_col else ''
-                    features.append({
-                        'nombre': str(name),
-                        'clave': str(feature_id)
-                    })
-            except:
-                pass
-        
-        return features
-    
-    def _find_nearby_localities(self, route_line, localities_gdf, buffer_distance):
-        """Find localities near the route"""
-        if localities_gdf is None:
-            return {'urbanas': [], 'rurales': [], 'total': []}
-        
-        buffer_deg = buffer_distance / 111000
-        route_buffer = route_line.buffer(buffer_deg)
-        
-        # Find column names
-        name_col = self._find_name_column(localities_gdf, [
-            'NOM_LOC', 'NOMBRE', 'NOMGEO', 'nombre', 'name', 'LOCALIDAD'
-        ])
-        type_col = self._find_name_column(localities_gdf, [
-            'AMBITO', 'TIPO', 'TIPO_LOC', 'tipo', 'ambito', 'URBAN_RURA'
-        ])
-        mun_col = self._find_name_column(localities_gdf, [
-            'CVE_MUN', 'CVEGEO', 'NOM_MUN', 'municipio', 'MUNICIPIO'
-        ])
-        
-        urbanas = []
-        rurales = []
-        total = []
-        
-        for idx, loc in localities_gdf.iterrows():
-            try:
-                if loc.geometry.intersects(route_buffer) or loc.geometry.within(route_buffer):
-                    name = str(loc.get(name_col, '')) if name_col else f'Localidad {idx}'
-                    mun = str(loc.get(mun_col, '')) if mun_col else ''
-                    
-                    # Determine type
-                    loc_type = 'rural'
-                    if type_col:
-                        type_val = str(loc.get(type_col, '')).lower()
-                        if any(u in type_val for u in ['urban', 'urbana', 'u', '1']):
-                            loc_type = 'urbana'
-                    
-                    loc_info = {
-                        'nombre': name,
-                        'municipio': mun,
-                        'tipo': loc_type
-                    }
-                    
-                    total.append(loc_info)
-                    if loc_type == 'urbana':
-                        urbanas.append(loc_info)
-                    else:
-                        rurales.append(loc_info)
-            except:
-                pass
-        
-        return {
-            'urbanas': urbanas,
-            'rurales': rurales,
-            'total': total
-        }
+        return _read_layer_cached(shp_path, os.stat(shp_path).st_mtime_ns, crs)
     
     def _save_results(self, route_id, analysis, matched_result, visualization_data=None):
         """Save analysis results to file"""
-        results_path = os.path.join(self.results_folder, f'{route_id}_results.json')
-        
         # Convert aligned geometry to GeoJSON if available
         aligned_geojson = None
         if matched_result.get('aligned_geometry') is not None:
@@ -493,16 +320,84 @@ class AnalysisService:
             except:
                 pass
         
-        results = {
-            'route_id': route_id,
+        return self._write_results(route_id, {
             'analysis': analysis,
             'aligned_geojson': aligned_geojson,
-            'visualization': visualization_data or {},
+            'visualization': visualization_data or {}
+        })
+    
+    def _write_results(self, route_id, content):
+        """Write the results file for a route and return what was written"""
+        results_path = os.path.join(self.results_folder, f'{route_id}_results.json')
+        results = {
+            'route_id': route_id,
+            'analysis': content['analysis'],
+            'aligned_geojson': content['aligned_geojson'],
+            'visualization': content['visualization'],
             'analyzed_at': datetime.now().isoformat()
         }
         
-        with open(results_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2, default=str)
+        with open(results_path, 'wb') as f:
+            f.write(orjson.dumps(results, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        return results
+    
+    def _result_cache_key(self, gpx_bytes, config):
+        """
+        Content hash of everything an analysis depends on, as '<generation>/<hash>'.
+        The generation folder changes with the layers and RESULT_CACHE_VERSION.
+        """
+        generation = hashlib.blake2b(f'v{RESULT_CACHE_VERSION};'.encode(), digest_size=8)
+        for shapefile_type in RESULT_CACHE_LAYERS:
+            shp_path = os.path.join(self.data_folder, 'shapefiles', shapefile_type, f'{shapefile_type}.shp')
+            mtime = os.stat(shp_path).st_mtime_ns if os.path.exists(shp_path) else 0
+            generation.update(f'{shapefile_type}:{mtime};'.encode())
+        
+        h = hashlib.blake2b(gpx_bytes, digest_size=16)
+        # Only the analysis parameters, layer metadata in config is covered by the generation
+        h.update(f"buffer:{config.get('buffer_distance', 50)};".encode())
+        return f'{generation.hexdigest()}/{h.hexdigest()}'
+    
+    def _load_cached_results(self, cache_key):
+        """Cached results for a content key, or None"""
+        cache_path = os.path.join(self.cache_folder, f'{cache_key}.json')
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+    
+    def _store_cached_results(self, cache_key, results):
+        """Keep the route-independent part of the results under the content key"""
+        cache_path = os.path.join(self.cache_folder, f'{cache_key}.json')
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        content = {k: results[k] for k in ('analysis', 'aligned_geojson', 'visualization')}
+        # Unique temp file per call: single-route analyses run in threads of the same process
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(content, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        os.replace(tmp_path, cache_path)
+        try:
+            self._prune_cached_results(os.path.dirname(cache_path))
+        except OSError:
+            pass  # Another worker is pruning too; the next store tries again
+    
+    def _prune_cached_results(self, generation_folder):
+        """Delete results cached for other layers or versions, and the oldest past RESULT_CACHE_SIZE"""
+        for entry in os.scandir(self.cache_folder):
+            if entry.path == generation_folder:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        
+        cached = [entry for entry in os.scandir(generation_folder) if entry.name.endswith('.json')]
+        if len(cached) > RESULT_CACHE_SIZE:
+            cached.sort(key=lambda entry: entry.stat().st_mtime_ns)
+            for entry in cached[:len(cached) - RESULT_CACHE_SIZE]:
+                os.remove(entry.path)
     
     def get_results(self, route_id):
         """Get analysis results for a route"""
@@ -511,5 +406,4 @@ class AnalysisService:
         if not os.path.exists(results_path):
             return None
         
-        with open(results_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        return route_cache.get_results(results_path)
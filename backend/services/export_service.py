@@ -1,10 +1,99 @@
 import os
-import json
+import csv
 import tempfile
 import zipfile
-import pandas as pd
+import numpy as np
 import geopandas as gpd
 from shapely.geometry import LineString
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+
+from services import route_cache
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+
+# Columns of the routes summary export (CSV / Excel), in order
+_COLUMNS = (
+    'ID', 'Nombre', 'Municipio', 'Modalidad', 'Clave Mnemotécnica', 'Analizado',
+    'Distancia (km)', 'Duración (min)', 'Velocidad Promedio (km/h)', 'Velocidad Máxima (km/h)',
+    'Elevación Mínima (m)', 'Elevación Máxima (m)', 'Ganancia Elevación (m)', 'Pérdida Elevación (m)',
+    'Pavimentado (km)', 'Terracería (km)', 'Federal (km)', 'Estatal (km)', 'Municipal (km)',
+    'Municipios Atravesados', 'Localidades Urbanas', 'Localidades Rurales', 'Confianza Matching (%)'
+)
+
+
+def _row(route):
+    """Summary values of a route, in _COLUMNS order"""
+    analysis = route.get('analysis', {})
+    superficie = analysis.get('superficie', {})
+    admin = analysis.get('administracion', {})
+    
+    return (
+        route.get('id', ''),
+        route.get('nombre', ''),
+        route.get('municipio', ''),
+        route.get('modalidad', ''),
+        route.get('clave_mnemotecnica', ''),
+        'Sí' if route.get('analyzed', False) else 'No',
+        analysis.get('distancia_km', ''),
+        analysis.get('duracion_min', ''),
+        analysis.get('velocidad_promedio_kmh', ''),
+        analysis.get('velocidad_maxima_kmh', ''),
+        analysis.get('elevacion_min_m', ''),
+        analysis.get('elevacion_max_m', ''),
+        analysis.get('ganancia_elevacion_m', ''),
+        analysis.get('perdida_elevacion_m', ''),
+        superficie.get('pavimentado_km', ''),
+        superficie.get('terraceria_km', ''),
+        admin.get('federal_km', ''),
+        admin.get('estatal_km', ''),
+        admin.get('municipal_km', ''),
+        analysis.get('num_municipios', ''),
+        analysis.get('localidades_urbanas', ''),
+        analysis.get('localidades_rurales', ''),
+        analysis.get('confianza_matching', '')
+    )
+
+
+_THIN = Side(style='thin')
+
+
+def _header_cell(ws, name):
+    """Bold, bordered, centered header cell (same look as the pandas Excel writer)"""
+    cell = WriteOnlyCell(ws, value=name)
+    cell.font = Font(bold=True)
+    cell.border = Border(left=_THIN, right=_THIN, top=_THIN, bottom=_THIN)
+    cell.alignment = Alignment(horizontal='center', vertical='top')
+    return cell
+
+
+# Shapefile (DBF) field names are limited to 10 characters
+_SHAPEFILE_FIELDS = {
+    'clave_mnemotecnica': 'clave_mnem',
+    'distancia_km': 'dist_km',
+    'duracion_min': 'dur_min',
+    'velocidad_promedio_kmh': 'vel_prom',
+    'velocidad_maxima_kmh': 'vel_max',
+    'elevacion_min_m': 'ele_min',
+    'elevacion_max_m': 'ele_max',
+    'ganancia_elevacion_m': 'ele_gain',
+    'perdida_elevacion_m': 'ele_loss',
+    'pavimentado_km': 'pav_km',
+    'terraceria_km': 'terr_km',
+    'federal_km': 'fed_km',
+    'estatal_km': 'est_km',
+    'municipal_km': 'mun_km',
+    'num_municipios': 'n_mun',
+    'localidades_urbanas': 'n_loc_urb',
+    'localidades_rurales': 'n_loc_rur',
+    'confianza_matching': 'confianza',
+}
+
 
 class ExportService:
     def __init__(self, results_folder):
@@ -12,8 +101,8 @@ class ExportService:
         self.exports_folder = os.path.join(results_folder, 'exports')
         os.makedirs(self.exports_folder, exist_ok=True)
     
-    def export_shapefile(self, route):
-        """Export route as shapefile with attributes"""
+    def _route_geodataframe(self, route):
+        """Route line with its analysis summary as a one-row GeoDataFrame (full field names)"""
         route_id = route['id']
         
         # Load results
@@ -21,8 +110,7 @@ class ExportService:
         if not os.path.exists(results_path):
             raise FileNotFoundError('Analysis results not found')
         
-        with open(results_path, 'r', encoding='utf-8') as f:
-            results = json.load(f)
+        results = route_cache.get_results(results_path)
         
         # Get GPX coordinates
         gpx_folder = os.path.join(os.path.dirname(self.results_folder), 'data', 'gpx')
@@ -31,55 +119,71 @@ class ExportService:
         if not os.path.exists(gpx_path):
             raise FileNotFoundError('GPX file not found')
         
-        # Parse GPX
-        import gpxpy
-        with open(gpx_path, 'r', encoding='utf-8') as f:
-            gpx = gpxpy.parse(f)
-        
-        coords = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    coords.append((point.longitude, point.latitude))
-        
-        if not coords:
+        # Parse GPX (track points only)
+        gpx = route_cache.get_arrays(gpx_path)
+        if gpx['kind'] != 'trkpt':
             raise ValueError('No coordinates found in GPX')
         
         # Create GeoDataFrame
-        line = LineString(coords)
+        line = LineString(np.column_stack((gpx['lon'], gpx['lat'])))
         analysis = results.get('analysis', {})
         
-        gdf = gpd.GeoDataFrame({
+        return gpd.GeoDataFrame({
             'id': [route_id],
             'nombre': [route.get('nombre', '')],
             'municipio': [route.get('municipio', '')],
             'modalidad': [route.get('modalidad', '')],
-            'clave_mnem': [route.get('clave_mnemotecnica', '')],
-            'dist_km': [analysis.get('distancia_km', 0)],
-            'dur_min': [analysis.get('duracion_min', 0)],
-            'vel_prom': [analysis.get('velocidad_promedio_kmh', 0)],
-            'vel_max': [analysis.get('velocidad_maxima_kmh', 0)],
-            'ele_min': [analysis.get('elevacion_min_m', 0)],
-            'ele_max': [analysis.get('elevacion_max_m', 0)],
-            'ele_gain': [analysis.get('ganancia_elevacion_m', 0)],
-            'ele_loss': [analysis.get('perdida_elevacion_m', 0)],
-            'pav_km': [analysis.get('superficie', {}).get('pavimentado_km', 0)],
-            'terr_km': [analysis.get('superficie', {}).get('terraceria_km', 0)],
-            'fed_km': [analysis.get('administracion', {}).get('federal_km', 0)],
-            'est_km': [analysis.get('administracion', {}).get('estatal_km', 0)],
-            'mun_km': [analysis.get('administracion', {}).get('municipal_km', 0)],
-            'n_mun': [analysis.get('num_municipios', 0)],
-            'n_loc_urb': [analysis.get('localidades_urbanas', 0)],
-            'n_loc_rur': [analysis.get('localidades_rurales', 0)],
-            'confianza': [analysis.get('confianza_matching', 0)]
+            'clave_mnemotecnica': [route.get('clave_mnemotecnica', '')],
+            'distancia_km': [analysis.get('distancia_km', 0)],
+            'duracion_min': [analysis.get('duracion_min', 0)],
+            'velocidad_promedio_kmh': [analysis.get('velocidad_promedio_kmh', 0)],
+            'velocidad_maxima_kmh': [analysis.get('velocidad_maxima_kmh', 0)],
+            'elevacion_min_m': [analysis.get('elevacion_min_m', 0)],
+            'elevacion_max_m': [analysis.get('elevacion_max_m', 0)],
+            'ganancia_elevacion_m': [analysis.get('ganancia_elevacion_m', 0)],
+            'perdida_elevacion_m': [analysis.get('perdida_elevacion_m', 0)],
+            'pavimentado_km': [analysis.get('superficie', {}).get('pavimentado_km', 0)],
+            'terraceria_km': [analysis.get('superficie', {}).get('terraceria_km', 0)],
+            'federal_km': [analysis.get('administracion', {}).get('federal_km', 0)],
+            'estatal_km': [analysis.get('administracion', {}).get('estatal_km', 0)],
+            'municipal_km': [analysis.get('administracion', {}).get('municipal_km', 0)],
+            'num_municipios': [analysis.get('num_municipios', 0)],
+            'localidades_urbanas': [analysis.get('localidades_urbanas', 0)],
+            'localidades_rurales': [analysis.get('localidades_rurales', 0)],
+            'confianza_matching': [analysis.get('confianza_matching', 0)]
         }, geometry=[line], crs='EPSG:4326')
+    
+    def export_geopackage(self, route):
+        """Export route as a single-file GeoPackage with attributes"""
+        route_id = route['id']
+        gdf = self._route_geodataframe(route)
+        
+        # One file, no ZIP step and no 10-character field name limit
+        gpkg_path = os.path.join(self.exports_folder, f'ruta_{route_id}.gpkg')
+        if os.path.exists(gpkg_path):
+            os.remove(gpkg_path)
+        if pyogrio is not None:
+            pyogrio.write_dataframe(gdf, gpkg_path, layer=f'ruta_{route_id}', driver='GPKG')
+        else:
+            gdf.to_file(gpkg_path, layer=f'ruta_{route_id}', driver='GPKG')
+        
+        return gpkg_path
+    
+    def export_shapefile(self, route):
+        """Export route as shapefile with attributes (legacy, zipped)"""
+        route_id = route['id']
+        gdf = self._route_geodataframe(route).rename(columns=_SHAPEFILE_FIELDS)
         
         # Export to shapefile
         export_folder = os.path.join(self.exports_folder, f'route_{route_id}')
         os.makedirs(export_folder, exist_ok=True)
         
         shp_path = os.path.join(export_folder, f'ruta_{route_id}.shp')
-        gdf.to_file(shp_path)
+        if pyogrio is not None:
+            # GDAL's batched writer, skips Fiona's per-feature Python loop
+            pyogrio.write_dataframe(gdf, shp_path)
+        else:
+            gdf.to_file(shp_path)
         
         # Create ZIP with all shapefile components
         zip_path = os.path.join(self.exports_folder, f'ruta_{route_id}.zip')
@@ -92,82 +196,26 @@ class ExportService:
     
     def export_csv(self, routes):
         """Export all routes summary as CSV"""
-        data = []
-        
-        for route in routes:
-            analysis = route.get('analysis', {})
-            superficie = analysis.get('superficie', {})
-            admin = analysis.get('administracion', {})
-            
-            data.append({
-                'ID': route.get('id', ''),
-                'Nombre': route.get('nombre', ''),
-                'Municipio': route.get('municipio', ''),
-                'Modalidad': route.get('modalidad', ''),
-                'Clave Mnemotécnica': route.get('clave_mnemotecnica', ''),
-                'Analizado': 'Sí' if route.get('analyzed', False) else 'No',
-                'Distancia (km)': analysis.get('distancia_km', ''),
-                'Duración (min)': analysis.get('duracion_min', ''),
-                'Velocidad Promedio (km/h)': analysis.get('velocidad_promedio_kmh', ''),
-                'Velocidad Máxima (km/h)': analysis.get('velocidad_maxima_kmh', ''),
-                'Elevación Mínima (m)': analysis.get('elevacion_min_m', ''),
-                'Elevación Máxima (m)': analysis.get('elevacion_max_m', ''),
-                'Ganancia Elevación (m)': analysis.get('ganancia_elevacion_m', ''),
-                'Pérdida Elevación (m)': analysis.get('perdida_elevacion_m', ''),
-                'Pavimentado (km)': superficie.get('pavimentado_km', ''),
-                'Terracería (km)': superficie.get('terraceria_km', ''),
-                'Federal (km)': admin.get('federal_km', ''),
-                'Estatal (km)': admin.get('estatal_km', ''),
-                'Municipal (km)': admin.get('municipal_km', ''),
-                'Municipios Atravesados': analysis.get('num_municipios', ''),
-                'Localidades Urbanas': analysis.get('localidades_urbanas', ''),
-                'Localidades Rurales': analysis.get('localidades_rurales', ''),
-                'Confianza Matching (%)': analysis.get('confianza_matching', '')
-            })
-        
-        df = pd.DataFrame(data)
         csv_path = os.path.join(self.exports_folder, 'rutas_resumen.csv')
-        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+        
+        # Rows are written as they are built, no intermediate table
+        with open(csv_path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(_COLUMNS)
+            writer.writerows(map(_row, routes))
         
         return csv_path
     
     def export_excel(self, routes):
         """Export all routes summary as Excel"""
-        data = []
-        
-        for route in routes:
-            analysis = route.get('analysis', {})
-            superficie = analysis.get('superficie', {})
-            admin = analysis.get('administracion', {})
-            
-            data.append({
-                'ID': route.get('id', ''),
-                'Nombre': route.get('nombre', ''),
-                'Municipio': route.get('municipio', ''),
-                'Modalidad': route.get('modalidad', ''),
-                'Clave Mnemotécnica': route.get('clave_mnemotecnica', ''),
-                'Analizado': 'Sí' if route.get('analyzed', False) else 'No',
-                'Distancia (km)': analysis.get('distancia_km', ''),
-                'Duración (min)': analysis.get('duracion_min', ''),
-                'Velocidad Promedio (km/h)': analysis.get('velocidad_promedio_kmh', ''),
-                'Velocidad Máxima (km/h)': analysis.get('velocidad_maxima_kmh', ''),
-                'Elevación Mínima (m)': analysis.get('elevacion_min_m', ''),
-                'Elevación Máxima (m)': analysis.get('elevacion_max_m', ''),
-                'Ganancia Elevación (m)': analysis.get('ganancia_elevacion_m', ''),
-                'Pérdida Elevación (m)': analysis.get('perdida_elevacion_m', ''),
-                'Pavimentado (km)': superficie.get('pavimentado_km', ''),
-                'Terracería (km)': superficie.get('terraceria_km', ''),
-                'Federal (km)': admin.get('federal_km', ''),
-                'Estatal (km)': admin.get('estatal_km', ''),
-                'Municipal (km)': admin.get('municipal_km', ''),
-                'Municipios Atravesados': analysis.get('num_municipios', ''),
-                'Localidades Urbanas': analysis.get('localidades_urbanas', ''),
-                'Localidades Rurales': analysis.get('localidades_rurales', ''),
-                'Confianza Matching (%)': analysis.get('confianza_matching', '')
-            })
-        
-        df = pd.DataFrame(data)
         excel_path = os.path.join(self.exports_folder, 'rutas_resumen.xlsx')
-        df.to_excel(excel_path, index=False, engine='openpyxl')
+        
+        # Write-only workbook streams rows to disk instead of keeping every cell in memory
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet('Sheet1')
+        ws.append([_header_cell(ws, name) for name in _COLUMNS])
+        for row in map(_row, routes):
+            ws.append(row)
+        wb.save(excel_path)
         
         return excel_path
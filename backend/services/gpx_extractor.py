@@ -1,10 +1,20 @@
 """
 Extrae métricas avanzadas del GPX: elevación, velocidad, pendientes, duración
 """
-import gpxpy
-import io
-from math import radians, cos, sin, asin, sqrt
+import numpy as np
 from datetime import timedelta
+from functools import cached_property
+
+from services.gpx_kernels import analyze_track
+from services.gpx_parser import parse_gpx_arrays
+
+
+R_TIERRA_KM = 6371  # Radio de la Tierra en km
+
+# Límites de pendiente (%) para colorear segmentos y sus categorías
+SLOPE_BINS = [2, 5, 10]
+SLOPE_COLORS = ['#28a745', '#ffc107', '#fd7e14', '#dc3545']  # Verde, amarillo, naranja, rojo
+SLOPE_CATEGORIES = ['Plano (< 2%)', 'Moderado (2-5%)', 'Pronunciado (5-10%)', 'Muy Pronunciado (>10%)']
 
 
 class GPXExtractor:
@@ -13,159 +23,196 @@ class GPXExtractor:
         Args:
             gpx_file_or_bytes: Archivo GPX o bytes
         """
-        if isinstance(gpx_file_or_bytes, bytes):
-            self.gpx = gpxpy.parse(io.BytesIO(gpx_file_or_bytes))
-        else:
-            self.gpx = gpxpy.parse(gpx_file_or_bytes)
-        
-        self.track_points = self._extract_points()
+        self._build_arrays(parse_gpx_arrays(gpx_file_or_bytes))
     
     def analyze(self):
         """Retorna diccionario con todas las métricas."""
-        if not self.track_points or len(self.track_points) < 2:
+        if len(self.lat) < 2:
             return self._empty_metrics()
         
+        if analyze_track is not None:
+            return self._analyze_compiled()
+        
         return {
             "duracion_minutos": self._calcular_duracion(),
             "distancia_km": self._calcular_distancia(),
             "elevacion": self._analizar_elevacion(),
             "inclinacion": self._analizar_inclinacion(),
             "velocidad": self._analizar_velocidad(),
-            "puntos_totales": len(self.track_points),
+            "puntos_totales": len(self.lat),
+        }
+    
+    def _analyze_compiled(self):
+        """Mismas métricas que analyze(), en una sola pasada con el kernel de Numba."""
+        (distancia_km, ele_min, ele_max, ganancia, perdida,
+         suma_pos, n_pos, suma_neg, n_neg, max_pct,
+         suma_vel, n_vel, max_vel) = analyze_track(self._seg_km, self._seg_km_local,
+                                                         self.ele, self.t_sec)
+        
+        if np.isnan(ele_min):
+            elevacion = {"minima_m": None, "maxima_m": None, "ganancia_m": None, "perdida_m": None}
+        else:
+            elevacion = {
+                "minima_m": round(ele_min, 1),
+                "maxima_m": round(ele_max, 1),
+                "ganancia_m": round(ganancia, 1),
+                "perdida_m": round(perdida, 1),
+            }
+        
+        return {
+            "duracion_minutos": self._calcular_duracion(),
+            "distancia_km": round(distancia_km, 3),
+            "elevacion": elevacion,
+            "inclinacion": {
+                "promedio_positiva_pct": round(suma_pos / n_pos, 2) if n_pos else None,
+                "promedio_negativa_pct": round(suma_neg / n_neg, 2) if n_neg else None,
+                "maxima_pct": round(max_pct, 2),
+            },
+            "velocidad": {
+                "promedio_kmh": round(suma_vel / n_vel, 1) if n_vel else None,
+                "maxima_kmh": round(max_vel, 1) if n_vel else None,
+            },
+            "puntos_totales": len(self.lat),
         }
     
-    def _extract_points(self):
-        """Extrae lista de puntos con (lon, lat, ele, time)."""
-        points = []
-        for track in self.gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    if point.longitude and point.latitude:
-                        points.append({
-                            'lon': point.longitude,
-                            'lat': point.latitude,
-                            'ele': point.elevation if point.elevation else None,
-                            'time': point.time,
-                        })
-        return points
+    @cached_property
+    def points(self):
+        """Lista de puntos con (lon, lat, ele, time), construida solo si se pide; los cálculos usan los arreglos."""
+        return [
+            {'lon': lon, 'lat': lat, 'ele': None if np.isnan(ele) else ele, 'time': time}
+            for lon, lat, ele, time in zip(self.lon.tolist(), self.lat.tolist(), self.ele.tolist(), self.time.tolist())
+        ]
+    
+    @property
+    def track_points(self):
+        """Alias de points para código existente."""
+        return self.points
+    
+    def _build_arrays(self, gpx):
+        """
+        Arreglos paralelos de los puntos del track (lat, lon, ele con NaN si falta, tiempo)
+        y distancias por segmento, calculados una sola vez.
+        """
+        if gpx['kind'] == 'trkpt':
+            # Omitir puntos sin coordenadas; elevación 0 se considera faltante
+            keep = (gpx['lon'] != 0) & (gpx['lat'] != 0) & ~np.isnan(gpx['lon']) & ~np.isnan(gpx['lat'])
+        else:
+            keep = np.zeros(len(gpx['lat']), dtype=bool)
+        self.lat = gpx['lat'][keep]
+        self.lon = gpx['lon'][keep]
+        self.ele = np.where(gpx['ele'][keep] == 0, np.nan, gpx['ele'][keep])
+        self.time = gpx['time'][keep]
+        n = len(self.lat)
+        
+        # Segundos desde el primer punto con tiempo (NaN si no hay tiempo)
+        has_time = ~np.isnat(self.time)
+        if has_time.any():
+            self.t_sec = (self.time - self.time[has_time][0]) / np.timedelta64(1, 's')
+        else:
+            self.t_sec = np.full(n, np.nan)
+        
+        # Radianes y coseno de la latitud por punto, una sola vez por track
+        self._lat_rad = np.radians(self.lat)
+        self._lon_rad = np.radians(self.lon)
+        self._cos_lat = np.cos(self._lat_rad)
+        
+        # Distancia de cada segmento (km): Haversine para el total de la ruta,
+        # equirectangular para los filtros por segmento de pendiente y velocidad
+        self._seg_km = self._haversine_segments()
+        self._seg_km_local = self._equirect_segments()
+    
+    def _segment_slopes(self):
+        """
+        Pendiente (%) por segmento y máscara de segmentos válidos:
+        ambos puntos con elevación, al menos 5 m de largo y |pendiente| <= 25%.
+        """
+        dist_m = self._seg_km_local * 1000
+        delta_ele = np.diff(self.ele)
+        valid = ~np.isnan(delta_ele) & (dist_m >= 5)  # Filtrar segmentos muy cortos (< 5m) para evitar errores GPS
+        pct = np.zeros_like(dist_m)
+        np.divide(delta_ele, dist_m, out=pct, where=valid)
+        pct *= 100
+        valid &= np.abs(pct) <= 25  # Límite máximo razonable ~25%
+        return pct, valid
     
     def _calcular_duracion(self):
         """Calcula duración en minutos."""
-        times = [p['time'] for p in self.track_points if p['time']]
-        if len(times) >= 2:
-            delta = times[-1] - times[0]
-            return int(delta.total_seconds() / 60)
+        t_sec = self.t_sec[~np.isnan(self.t_sec)]
+        if len(t_sec) >= 2:
+            return int((t_sec[-1] - t_sec[0]) / 60)
         return None
     
     def _calcular_distancia(self):
         """Calcula distancia total en km usando fórmula de Haversine."""
-        total_km = 0
-        for i in range(len(self.track_points) - 1):
-            p1 = self.track_points[i]
-            p2 = self.track_points[i + 1]
-            total_km += self._haversine(p1['lat'], p1['lon'], p2['lat'], p2['lon'])
-        return round(total_km, 3)
+        return round(float(self._seg_km.sum()), 3)
     
-    def _haversine(self, lat1, lon1, lat2, lon2):
-        """Calcula distancia en km entre dos coordenadas."""
-        R = 6371  # Radio de la Tierra en km
-        dlat = radians(lat2 - lat1)
-        dlon = radians(lon2 - lon1)
-        a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-        c = 2 * asin(sqrt(a))
-        return R * c
+    def _haversine_segments(self):
+        """Distancia Haversine en km entre puntos consecutivos, con cos(lat) ya calculado por punto."""
+        dlat = np.diff(self._lat_rad)
+        dlon = np.diff(self._lon_rad)
+        a = np.sin(dlat/2)**2 + self._cos_lat[:-1] * self._cos_lat[1:] * np.sin(dlon/2)**2
+        c = 2 * np.arcsin(np.sqrt(a))
+        return R_TIERRA_KM * c
+    
+    def _equirect_segments(self):
+        """
+        Distancia en km entre puntos consecutivos con proyección equirectangular local.
+        Sin funciones trigonométricas (usa el promedio de cos(lat) de ambos puntos);
+        para segmentos de metros el error frente a Haversine es despreciable.
+        """
+        dx = np.diff(self._lon_rad) * (0.5 * (self._cos_lat[:-1] + self._cos_lat[1:]))
+        dy = np.diff(self._lat_rad)
+        return R_TIERRA_KM * np.hypot(dx, dy)
     
     def _analizar_elevacion(self):
         """Analiza métricas de elevación."""
-        elevaciones = [p['ele'] for p in self.track_points if p['ele'] is not None]
-        if not elevaciones:
+        elevaciones = self.ele[~np.isnan(self.ele)]
+        if not len(elevaciones):
             return {"minima_m": None, "maxima_m": None, "ganancia_m": None, "perdida_m": None}
         
         # Calcular ganancia y pérdida acumulada
-        ganancia = 0
-        perdida = 0
-        for i in range(len(elevaciones) - 1):
-            diff = elevaciones[i + 1] - elevaciones[i]
-            if diff > 1:  # Umbral para filtrar ruido GPS
-                ganancia += diff
-            elif diff < -1:
-                perdida += abs(diff)
+        diff = np.diff(elevaciones)
+        ganancia = float(diff[diff > 1].sum())  # Umbral para filtrar ruido GPS
+        perdida = float(-diff[diff < -1].sum())
         
         return {
-            "minima_m": round(min(elevaciones), 1),
-            "maxima_m": round(max(elevaciones), 1),
+            "minima_m": round(float(elevaciones.min()), 1),
+            "maxima_m": round(float(elevaciones.max()), 1),
             "ganancia_m": round(ganancia, 1),
             "perdida_m": round(perdida, 1),
         }
     
     def _analizar_inclinacion(self):
         """Analiza pendientes (%) positivas y negativas."""
-        pendientes_pos = []
-        pendientes_neg = []
-        
-        for i in range(len(self.track_points) - 1):
-            p1 = self.track_points[i]
-            p2 = self.track_points[i + 1]
-            
-            if p1['ele'] is None or p2['ele'] is None:
-                continue
-            
-            # Distancia horizontal en metros
-            dist_m = self._haversine(p1['lat'], p1['lon'], p2['lat'], p2['lon']) * 1000
-            if dist_m < 5:  # Filtrar segmentos muy cortos (< 5m) para evitar errores GPS
-                continue
-            
-            # Cambio de elevación
-            delta_ele = p2['ele'] - p1['ele']
-            pendiente_pct = (delta_ele / dist_m) * 100
-            
-            # Filtrar pendientes anómalas (probablemente errores GPS)
-            if abs(pendiente_pct) > 25:  # Límite máximo razonable ~25%
-                continue
-            
-            if pendiente_pct > 0.5:
-                pendientes_pos.append(pendiente_pct)
-            elif pendiente_pct < -0.5:
-                pendientes_neg.append(pendiente_pct)
+        pct, valid = self._segment_slopes()
+        pendientes = pct[valid]  # Una sola compresión; positivas y negativas salen del arreglo ya filtrado
+        pendientes_pos = pendientes[pendientes > 0.5]
+        pendientes_neg = pendientes[pendientes < -0.5]
         
         return {
-            "promedio_positiva_pct": round(sum(pendientes_pos) / len(pendientes_pos), 2) if pendientes_pos else None,
-            "promedio_negativa_pct": round(sum(pendientes_neg) / len(pendientes_neg), 2) if pendientes_neg else None,
-            "maxima_pct": round(max(pendientes_pos + [abs(x) for x in pendientes_neg], default=0), 2),
+            "promedio_positiva_pct": round(float(pendientes_pos.mean()), 2) if len(pendientes_pos) else None,
+            "promedio_negativa_pct": round(float(pendientes_neg.mean()), 2) if len(pendientes_neg) else None,
+            "maxima_pct": round(max(float(pendientes_pos.max(initial=0)), float(-pendientes_neg.min(initial=0))), 2),
         }
     
     def _analizar_velocidad(self):
         """Analiza velocidades (km/h)."""
-        velocidades = []
+        # Tiempo en horas por segmento (NaN si falta algún tiempo)
+        delta_time = np.diff(self.time) / np.timedelta64(1, 's') / 3600
+        moving = delta_time >= 0.0001  # Evitar divisiones por cero
+        velocidades = np.full_like(delta_time, np.nan)
+        np.divide(self._seg_km_local, delta_time, out=velocidades, where=moving)
         
-        for i in range(len(self.track_points) - 1):
-            p1 = self.track_points[i]
-            p2 = self.track_points[i + 1]
-            
-            if not p1['time'] or not p2['time']:
-                continue
-            
-            # Distancia en km
-            dist_km = self._haversine(p1['lat'], p1['lon'], p2['lat'], p2['lon'])
-            
-            # Tiempo en horas
-            delta_time = (p2['time'] - p1['time']).total_seconds() / 3600
-            if delta_time < 0.0001:  # Evitar divisiones por cero
-                continue
-            
-            velocidad_kmh = dist_km / delta_time
-            
-            # Filtrar velocidades cero o anómalas (paradas en semáforos, pasajeros, etc.)
-            # Solo considerar velocidades reales de movimiento (> 0.5 km/h)
-            if velocidad_kmh > 0.5 and velocidad_kmh < 150:
-                velocidades.append(velocidad_kmh)
+        # Filtrar velocidades cero o anómalas (paradas en semáforos, pasajeros, etc.)
+        # Solo considerar velocidades reales de movimiento (> 0.5 km/h); NaN queda fuera
+        velocidades = velocidades[(velocidades > 0.5) & (velocidades < 150)]
         
-        if not velocidades:
+        if not len(velocidades):
             return {"promedio_kmh": None, "maxima_kmh": None}
         
         return {
-            "promedio_kmh": round(sum(velocidades) / len(velocidades), 1),
-            "maxima_kmh": round(max(velocidades), 1),
+            "promedio_kmh": round(float(velocidades.mean()), 1),
+            "maxima_kmh": round(float(velocidades.max()), 1),
         }
     
     def _empty_metrics(self):
@@ -195,105 +242,78 @@ class GPXExtractor:
         """Retorna una geometría LineString de Shapely con los puntos del GPX."""
         from shapely.geometry import LineString
         
-        if not self.track_points or len(self.track_points) < 2:
+        if len(self.lat) < 2:
             return None
         
-        coords = [(p['lon'], p['lat']) for p in self.track_points]
-        return LineString(coords)
+        return LineString(np.column_stack((self.lon, self.lat)))
     
     def get_high_slope_points(self, threshold_pct=20):
         """
         Detecta puntos con pendientes altas (> threshold_pct).
         Retorna lista de GeoJSON features con pendiente > umbral.
         """
-        high_slopes = []
+        pct, valid = self._segment_slopes()
+        idx = np.flatnonzero(valid & (np.abs(pct) >= threshold_pct))
         
-        for i in range(len(self.track_points) - 1):
-            p1 = self.track_points[i]
-            p2 = self.track_points[i + 1]
-            
-            if p1['ele'] is None or p2['ele'] is None:
-                continue
-            
-            dist_m = self._haversine(p1['lat'], p1['lon'], p2['lat'], p2['lon']) * 1000
-            if dist_m < 5:
-                continue
-            
-            delta_ele = p2['ele'] - p1['ele']
-            pendiente_pct = abs((delta_ele / dist_m) * 100)
-            
-            if pendiente_pct > 25:
-                continue
-            
-            if pendiente_pct >= threshold_pct:
-                tipo = "subida" if delta_ele > 0 else "bajada"
-                high_slopes.append({
-                    'type': 'Feature',
-                    'geometry': {
-                        'type': 'Point',
-                        'coordinates': [p1['lon'], p1['lat']]
-                    },
-                    'properties': {
-                        'pendiente_pct': round(pendiente_pct, 1),
-                        'tipo': tipo,
-                        'elevacion_m': round(p1['ele'], 1)
-                    }
-                })
-        
-        return high_slopes
+        return [
+            {
+                'type': 'Feature',
+                'geometry': {
+                    'type': 'Point',
+                    'coordinates': [lon, lat]
+                },
+                'properties': {
+                    'pendiente_pct': round(abs(pendiente_pct), 1),
+                    'tipo': "subida" if pendiente_pct > 0 else "bajada",
+                    'elevacion_m': round(ele, 1)
+                }
+            }
+            for lon, lat, ele, pendiente_pct in zip(self.lon[idx].tolist(), self.lat[idx].tolist(),
+                                                     self.ele[idx].tolist(), pct[idx].tolist())
+        ]
     
     def get_colored_segments_by_slope(self):
         """
         Genera segmentos de línea coloreados según pendiente.
-        Retorna GeoJSON FeatureCollection con segmentos y propiedades de color.
+        Retorna GeoJSON FeatureCollection con un MultiLineString por categoría de pendiente,
+        cuyas partes son tramos continuos de la misma categoría; 'pendientes_pct' trae,
+        por parte, la pendiente de cada uno de sus segmentos.
         """
-        segments = []
+        pct, valid = self._segment_slopes()
+        pct = np.where(valid, pct, 0.0)  # Segmentos sin pendiente confiable cuentan como planos
+        
+        # Clasificar pendiente: 0 plano, 1 moderado, 2 pronunciado, 3 muy pronunciado
+        clases = np.digitize(np.abs(pct), SLOPE_BINS)
+        pendientes = [round(pendiente_pct, 2) for pendiente_pct in pct.tolist()]
         
-        for i in range(len(self.track_points) - 1):
-            p1 = self.track_points[i]
-            p2 = self.track_points[i + 1]
-            
-            if p1['ele'] is None or p2['ele'] is None:
-                pendiente_pct = 0
-            else:
-                dist_m = self._haversine(p1['lat'], p1['lon'], p2['lat'], p2['lon']) * 1000
-                if dist_m < 5:
-                    pendiente_pct = 0
-                else:
-                    delta_ele = p2['ele'] - p1['ele']
-                    pendiente_pct = (delta_ele / dist_m) * 100
-                    
-                    if abs(pendiente_pct) > 25:
-                        pendiente_pct = 0
-            
-            # Clasificar pendiente y asignar color
-            if abs(pendiente_pct) < 2:
-                color = '#28a745'  # Verde: plano
-                categoria = 'Plano (< 2%)'
-            elif abs(pendiente_pct) < 5:
-                color = '#ffc107'  # Amarillo: moderado
-                categoria = 'Moderado (2-5%)'
-            elif abs(pendiente_pct) < 10:
-                color = '#fd7e14'  # Naranja: pronunciado
-                categoria = 'Pronunciado (5-10%)'
-            else:
-                color = '#dc3545'  # Rojo: muy pronunciado
-                categoria = 'Muy Pronunciado (>10%)'
-            
-            segments.append({
+        # Tramos de segmentos consecutivos con la misma categoría: segmentos [inicio, fin)
+        cortes = np.flatnonzero(np.diff(clases)) + 1
+        inicios = np.concatenate(([0], cortes)).tolist() if len(clases) else []
+        fines = np.concatenate((cortes, [len(clases)])).tolist() if len(clases) else []
+        clase_tramo = clases[inicios].tolist()
+        
+        # Cada tramo es una vista del arreglo (n, 2), serializada por orjson sin listas intermedias
+        coords = np.column_stack((self.lon, self.lat))
+        
+        features = []
+        for clase, (color, categoria) in enumerate(zip(SLOPE_COLORS, SLOPE_CATEGORIES)):
+            tramos = [(inicio, fin) for inicio, fin, c in zip(inicios, fines, clase_tramo) if c == clase]
+            if not tramos:
+                continue
+            features.append({
                 'type': 'Feature',
                 'geometry': {
-                    'type': 'LineString',
-                    'coordinates': [[p1['lon'], p1['lat']], [p2['lon'], p2['lat']]]
+                    'type': 'MultiLineString',
+                    'coordinates': [coords[inicio:fin + 1] for inicio, fin in tramos]
                 },
                 'properties': {
-                    'pendiente_pct': round(pendiente_pct, 2),
                     'color': color,
-                    'categoria': categoria
+                    'categoria': categoria,
+                    'pendientes_pct': [pendientes[inicio:fin] for inicio, fin in tramos]
                 }
             })
         
         return {
             'type': 'FeatureCollection',
-            'features': segments
+            'features': features
         }
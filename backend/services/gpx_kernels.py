@@ -0,0 +1,99 @@
+"""
+Kernel compilado (Numba) que calcula en una sola pasada las métricas de un track GPX.
+Si Numba no está instalado, GPXExtractor usa su versión vectorizada con NumPy.
+"""
+import math
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _analyze_track(seg_km, seg_km_local, ele, t_sec):
+    """
+    Recorre los segmentos una vez y acumula distancia, elevación, pendientes y velocidades.
+    Mismos filtros que GPXExtractor: pendientes de segmentos >= 5 m y |p| <= 25%,
+    velocidades entre 0.5 y 150 km/h con al menos 0.36 s entre puntos.
+
+    Args:
+        seg_km: distancia Haversine de cada segmento (km), n - 1 valores, para el total
+        seg_km_local: distancia equirectangular de cada segmento (km), para pendientes y velocidades
+        ele: elevación por punto (NaN si falta)
+        t_sec: segundos por punto (NaN si falta)
+
+    Returns:
+        tupla (distancia_km, ele_min, ele_max, ganancia, perdida,
+               suma_pos, n_pos, suma_neg, n_neg, max_pct,
+               suma_vel, n_vel, max_vel); ele_min/ele_max son NaN si no hay elevaciones
+    """
+    n = ele.shape[0]
+    total_km = 0.0
+    ele_min = math.nan
+    ele_max = math.nan
+    ganancia = 0.0
+    perdida = 0.0
+    prev_ele = math.nan
+    suma_pos = 0.0
+    n_pos = 0
+    suma_neg = 0.0
+    n_neg = 0
+    max_pct = 0.0
+    suma_vel = 0.0
+    n_vel = 0
+    max_vel = 0.0
+
+    for i in range(n):
+        e = ele[i]
+        if not math.isnan(e):
+            # Ganancia/pérdida entre elevaciones consecutivas disponibles (umbral de ruido 1 m)
+            if math.isnan(prev_ele):
+                ele_min = e
+                ele_max = e
+            else:
+                diff = e - prev_ele
+                if diff > 1:
+                    ganancia += diff
+                elif diff < -1:
+                    perdida -= diff
+                ele_min = min(ele_min, e)
+                ele_max = max(ele_max, e)
+            prev_ele = e
+
+        if i == n - 1:
+            break
+
+        total_km += seg_km[i]
+        dist_km = seg_km_local[i]
+
+        # Pendiente del segmento
+        e2 = ele[i + 1]
+        dist_m = dist_km * 1000
+        if not math.isnan(e) and not math.isnan(e2) and dist_m >= 5:
+            pct = ((e2 - e) / dist_m) * 100
+            if abs(pct) <= 25:
+                if pct > 0.5:
+                    suma_pos += pct
+                    n_pos += 1
+                    max_pct = max(max_pct, pct)
+                elif pct < -0.5:
+                    suma_neg += pct
+                    n_neg += 1
+                    max_pct = max(max_pct, -pct)
+
+        # Velocidad del segmento
+        dt_h = (t_sec[i + 1] - t_sec[i]) / 3600
+        if dt_h >= 0.0001:  # Falso también si falta algún tiempo (NaN)
+            vel = dist_km / dt_h
+            if vel > 0.5 and vel < 150:
+                suma_vel += vel
+                n_vel += 1
+                max_vel = max(max_vel, vel)
+
+    return (total_km, ele_min, ele_max, ganancia, perdida,
+            suma_pos, n_pos, suma_neg, n_neg, max_pct,
+            suma_vel, n_vel, max_vel)
+
+
+# Sin fastmath: supone que no hay NaN y eliminaría los chequeos de datos faltantes
+analyze_track = njit(cache=True, boundscheck=False)(_analyze_track) if njit is not None else None
@@ -0,0 +1,230 @@
+"""
+Lee puntos de un GPX directamente a arreglos NumPy con lxml.iterparse.
+Si lxml no está instalado se usa gpxpy.
+"""
+import io
+import os
+import math
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+from datetime import timezone
+from xml.etree import ElementTree
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+# Tipos de punto en orden de preferencia: track, waypoints, ruta
+POINT_TAGS = ('trkpt', 'wpt', 'rtept')
+
+
+def parse_iso_times(raw_times):
+    """ISO timestamps -> UTC datetime64[us]; numpy's C parser for UTC stamps, pandas for other offsets"""
+    utc_times = []
+    for t in raw_times:
+        if t is None:
+            utc_times.append(None)
+        elif t.endswith('+00:00'):
+            utc_times.append(t[:-6])
+        elif t.endswith('Z'):
+            utc_times.append(t[:-1])
+        else:
+            break
+    else:
+        try:
+            return np.array(utc_times, dtype='datetime64[us]')
+        except ValueError:
+            pass
+    return pd.to_datetime(raw_times, utc=True, errors='coerce', format='ISO8601').values.astype('datetime64[us]')
+
+
+def _to_datetime64(time):
+    """datetime (con o sin zona) -> valor para un arreglo datetime64[us] en UTC"""
+    if time is None:
+        return None
+    if time.tzinfo is not None:
+        return time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+def _float_or_nan(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _read_lxml(source):
+    """{tag: (lat, lon, ele, time)} con listas por tipo de punto, en orden del documento"""
+    columns = {tag: ([], [], [], []) for tag in POINT_TAGS}
+
+    context = etree.iterparse(source, events=('end',), tag=[f'{{*}}{tag}' for tag in POINT_TAGS],
+                              resolve_entities=False, no_network=True)
+    try:
+        for _, elem in context:
+            lat, lon, ele, time = columns[etree.QName(elem).localname]
+            lat.append(float(elem.get('lat')))
+            lon.append(float(elem.get('lon')))
+            ele.append(_float_or_nan(elem.findtext('{*}ele')))
+            time_text = elem.findtext('{*}time')
+            time.append(time_text.strip() if time_text else None)
+
+            # Liberar el punto ya leído y sus hermanos anteriores
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f'Error parsing XML: {e.msg}')
+
+    return {tag: (lat, lon, ele, parse_iso_times(time)) for tag, (lat, lon, ele, time) in columns.items()}
+
+
+def _read_gpxpy(source):
+    """Mismo resultado que _read_lxml usando gpxpy"""
+    import gpxpy
+
+    if isinstance(source, io.IOBase):
+        gpx = gpxpy.parse(source)
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            gpx = gpxpy.parse(f)
+
+    points = {
+        'trkpt': [p for track in gpx.tracks for segment in track.segments for p in segment.points],
+        'wpt': list(gpx.waypoints),
+        'rtept': [p for route in gpx.routes for p in route.points],
+    }
+    return {
+        tag: (
+            [p.latitude for p in pts],
+            [p.longitude for p in pts],
+            [np.nan if p.elevation is None else p.elevation for p in pts],
+            np.array([_to_datetime64(p.time) for p in pts], dtype='datetime64[us]'),
+        )
+        for tag, pts in points.items()
+    }
+
+
+def parse_gpx_arrays(source):
+    """
+    Lee los puntos de un GPX: los del track, o si no hay, los waypoints, o si no hay, los de la ruta.
+
+    Args:
+        source: ruta al archivo GPX o bytes
+
+    Returns:
+        dict con:
+            - lat, lon: float64
+            - ele: float64 (NaN si falta)
+            - time: datetime64[us] en UTC (NaT si falta)
+            - kind: 'trkpt', 'wpt', 'rtept' o None si el GPX no tiene puntos
+            - bounds: [min_lon, min_lat, max_lon, max_lat] o None
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    columns = _read_lxml(source) if etree is not None else _read_gpxpy(source)
+
+    kind = next((tag for tag in POINT_TAGS if columns[tag][0]), None)
+    lat, lon, ele, time = columns[kind or 'trkpt']
+    # float64 a propósito: en float32 la longitud (~-98°) queda a ~0.8 m, del orden de los
+    # segmentos de 5 m que filtran pendientes y velocidades, y cambia sus máximos
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    return {
+        'lat': lat,
+        'lon': lon,
+        'ele': np.asarray(ele, dtype=np.float64),
+        'time': np.asarray(time, dtype='datetime64[us]'),
+        'kind': kind,
+        'bounds': [float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())] if kind else None,
+    }
+
+
+def scan_gpx_metadata(source):
+    """
+    Número de puntos y extensión de un GPX en una sola pasada, sin guardar los puntos.
+    Mismo criterio que parse_gpx_arrays: track, o si no hay, waypoints, o si no hay, ruta.
+
+    Args:
+        source: ruta al archivo GPX o bytes
+
+    Returns:
+        (kind, points_count, bounds); kind y bounds son None si el GPX no tiene puntos
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    # Por tipo de punto: [n, min_lon, min_lat, max_lon, max_lat]
+    stats = {tag: [0, math.inf, math.inf, -math.inf, -math.inf] for tag in POINT_TAGS}
+
+    if etree is not None:
+        context = etree.iterparse(source, events=('end',), tag=[f'{{*}}{tag}' for tag in POINT_TAGS],
+                                  resolve_entities=False, no_network=True)
+        syntax_error = etree.XMLSyntaxError
+    else:
+        context = ElementTree.iterparse(source, events=('end',))
+        syntax_error = ElementTree.ParseError
+    try:
+        for _, elem in context:
+            s = stats.get(elem.tag.rpartition('}')[2])
+            if s is None:
+                continue
+            lat = float(elem.get('lat'))
+            lon = float(elem.get('lon'))
+            s[0] += 1
+            s[1] = min(s[1], lon)
+            s[2] = min(s[2], lat)
+            s[3] = max(s[3], lon)
+            s[4] = max(s[4], lat)
+
+            # Liberar el punto ya leído (y con lxml también sus hermanos anteriores)
+            elem.clear()
+            if etree is not None:
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+    except syntax_error as e:
+        raise ValueError(f'Error parsing XML: {e.msg}')
+
+    kind = next((tag for tag in POINT_TAGS if stats[tag][0]), None)
+    if kind is None:
+        return None, 0, None
+    n, *bounds = stats[kind]
+    return kind, n, bounds
+
+
+def load_gpx_arrays(gpx_path):
+    """parse_gpx_arrays de un archivo en disco, guardado en un sidecar .npz junto al GPX"""
+    npz_path = os.path.splitext(gpx_path)[0] + '.npz'
+    if os.path.exists(npz_path) and os.stat(npz_path).st_mtime_ns >= os.stat(gpx_path).st_mtime_ns:
+        try:
+            with np.load(npz_path) as data:
+                return {
+                    'lat': data['lat'],
+                    'lon': data['lon'],
+                    'ele': data['ele'],
+                    'time': data['time'],
+                    'kind': str(data['kind']) or None,
+                    'bounds': data['bounds'].tolist() or None,
+                }
+        except (OSError, ValueError, zipfile.BadZipFile, KeyError):
+            pass  # Sidecar dañado: se vuelve a leer el GPX y se reescribe
+
+    gpx = parse_gpx_arrays(gpx_path)
+    # Nombre temporal único por llamada: varios hilos pueden escribir el mismo sidecar a la vez
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(npz_path) or '.', suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, lat=gpx['lat'], lon=gpx['lon'], ele=gpx['ele'], time=gpx['time'],
+                     kind=np.array(gpx['kind'] or ''), bounds=np.array(gpx['bounds'] or [], dtype=np.float64))
+        os.replace(tmp_path, npz_path)
+    except OSError:
+        # Sin sidecar, se vuelve a leer el GPX la próxima vez
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return gpx
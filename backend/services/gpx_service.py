@@ -1,14 +1,66 @@
 import os
-import gpxpy
 import json
 import uuid
 import zipfile
-import tempfile
-import shutil
-import csv
+import posixpath
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from werkzeug.utils import secure_filename
 
+from services import route_cache
+from services.gpx_parser import scan_gpx_metadata
+
+NO_POINTS_ERROR = 'GPX file contains no track points, waypoints, or routes'
+
+def parse_gpx_entry(data):
+    """Worker: (info, error) with points count and bounds of in-memory GPX content"""
+    try:
+        kind, points_count, bounds = scan_gpx_metadata(data)
+        if kind is None:
+            raise ValueError(NO_POINTS_ERROR)
+    except Exception as e:
+        return None, str(e)
+    return {'points_count': points_count, 'bounds': bounds}, None
+
+
+def _scan_zip_entries(z, names, max_workers=None):
+    """
+    (name, data, (info, error)) for each GPX entry of an open ZIP, in archive order.
+    Entries are scanned in parallel across CPU cores; only a few are held in memory at a time.
+    """
+    if len(names) <= 1:
+        for name in names:
+            data = z.read(name)
+            yield name, data, parse_gpx_entry(data)
+        return
+    
+    max_workers = min(max_workers or os.cpu_count() or 1, len(names))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for name in names:
+            data = z.read(name)
+            pending.append((name, data, executor.submit(parse_gpx_entry, data)))
+            # Two entries per worker keep the pool busy without reading the whole archive
+            if len(pending) >= 2 * max_workers:
+                name, data, future = pending.popleft()
+                yield name, data, future.result()
+        while pending:
+            name, data, future = pending.popleft()
+            yield name, data, future.result()
+
+
+def _coalesce_columns(df, names):
+    """First non-empty value per row among the given columns (missing columns are skipped)"""
+    values = pd.Series('', index=df.index, dtype=object)
+    for name in reversed(names):
+        if name in df.columns:
+            values = df[name].where(df[name] != '', values)
+    return values
+
+
 class GPXService:
     def __init__(self, upload_folder, data_folder):
         self.upload_folder = upload_folder
@@ -28,9 +80,11 @@ class GPXService:
         gpx_path = os.path.join(self.gpx_folder, f'{route_id}.gpx')
         file.save(gpx_path)
         
-        # Parse GPX to get basic info
+        # Scan GPX for point count and bounds, points are not kept
         try:
-            gpx_info = self._parse_gpx(gpx_path)
+            kind, points_count, bounds = scan_gpx_metadata(gpx_path)
+            if kind is None:
+                raise ValueError(NO_POINTS_ERROR)
         except Exception as e:
             os.remove(gpx_path)
             return {'success': False, 'error': f'Error parsing GPX: {str(e)}'}
@@ -44,15 +98,14 @@ class GPXService:
             'clave_mnemotecnica': metadata.get('clave_mnemotecnica', ''),
             'uploaded_at': datetime.now().isoformat(),
             'analyzed': False,
-            'points_count': gpx_info['points_count'],
-            'bounds': gpx_info['bounds']
+            'points_count': points_count,
+            'bounds': bounds
         }
         
         return {'success': True, 'route': route}
     
-    def save_gpx_batch(self, zip_file, csv_file=None, default_metadata=None):
-        """Save multiple GPX files from a ZIP"""
-        temp_dir = tempfile.mkdtemp()
+    def save_gpx_batch(self, zip_file, csv_file=None, default_metadata=None, max_workers=None):
+        """Save multiple GPX files from a ZIP (uploaded file or path on disk)"""
         routes = []
         errors = []
         
@@ -60,56 +113,48 @@ class GPXService:
             default_metadata = {}
         
         try:
-            # Extract ZIP
-            zip_path = os.path.join(temp_dir, 'upload.zip')
-            zip_file.save(zip_path)
-            
-            with zipfile.ZipFile(zip_path, 'r') as z:
-                z.extractall(temp_dir)
-            
             # Parse CSV metadata if provided
             metadata_map = {}
             if csv_file:
-                csv_path = os.path.join(temp_dir, 'metadata.csv')
-                csv_file.save(csv_path)
-                metadata_map = self._parse_metadata_csv(csv_path)
+                metadata_map = self._parse_metadata_csv(csv_file.stream)
             
-            # Find and process GPX files
-            for root, dirs, files in os.walk(temp_dir):
-                for filename in files:
-                    if filename.lower().endswith('.gpx'):
-                        filepath = os.path.join(root, filename)
-                        
-                        # Get metadata for this file
-                        base_name = filename.replace('.gpx', '').replace('.GPX', '')
-                        # Merge: CSV metadata overrides default metadata
-                        metadata = {**default_metadata, **metadata_map.get(base_name, {})}
-                        
-                        route_id = str(uuid.uuid4())[:8]
-                        
-                        # Copy GPX to data folder
-                        dest_path = os.path.join(self.gpx_folder, f'{route_id}.gpx')
-                        shutil.copy(filepath, dest_path)
-                        
-                        try:
-                            gpx_info = self._parse_gpx(dest_path)
-                            
-                            route = {
-                                'id': route_id,
-                                'filename': filename,
-                                'nombre': metadata.get('nombre') or base_name,
-                                'municipio': metadata.get('municipio', ''),
-                                'modalidad': metadata.get('modalidad', ''),
-                                'clave_mnemotecnica': base_name,  # Auto-assign filename as clave
-                                'uploaded_at': datetime.now().isoformat(),
-                                'analyzed': False,
-                                'points_count': gpx_info['points_count'],
-                                'bounds': gpx_info['bounds']
-                            }
-                            routes.append(route)
-                        except Exception as e:
-                            errors.append({'filename': filename, 'error': str(e)})
-                            os.remove(dest_path)
+            # Read GPX entries straight from the archive, nothing is extracted to disk
+            zip_source = zip_file if isinstance(zip_file, str) else zip_file.stream
+            with zipfile.ZipFile(zip_source, 'r') as z:
+                gpx_names = [n for n in z.namelist() if n.lower().endswith('.gpx')]
+                
+                for name, data, (gpx_info, error) in _scan_zip_entries(z, gpx_names, max_workers):
+                    filename = posixpath.basename(name)
+                    
+                    if error is not None:
+                        errors.append({'filename': filename, 'error': error})
+                        continue
+                    
+                    # Get metadata for this file
+                    base_name = filename.replace('.gpx', '').replace('.GPX', '')
+                    # Merge: CSV metadata overrides default metadata
+                    metadata = {**default_metadata, **metadata_map.get(base_name, {})}
+                    
+                    route_id = str(uuid.uuid4())[:8]
+                    
+                    # Only valid GPX files reach the data folder
+                    dest_path = os.path.join(self.gpx_folder, f'{route_id}.gpx')
+                    with open(dest_path, 'wb') as f:
+                        f.write(data)
+                    
+                    route = {
+                        'id': route_id,
+                        'filename': filename,
+                        'nombre': metadata.get('nombre') or base_name,
+                        'municipio': metadata.get('municipio', ''),
+                        'modalidad': metadata.get('modalidad', ''),
+                        'clave_mnemotecnica': base_name,  # Auto-assign filename as clave
+                        'uploaded_at': datetime.now().isoformat(),
+                        'analyzed': False,
+                        'points_count': gpx_info['points_count'],
+                        'bounds': gpx_info['bounds']
+                    }
+                    routes.append(route)
             
             return {
                 'success': True,
@@ -120,84 +165,34 @@ class GPXService:
             
         except Exception as e:
             return {'success': False, 'error': str(e), 'routes': []}
-        finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
     
-    def _parse_metadata_csv(self, csv_path):
-        """Parse CSV file with route metadata"""
+    def _parse_metadata_csv(self, csv_stream):
+        """Parse CSV file (binary stream) with route metadata"""
         metadata_map = {}
         
         try:
-            with open(csv_path, 'r', encoding='utf-8-sig') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    # Try different column names for filename
-                    filename = row.get('archivo') or row.get('filename') or row.get('nombre_archivo', '')
-                    filename = filename.replace('.gpx', '').replace('.GPX', '')
-                    
-                    if filename:
-                        metadata_map[filename] = {
-                            'nombre': row.get('nombre') or row.get('name', ''),
-                            'municipio': row.get('municipio') or row.get('municipality', ''),
-                            'modalidad': row.get('modalidad') or row.get('modality', ''),
-                            'clave_mnemotecnica': row.get('clave_mnemotecnica') or row.get('clave', '')
-                        }
+            # All values as text, empty cells and short rows as ''
+            df = pd.read_csv(csv_stream, dtype=str, encoding='utf-8-sig', keep_default_na=False).fillna('')
+            
+            # Try different column names for each field
+            metadata = pd.DataFrame({
+                'nombre': _coalesce_columns(df, ('nombre', 'name')),
+                'municipio': _coalesce_columns(df, ('municipio', 'municipality')),
+                'modalidad': _coalesce_columns(df, ('modalidad', 'modality')),
+                'clave_mnemotecnica': _coalesce_columns(df, ('clave_mnemotecnica', 'clave'))
+            })
+            filenames = _coalesce_columns(df, ('archivo', 'filename', 'nombre_archivo'))
+            metadata.index = filenames.str.replace('.gpx', '', regex=False).str.replace('.GPX', '', regex=False)
+            
+            # Rows without filename are skipped, later rows win for repeated files
+            metadata = metadata[metadata.index != '']
+            metadata = metadata[~metadata.index.duplicated(keep='last')]
+            metadata_map = metadata.to_dict(orient='index')
         except Exception as e:
             print(f'Error parsing CSV: {e}')
         
         return metadata_map
     
-    def _parse_gpx(self, gpx_path):
-        """Parse GPX file and extract basic info"""
-        with open(gpx_path, 'r', encoding='utf-8') as f:
-            gpx = gpxpy.parse(f)
-        
-        points = []
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    points.append({
-                        'lat': point.latitude,
-                        'lon': point.longitude,
-                        'ele': point.elevation,
-                        'time': point.time.isoformat() if point.time else None
-                    })
-        
-        # Also check waypoints if no tracks
-        if not points:
-            for waypoint in gpx.waypoints:
-                points.append({
-                    'lat': waypoint.latitude,
-                    'lon': waypoint.longitude,
-                    'ele': waypoint.elevation,
-                    'time': waypoint.time.isoformat() if waypoint.time else None
-                })
-        
-        # Also check routes
-        if not points:
-            for route in gpx.routes:
-                for point in route.points:
-                    points.append({
-                        'lat': point.latitude,
-                        'lon': point.longitude,
-                        'ele': point.elevation,
-                        'time': point.time.isoformat() if point.time else None
-                    })
-        
-        if not points:
-            raise ValueError('GPX file contains no track points, waypoints, or routes')
-        
-        # Calculate bounds
-        lats = [p['lat'] for p in points]
-        lons = [p['lon'] for p in points]
-        bounds = [min(lons), min(lats), max(lons), max(lats)]
-        
-        return {
-            'points': points,
-            'points_count': len(points),
-            'bounds': bounds
-        }
-    
     def get_gpx_geojson(self, route_id):
         """Get GPX as GeoJSON LineString"""
         gpx_path = os.path.join(self.gpx_folder, f'{route_id}.gpx')
@@ -205,11 +200,12 @@ class GPXService:
         if not os.path.exists(gpx_path):
             raise FileNotFoundError(f'GPX file not found: {route_id}')
         
-        gpx_info = self._parse_gpx(gpx_path)
-        points = gpx_info['points']
+        gpx = route_cache.get_arrays(gpx_path)
+        if gpx['kind'] is None:
+            raise ValueError(NO_POINTS_ERROR)
         
-        # Create GeoJSON
-        coordinates = [[p['lon'], p['lat']] for p in points]
+        # Create GeoJSON, coordinates stay an (N, 2) array for orjson's numpy serializer
+        coordinates = np.column_stack((gpx['lon'], gpx['lat']))
         
         geojson = {
             'type': 'FeatureCollection',
@@ -217,7 +213,7 @@ class GPXService:
                 'type': 'Feature',
                 'properties': {
                     'route_id': route_id,
-                    'points_count': len(points)
+                    'points_count': len(coordinates)
                 },
                 'geometry': {
                     'type': 'LineString',
@@ -235,10 +231,33 @@ class GPXService:
         if not os.path.exists(gpx_path):
             raise FileNotFoundError(f'GPX file not found: {route_id}')
         
-        return self._parse_gpx(gpx_path)
+        # Track points, or waypoints if no tracks, or route points if neither
+        gpx = route_cache.get_arrays(gpx_path)
+        if gpx['kind'] is None:
+            raise ValueError(NO_POINTS_ERROR)
+        
+        points = [
+            {
+                'lat': lat,
+                'lon': lon,
+                'ele': None if ele != ele else ele,  # NaN -> None
+                'time': time.isoformat() + '+00:00' if time else None
+            }
+            for lat, lon, ele, time in zip(gpx['lat'].tolist(), gpx['lon'].tolist(),
+                                           gpx['ele'].tolist(), gpx['time'].tolist())
+        ]
+        return {
+            'points': points,
+            'points_count': len(points),
+            'bounds': list(gpx['bounds'])
+        }
     
     def delete_gpx(self, route_id):
-        """Delete a GPX file"""
-        gpx_path = os.path.join(self.gpx_folder, f'{route_id}.gpx')
-        if os.path.exists(gpx_path):
-            os.remove(gpx_path)
+        """Delete a GPX file and its cached geometry and arrays"""
+        for ext in ('.gpx', '.wkb', '.npz'):
+            path = os.path.join(self.gpx_folder, f'{route_id}{ext}')
+            if os.path.exists(path):
+                os.remove(path)
+        
+        # Drop the cached arrays of the deleted file
+        route_cache.invalidate(os.path.join(self.gpx_folder, f'{route_id}.gpx'))
@@ -2,18 +2,35 @@
 Detecta localidades urbanas/rurales atendidas por la ruta
 Usa análisis de red (Dijkstra) para calcular distancia real de caminata
 """
+import numpy as np
 import geopandas as gpd
 from shapely.geometry import Point
 
 
+def _column_values(gdf, column, default):
+    """Valores de una columna como lista de Python (default si no existe), igual que row.get(column, default)"""
+    if column in gdf.columns:
+        return gdf[column].tolist()
+    return [default] * len(gdf)
+
+
+def _locality_columns(gdf):
+    """Tuplas (CVE_MUN, AMBITO, CVEGEO, NOMGEO) por localidad, sin crear una Series por fila"""
+    return zip(_column_values(gdf, 'CVE_MUN', ''), _column_values(gdf, 'AMBITO', ''),
+               _column_values(gdf, 'CVEGEO', ''), _column_values(gdf, 'NOMGEO', 'Sin nombre'))
+
+
 class LocalityDetector:
-    def __init__(self, marco_gdf, municipios_gdf=None, buffer_meters=700, network_analyzer=None):
+    def __init__(self, marco_gdf, municipios_gdf=None, buffer_meters=700, network_analyzer=None,
+                 marco_projected=None, municipios_projected=None):
         """
         Args:
             marco_gdf: GeoDataFrame del Marco Geoestadístico (localidades)
             municipios_gdf: GeoDataFrame de municipios (opcional)
             buffer_meters: Distancia de caminata para considerar atendida (700m por defecto)
             network_analyzer: NetworkAnalyzer para cálculo de distancia por red
+            marco_projected, municipios_projected: copias ya proyectadas a EPSG:32614 (con su
+                índice espacial) para no reproyectar en cada análisis; se calculan si no se dan
         """
         # Asegurar que el marco esté en EPSG:4326
         if marco_gdf.crs != 'EPSG:4326':
@@ -22,12 +39,23 @@ class LocalityDetector:
         self.marco_gdf = marco_gdf
         
         # También mantener versión proyectada para análisis de red
-        self.marco_gdf_projected = marco_gdf.to_crs(epsg=32614)
+        if marco_projected is None:
+            marco_projected = marco_gdf.to_crs(epsg=32614)
+        self.marco_gdf_projected = marco_projected
         
         # Procesar municipios si se proporcionan
         if municipios_gdf is not None and municipios_gdf.crs != 'EPSG:4326':
             municipios_gdf = municipios_gdf.to_crs('EPSG:4326')
         self.municipios_gdf = municipios_gdf
+        if municipios_projected is None and municipios_gdf is not None:
+            municipios_projected = municipios_gdf.to_crs(epsg=32614)
+        self.municipios_gdf_projected = municipios_projected
+        
+        # Nombre por clave de municipio (primera aparición) para no filtrar el GeoDataFrame por localidad
+        self._mun_name_by_cve = {}
+        if municipios_gdf is not None and {'CVE_MUN', 'NOMGEO'} <= set(municipios_gdf.columns):
+            for cve_mun, nombre in zip(municipios_gdf['CVE_MUN'].tolist(), municipios_gdf['NOMGEO'].tolist()):
+                self._mun_name_by_cve.setdefault(cve_mun, nombre)
         
         self.buffer_m = buffer_meters
         # Convertir buffer de metros a grados (aproximación)
@@ -57,34 +85,34 @@ class LocalityDetector:
         # Detectar municipios si están disponibles
         municipios_data = {}
         if self.municipios_gdf is not None:
-            municipios_intersect = self.municipios_gdf[
-                self.municipios_gdf.geometry.intersects(buffered)
-            ]
+            municipios_intersect = self._intersecting(self.municipios_gdf, buffered)
             
-            for idx, row in municipios_intersect.iterrows():
-                cve_mun = str(row.get('CVE_MUN', ''))
+            for cve_mun, nombre, cvegeo in zip(_column_values(municipios_intersect, 'CVE_MUN', ''),
+                                               _column_values(municipios_intersect, 'NOMGEO', 'Sin nombre'),
+                                               _column_values(municipios_intersect, 'CVEGEO', '')):
+                cve_mun = str(cve_mun)
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
-                    'nombre': row.get('NOMGEO', 'Sin nombre'),
-                    'cvegeo': row.get('CVEGEO', ''),
+                    'nombre': nombre,
+                    'cvegeo': cvegeo,
                     'localidades_urbanas': [],
                     'localidades_rurales': []
                 }
         
         # Encontrar localidades que intersectan el buffer
-        intersecting = self.marco_gdf[self.marco_gdf.geometry.intersects(buffered)]
+        intersecting = self._intersecting(self.marco_gdf, buffered)
         
         if intersecting.empty and not municipios_data:
             return self._empty_result()
         
         # Procesar localidades
-        for idx, row in intersecting.iterrows():
-            cve_mun = str(row.get('CVE_MUN', ''))
-            ambito = str(row.get('AMBITO', '')).strip()
+        for cve_mun, ambito, cvegeo, nombre in _locality_columns(intersecting):
+            cve_mun = str(cve_mun)
+            ambito = str(ambito).strip()
             
             loc_data = {
-                'cvegeo': row.get('CVEGEO', ''),
-                'nombre': row.get('NOMGEO', 'Sin nombre'),
+                'cvegeo': cvegeo,
+                'nombre': nombre,
                 'cve_mun': cve_mun,
                 'ambito': ambito
             }
@@ -92,11 +120,7 @@ class LocalityDetector:
             # Si el municipio no está en municipios_data, agregarlo
             if cve_mun and cve_mun not in municipios_data:
                 # Buscar nombre del municipio desde el shapefile de municipios o desde localidades
-                nombre_mun = f'Municipio {cve_mun}'
-                if self.municipios_gdf is not None:
-                    mun_row = self.municipios_gdf[self.municipios_gdf['CVE_MUN'] == cve_mun]
-                    if not mun_row.empty:
-                        nombre_mun = mun_row.iloc[0].get('NOMGEO', nombre_mun)
+                nombre_mun = self._mun_name_by_cve.get(cve_mun, f'Municipio {cve_mun}')
                 
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
@@ -163,49 +187,45 @@ class LocalityDetector:
         municipios_data = {}
         
         # First, detect municipalities that intersect the service area
-        if self.municipios_gdf is not None:
-            mun_projected = self.municipios_gdf.to_crs(epsg=32614)
-            municipios_intersect = mun_projected[
-                mun_projected.geometry.intersects(service_area_polygon)
-            ]
+        if self.municipios_gdf_projected is not None:
+            municipios_intersect = self._intersecting(self.municipios_gdf_projected, service_area_polygon)
             
-            for idx, row in municipios_intersect.iterrows():
-                cve_mun = str(row.get('CVE_MUN', ''))
+            for cve_mun, nombre, cvegeo in zip(_column_values(municipios_intersect, 'CVE_MUN', ''),
+                                               _column_values(municipios_intersect, 'NOMGEO', 'Sin nombre'),
+                                               _column_values(municipios_intersect, 'CVEGEO', '')):
+                cve_mun = str(cve_mun)
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
-                    'nombre': row.get('NOMGEO', 'Sin nombre'),
-                    'cvegeo': row.get('CVEGEO', ''),
+                    'nombre': nombre,
+                    'cvegeo': cvegeo,
                     'localidades_urbanas': [],
                     'localidades_rurales': []
                 }
         
-        # Find localities that intersect the service area
-        localities_intersect = self.marco_gdf_projected[
-            self.marco_gdf_projected.geometry.intersects(service_area_polygon)
-        ]
-        
-        # Filter localities by checking if centroid is actually reachable
-        for idx, row in localities_intersect.iterrows():
-            centroid = row.geometry.centroid
-            is_reachable, dist = self.network_analyzer.is_point_in_service_area(
-                (centroid.x, centroid.y),
-                service_area_nodes,
-                node_distances,
-                max_distance=self.buffer_m
-            )
-            
-            if not is_reachable:
-                continue
-            
-            cve_mun = str(row.get('CVE_MUN', ''))
-            ambito = str(row.get('AMBITO', '')).strip()
-            
-            # Get original row for name (from non-projected version)
-            original_row = self.marco_gdf.loc[idx] if idx in self.marco_gdf.index else row
+        # Find localities that intersect the service area. This is part of the rule, not just a
+        # prefilter: a reachable centroid up to 700 m from its node may belong to a locality that
+        # never touches the 50 m network buffer, so a radius query on centroids would add those.
+        # The STRtree query only visits localities near the polygon anyway.
+        localities_intersect = self._intersecting(self.marco_gdf_projected, service_area_polygon)
+        
+        # Filter localities by checking if centroid is actually reachable (one batched query)
+        centroids = localities_intersect.geometry.centroid
+        reachable, distances = self.network_analyzer.is_point_in_service_area_batch(
+            np.column_stack([centroids.x.values, centroids.y.values]),
+            service_area_nodes,
+            node_distances,
+            max_distance=self.buffer_m
+        )
+        
+        # Attributes are the same in the projected copy, only the geometry differs
+        for (cve_mun, ambito, cvegeo, nombre), dist in zip(_locality_columns(localities_intersect[reachable]),
+                                                           distances[reachable].tolist()):
+            cve_mun = str(cve_mun)
+            ambito = str(ambito).strip()
             
             loc_data = {
-                'cvegeo': original_row.get('CVEGEO', ''),
-                'nombre': original_row.get('NOMGEO', 'Sin nombre'),
+                'cvegeo': cvegeo,
+                'nombre': nombre,
                 'cve_mun': cve_mun,
                 'ambito': ambito,
                 'distancia_red_m': round(dist, 1)
@@ -213,11 +233,7 @@ class LocalityDetector:
             
             # Add municipality if not exists
             if cve_mun and cve_mun not in municipios_data:
-                nombre_mun = f'Municipio {cve_mun}'
-                if self.municipios_gdf is not None:
-                    mun_row = self.municipios_gdf[self.municipios_gdf['CVE_MUN'] == cve_mun]
-                    if not mun_row.empty:
-                        nombre_mun = mun_row.iloc[0].get('NOMGEO', nombre_mun)
+                nombre_mun = self._mun_name_by_cve.get(cve_mun, f'Municipio {cve_mun}')
                 
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
@@ -255,43 +271,45 @@ class LocalityDetector:
             'network_analysis': True
         }
     
+    @staticmethod
+    def _intersecting(gdf, geometry):
+        """Filas de gdf que intersectan geometry, en su orden original, vía el índice espacial"""
+        hits = gdf.sindex.query(geometry, predicate='intersects')
+        return gdf.iloc[np.sort(hits)]
+    
     def _detect_euclidean(self, buffered):
         """Fallback detection using euclidean buffer"""
         municipios_data = {}
         if self.municipios_gdf is not None:
-            municipios_intersect = self.municipios_gdf[
-                self.municipios_gdf.geometry.intersects(buffered)
-            ]
+            municipios_intersect = self._intersecting(self.municipios_gdf, buffered)
             
-            for idx, row in municipios_intersect.iterrows():
-                cve_mun = str(row.get('CVE_MUN', ''))
+            for cve_mun, nombre, cvegeo in zip(_column_values(municipios_intersect, 'CVE_MUN', ''),
+                                               _column_values(municipios_intersect, 'NOMGEO', 'Sin nombre'),
+                                               _column_values(municipios_intersect, 'CVEGEO', '')):
+                cve_mun = str(cve_mun)
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
-                    'nombre': row.get('NOMGEO', 'Sin nombre'),
-                    'cvegeo': row.get('CVEGEO', ''),
+                    'nombre': nombre,
+                    'cvegeo': cvegeo,
                     'localidades_urbanas': [],
                     'localidades_rurales': []
                 }
         
-        intersecting = self.marco_gdf[self.marco_gdf.geometry.intersects(buffered)]
+        intersecting = self._intersecting(self.marco_gdf, buffered)
         
-        for idx, row in intersecting.iterrows():
-            cve_mun = str(row.get('CVE_MUN', ''))
-            ambito = str(row.get('AMBITO', '')).strip()
+        for cve_mun, ambito, cvegeo, nombre in _locality_columns(intersecting):
+            cve_mun = str(cve_mun)
+            ambito = str(ambito).strip()
             
             loc_data = {
-                'cvegeo': row.get('CVEGEO', ''),
-                'nombre': row.get('NOMGEO', 'Sin nombre'),
+                'cvegeo': cvegeo,
+                'nombre': nombre,
                 'cve_mun': cve_mun,
                 'ambito': ambito
             }
             
             if cve_mun and cve_mun not in municipios_data:
-                nombre_mun = f'Municipio {cve_mun}'
-                if self.municipios_gdf is not None:
-                    mun_row = self.municipios_gdf[self.municipios_gdf['CVE_MUN'] == cve_mun]
-                    if not mun_row.empty:
-                        nombre_mun = mun_row.iloc[0].get('NOMGEO', nombre_mun)
+                nombre_mun = self._mun_name_by_cve.get(cve_mun, f'Municipio {cve_mun}')
                 
                 municipios_data[cve_mun] = {
                     'cve_mun': cve_mun,
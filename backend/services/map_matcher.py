@@ -2,18 +2,23 @@
 Alinea el GPX a la Red Nacional de Caminos usando búsqueda espacial
 """
 import geopandas as gpd
-from shapely.geometry import LineString, Point
+import shapely
+from shapely.geometry import LineString
 from shapely.ops import nearest_points
 import numpy as np
+import pandas as pd
+
+from services.network_analyzer import TO_UTM
 
 
 class MapMatcher:
-    def __init__(self, gpx_linestring, rnc_gdf, buffer_tolerance_m=50):
+    def __init__(self, gpx_linestring, rnc_gdf, buffer_tolerance_m=50, rnc_projected=None):
         """
         Args:
             gpx_linestring: LineString del GPX (EPSG:4326)
             rnc_gdf: GeoDataFrame de la Red Nacional de Caminos
             buffer_tolerance_m: Distancia máxima para buscar segmentos viales
+            rnc_projected: el mismo RNC ya en EPSG:32614 (opcional, p. ej. de una caché compartida)
         """
         self.gpx = gpx_linestring
         
@@ -24,8 +29,11 @@ class MapMatcher:
         self.rnc_gdf = rnc_gdf
         self.buffer_m = buffer_tolerance_m
         
-        # Convertir buffer de metros a grados (aproximación en zona centro de México)
-        self.buffer_deg = buffer_tolerance_m / 111000
+        # Copia en metros para el matching, con su spatial index construido desde ya
+        if rnc_projected is None:
+            rnc_projected = rnc_gdf.to_crs(epsg=32614)
+        self.rnc_projected = rnc_projected
+        self.rnc_projected.sindex
     
     def match(self):
         """
@@ -34,57 +42,41 @@ class MapMatcher:
         Returns:
             dict con:
                 - matched_segments: lista de segmentos RNC usados
+                - matched_gdf: GeoDataFrame con los segmentos RNC únicos usados
                 - confidence: 0-100 (%)
                 - distance_avg_m: distancia promedio al camino
                 - unmatched_points: número de puntos sin match
         """
-        # Extraer puntos del GPX
-        gpx_points = [Point(coord) for coord in self.gpx.coords]
+        # Extraer puntos del GPX, proyectados a metros
+        lon, lat = shapely.get_coordinates(self.gpx).T
+        x, y = TO_UTM.transform(lon, lat)
+        gpx_points = shapely.points(x, y)
         total_points = len(gpx_points)
         
-        matched_segments = []
-        distances = []
-        unmatched_count = 0
-        
-        # Crear spatial index para búsquedas rápidas
-        sindex = self.rnc_gdf.sindex
-        
-        for i, point in enumerate(gpx_points):
-            # Buscar segmentos candidatos cercanos
-            buffer_geom = point.buffer(self.buffer_deg)
-            possible_matches_idx = list(sindex.intersection(buffer_geom.bounds))
-            
-            if not possible_matches_idx:
-                unmatched_count += 1
-                continue
-            
-            # De los candidatos, encontrar el más cercano
-            candidates = self.rnc_gdf.iloc[possible_matches_idx]
-            
-            min_dist = float('inf')
-            best_match = None
-            
-            for idx, row in candidates.iterrows():
-                dist = point.distance(row.geometry)
-                if dist < min_dist:
-                    min_dist = dist
-                    best_match = idx
-            
-            # Convertir distancia de grados a metros (aproximado)
-            dist_m = min_dist * 111000
-            
-            if dist_m <= self.buffer_m and best_match is not None:
-                matched_segments.append({
-                    'index': best_match,
-                    'distance_m': dist_m,
-                    'orden': i
-                })
-                distances.append(dist_m)
-            else:
-                unmatched_count += 1
+        # Candidatos de todos los puntos en una sola consulta al spatial index:
+        # segmentos cuyo rectángulo toca el cuadro de lado 2 * buffer alrededor de cada punto
+        b = self.buffer_m
+        boxes = shapely.box(x - b, y - b, x + b, y + b)
+        point_idx, rnc_pos = self.rnc_projected.sindex.query(boxes)
+        dists = shapely.distance(gpx_points[point_idx], self.rnc_projected.geometry.values[rnc_pos])
+        
+        # El más cercano por punto; en empates, el primero que devuelve el índice
+        order = np.lexsort((dists, point_idx))
+        first = order[np.r_[True, point_idx[order][1:] != point_idx[order][:-1]]] if len(order) else order
+        
+        dist_m = dists[first]
+        keep = dist_m <= self.buffer_m
+        
+        matched_segments = [
+            {'index': index, 'distance_m': distance, 'orden': orden}
+            for index, distance, orden in zip(self.rnc_projected.index[rnc_pos[first][keep]].tolist(),
+                                              dist_m[keep].tolist(), point_idx[first][keep].tolist())
+        ]
+        distances = dist_m[keep]
+        unmatched_count = total_points - len(matched_segments)
         
         # Calcular métricas de confianza
-        if distances:
+        if len(distances):
             distance_avg_m = np.mean(distances)
             confidence = max(0, 100 - (distance_avg_m / self.buffer_m * 100))
         else:
@@ -94,8 +86,14 @@ class MapMatcher:
         # Generar geometría alineada
         aligned_linestring = self._build_aligned_geometry(matched_segments)
         
+        # Segmentos únicos (en orden de recorrido) como sub-GeoDataFrame del RNC
+        matched_idx = pd.unique(np.fromiter((s['index'] for s in matched_segments), dtype=np.int64,
+                                            count=len(matched_segments)))
+        matched_gdf = self.rnc_gdf.loc[matched_idx]
+        
         return {
             'matched_segments': matched_segments,
+            'matched_gdf': matched_gdf,
             'aligned_geometry': aligned_linestring,
             'confidence': round(confidence, 1),
             'distance_avg_m': round(distance_avg_m, 1) if distance_avg_m else None,
@@ -112,53 +110,31 @@ class MapMatcher:
         if not matched_segments:
             return self.gpx
         
-        # Obtener puntos del GPX original
-        gpx_points = [Point(coord) for coord in self.gpx.coords]
-        
-        # Para cada punto del GPX, encontrar el punto más cercano en el segmento matcheado
-        aligned_coords = []
-        
-        for seg_info in matched_segments:
-            idx = seg_info['index']
-            orden = seg_info['orden']
-            
-            if orden >= len(gpx_points):
-                continue
-                
-            gpx_point = gpx_points[orden]
-            segment_geom = self.rnc_gdf.loc[idx, 'geometry']
-            
-            # Proyectar el punto GPX sobre el segmento de carretera
-            try:
-                # Encontrar el punto más cercano en el segmento
-                if segment_geom.geom_type == 'LineString':
-                    distance = gpx_point.distance(segment_geom)
-                    closest_point = segment_geom.interpolate(segment_geom.project(gpx_point))
-                    aligned_coords.append(closest_point.coords[0])
-                elif segment_geom.geom_type == 'MultiLineString':
-                    min_dist = float('inf')
-                    best_point = None
-                    for line in segment_geom.geoms:
-                        dist = gpx_point.distance(line)
-                        if dist < min_dist:
-                            min_dist = dist
-                            best_point = line.interpolate(line.project(gpx_point))
-                    if best_point:
-                        aligned_coords.append(best_point.coords[0])
-            except:
-                # Si hay error, usar el punto original
-                aligned_coords.append(gpx_point.coords[0])
-        
-        if len(aligned_coords) < 2:
-            return self.gpx
+        # Punto del GPX de cada segmento matcheado y la geometría (EPSG:4326) de ese segmento
+        gpx_coords = shapely.get_coordinates(self.gpx)
+        orden = np.fromiter((s['orden'] for s in matched_segments), dtype=np.intp, count=len(matched_segments))
+        segment_geoms = self.rnc_gdf.geometry.loc[[s['index'] for s in matched_segments]].values
+        in_range = orden < len(gpx_coords)
+        orden, segment_geoms = orden[in_range], segment_geoms[in_range]
+        
+        # Solo se proyecta sobre líneas; de una MultiLineString se usa la parte más cercana
+        # (la primera en caso de empate)
+        is_line = np.isin(shapely.get_type_id(segment_geoms), (1, 5)) & ~shapely.is_empty(segment_geoms)
+        gpx_points = shapely.points(gpx_coords[orden[is_line]])
+        parts, owner = shapely.get_parts(segment_geoms[is_line], return_index=True)
+        part_dists = shapely.distance(gpx_points[owner], parts)
+        order = np.lexsort((part_dists, owner))
+        closest = parts[order[np.r_[True, owner[order][1:] != owner[order][:-1]]]] if len(order) else parts
+        
+        # Proyectar cada punto GPX sobre su segmento de carretera, todos a la vez
+        snapped = shapely.line_interpolate_point(closest, shapely.line_locate_point(closest, gpx_points))
+        aligned_coords = shapely.get_coordinates(snapped)
         
         # Eliminar duplicados consecutivos
-        unique_coords = [aligned_coords[0]]
-        for coord in aligned_coords[1:]:
-            if coord != unique_coords[-1]:
-                unique_coords.append(coord)
+        if len(aligned_coords):
+            aligned_coords = aligned_coords[np.r_[True, (aligned_coords[1:] != aligned_coords[:-1]).any(axis=1)]]
         
-        if len(unique_coords) < 2:
+        if len(aligned_coords) < 2:
             return self.gpx
         
-        return LineString(unique_coords)
+        return LineString(aligned_coords)
@@ -4,13 +4,35 @@ Calculates true walking distance on the RNC (Red Nacional de Caminos)
 """
 
 import os
+import threading
+from collections import OrderedDict
 import numpy as np
+import shapely
+import pandas as pd
 import geopandas as gpd
 import networkx as nx
+from pyproj import Transformer
 from shapely.geometry import Point, LineString, MultiLineString
 from shapely.ops import unary_union, nearest_points
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from scipy.spatial import cKDTree
 
+from .shapefile_service import IO_ENGINE
+
+
+# Recent service areas and polygons kept per analyzer; each analysis asks for the same
+# 700 m area twice (LocalityDetector and ServiceAreaAnalyzer)
+SERVICE_AREA_CACHE_SIZE = 8
+
+# Routes (EPSG:4326) -> UTM zone 14N (EPSG:32614), created once and shared with MapMatcher
+TO_UTM = Transformer.from_crs(4326, 32614, always_xy=True)
+
+
+def project_to_utm(geometry):
+    """Reproject a WGS84 geometry to EPSG:32614 without building a GeoDataFrame"""
+    return shapely.transform(geometry, lambda coords: np.column_stack(TO_UTM.transform(coords[:, 0], coords[:, 1])))
+
 
 class NetworkAnalyzer:
     def __init__(self, data_folder):
@@ -20,6 +42,12 @@ class NetworkAnalyzer:
         self.node_coords = {}  # node_id -> (x, y)
         self.coord_tree = None  # KDTree for fast nearest node lookup
         self.node_ids = []  # ordered list of node IDs matching tree
+        self.csgraph = None  # sparse adjacency matrix of self.graph for scipy's C Dijkstra
+        self.graph_nodes = None  # node IDs in csgraph row order
+        self.node_index = {}  # node_id -> csgraph row
+        self._service_area_cache = OrderedDict()  # (route WKB, max_distance) -> (nodes, distances)
+        self._polygon_cache = OrderedDict()  # (frozenset of nodes, buffer_distance) -> polygon
+        self._cache_lock = threading.Lock()
         
         self._load_and_build_network()
     
@@ -32,7 +60,7 @@ class NetworkAnalyzer:
             return
         
         print("Loading RNC shapefile...")
-        self.rnc_gdf = gpd.read_file(rnc_path)
+        self.rnc_gdf = gpd.read_file(rnc_path, engine=IO_ENGINE)
         
         # Project to UTM for accurate distance calculations
         if self.rnc_gdf.crs and self.rnc_gdf.crs.is_geographic:
@@ -41,45 +69,63 @@ class NetworkAnalyzer:
         print(f"Building network graph from {len(self.rnc_gdf)} road segments...")
         self.graph = nx.Graph()
         
-        # Build graph from road segments
-        for idx, row in self.rnc_gdf.iterrows():
-            node_start = row['UNION_INI']
-            node_end = row['UNION_FIN']
-            length = row['LONGITUD']  # Already in meters
-            
-            # Get geometry coordinates for node positions
-            geom = row.geometry
-            if geom is None:
-                continue
-                
-            if isinstance(geom, MultiLineString):
-                coords = list(geom.geoms[0].coords)
-            else:
-                coords = list(geom.coords)
-            
-            if len(coords) < 2:
-                continue
-            
-            start_coord = coords[0]
-            end_coord = coords[-1]
-            
-            # Store node coordinates
-            if node_start not in self.node_coords:
-                self.node_coords[node_start] = start_coord
-            if node_end not in self.node_coords:
-                self.node_coords[node_end] = end_coord
-            
-            # Add edge with length as weight
-            self.graph.add_edge(node_start, node_end, weight=length, geometry=geom)
+        # Node positions come from the first part of each segment (its first and last vertex);
+        # segments without geometry or with fewer than 2 vertices are skipped
+        geoms = self.rnc_gdf.geometry.values
+        parts = shapely.get_geometry(geoms, 0)  # first line of a MultiLineString, the line itself otherwise
+        n_coords = shapely.get_num_coordinates(parts)
+        valid = n_coords >= 2
+        coords = shapely.get_coordinates(parts[valid])
+        last = np.cumsum(n_coords[valid]) - 1
+        first = last - n_coords[valid] + 1
+        
+        node_start = self.rnc_gdf['UNION_INI'].values[valid]
+        node_end = self.rnc_gdf['UNION_FIN'].values[valid]
+        lengths = self.rnc_gdf['LONGITUD'].values[valid]  # Already in meters
+        
+        # Store node coordinates: each node keeps the position of the first segment end that names it
+        endpoint_ids = np.column_stack([node_start, node_end]).ravel()
+        endpoint_coords = np.stack([coords[first], coords[last]], axis=1).reshape(-1, 2)
+        codes, node_ids = pd.factorize(endpoint_ids, use_na_sentinel=False)
+        _, first_seen = np.unique(codes, return_index=True)
+        self.node_coords = dict(zip(node_ids.tolist(), map(tuple, endpoint_coords[first_seen].tolist())))
+        
+        # Add edges with length as weight, in one bulk insert
+        self.graph.add_edges_from(
+            (u, v, {'weight': length, 'geometry': geom})
+            for u, v, length, geom in zip(node_start.tolist(), node_end.tolist(), lengths.tolist(), geoms[valid])
+        )
         
         print(f"Graph built: {self.graph.number_of_nodes()} nodes, {self.graph.number_of_edges()} edges")
         
+        # Sparse matrix copy of the graph for shortest paths outside the interpreter
+        self._build_csgraph()
+        
         # Build KDTree for fast nearest node lookup
         self._build_spatial_index()
     
+    def _build_csgraph(self):
+        """Build the CSR adjacency matrix of self.graph (one entry per undirected edge)"""
+        self.graph_nodes = np.array(list(self.graph.nodes), dtype=object)
+        self.node_index = {node: i for i, node in enumerate(self.graph_nodes.tolist())}
+        
+        n_edges = self.graph.number_of_edges()
+        rows = np.empty(n_edges, dtype=np.int64)
+        cols = np.empty(n_edges, dtype=np.int64)
+        weights = np.empty(n_edges, dtype=np.float64)
+        for i, (u, v, weight) in enumerate(self.graph.edges(data='weight')):
+            rows[i] = self.node_index[u]
+            cols[i] = self.node_index[v]
+            weights[i] = weight
+        
+        # Explicit zero-length edges are kept as edges by csgraph
+        n_nodes = len(self.graph_nodes)
+        self.csgraph = csr_matrix((weights, (rows, cols)), shape=(n_nodes, n_nodes))
+    
     def _build_spatial_index(self):
         """Build KDTree for fast nearest node lookup"""
-        self.node_ids = list(self.node_coords.keys())
+        # Same order as the csgraph rows, so node_index also maps a node to its tree index
+        self.node_ids = self.graph_nodes.tolist()
         coords = [self.node_coords[nid] for nid in self.node_ids]
         self.coord_tree = cKDTree(coords)
         print(f"Spatial index built for {len(self.node_ids)} nodes")
@@ -113,8 +159,7 @@ class NetworkAnalyzer:
         
         # Convert route to projected CRS if needed
         if isinstance(route_geometry, (LineString, MultiLineString)):
-            route_gdf = gpd.GeoDataFrame(geometry=[route_geometry], crs='EPSG:4326')
-            route_projected = route_gdf.to_crs(epsg=32614).geometry[0]
+            route_projected = project_to_utm(route_geometry)
         else:
             route_projected = route_geometry
         
@@ -127,15 +172,15 @@ class NetworkAnalyzer:
         total_length = route_line.length
         num_samples = max(int(total_length / sample_distance), 10)
         
-        nodes_found = set()
-        for i in range(num_samples + 1):
-            fraction = i / num_samples
-            point = route_line.interpolate(fraction, normalized=True)
-            node_id, dist = self.find_nearest_node((point.x, point.y))
-            
-            # Only include nodes within reasonable distance (500m) of route
-            if dist < 500:
-                nodes_found.add(node_id)
+        fractions = np.arange(num_samples + 1) / num_samples
+        sample_points = shapely.line_interpolate_point(route_line, fractions, normalized=True)
+        sample_coords = shapely.get_coordinates(sample_points)
+        
+        # One KDTree query for all samples, split across cores
+        dists, idxs = self.coord_tree.query(sample_coords, workers=-1)
+        
+        # Only include nodes within reasonable distance (500m) of route
+        nodes_found = {self.node_ids[idx] for idx, dist in zip(idxs.tolist(), dists.tolist()) if dist < 500}
         
         return list(nodes_found)
     
@@ -150,10 +195,16 @@ class NetworkAnalyzer:
         Returns:
             set of node IDs within the service area
             dict of node_id -> distance from route
+            (memoized per route and distance, callers must not modify them)
         """
         if self.graph is None:
             return set(), {}
         
+        cache_key = (route_geometry.wkb, max_distance)
+        cached = self._cache_get(self._service_area_cache, cache_key)
+        if cached is not None:
+            return cached
+        
         # Find nodes on/near the route
         route_nodes = self.find_nearest_nodes_on_route(route_geometry)
         
@@ -163,34 +214,24 @@ class NetworkAnalyzer:
         
         print(f"Found {len(route_nodes)} nodes on/near route")
         
-        # Use multi-source Dijkstra from all route nodes
-        # This finds shortest path from ANY route node to all other nodes
+        # Multi-source Dijkstra: one search seeded with all route nodes
+        # gives the shortest distance from ANY route node to every other node.
+        # Runs in scipy's compiled csgraph, stopping at max_distance; the bounded search only
+        # touches nodes near the route, so parallel full-graph SSSP (Δ-stepping) does not pay off.
+        # A rasterized distance field is no substitute: a Euclidean transform ignores the street
+        # layout that walking distance is about
+        sources = [self.node_index[node] for node in route_nodes if node in self.node_index]
         all_reachable = {}
-        
-        for source_node in route_nodes:
-            if source_node not in self.graph:
-                continue
-            
-            # Single-source Dijkstra with cutoff
-            try:
-                distances = nx.single_source_dijkstra_path_length(
-                    self.graph, 
-                    source_node, 
-                    cutoff=max_distance,
-                    weight='weight'
-                )
-                
-                # Keep minimum distance to each node
-                for node, dist in distances.items():
-                    if node not in all_reachable or dist < all_reachable[node]:
-                        all_reachable[node] = dist
-            except nx.NetworkXError:
-                continue
+        if sources:
+            distances = dijkstra(self.csgraph, directed=False, indices=sources,
+                                 limit=max_distance, min_only=True)
+            reached = np.flatnonzero(np.isfinite(distances))
+            all_reachable = dict(zip(self.graph_nodes[reached].tolist(), distances[reached].tolist()))
         
         service_area_nodes = set(all_reachable.keys())
         print(f"Service area contains {len(service_area_nodes)} nodes within {max_distance}m")
         
-        return service_area_nodes, all_reachable
+        return self._cache_put(self._service_area_cache, cache_key, (service_area_nodes, all_reachable))
     
     def get_service_area_polygon(self, service_area_nodes, buffer_distance=50):
         """
@@ -206,27 +247,50 @@ class NetworkAnalyzer:
         if not service_area_nodes:
             return None
         
-        # Collect all edges within the service area
-        geometries = []
+        cache_key = (frozenset(service_area_nodes), buffer_distance)
+        cached = self._cache_get(self._polygon_cache, cache_key)
+        if cached is not None:
+            return cached
         
-        for u, v, data in self.graph.edges(data=True):
-            if u in service_area_nodes and v in service_area_nodes:
-                if 'geometry' in data and data['geometry'] is not None:
-                    geometries.append(data['geometry'])
+        # Collect all edges within the service area (only the service-area subgraph is visited)
+        geometries = []
+        edge_nodes = set()
+        for u, v, geometry in self.graph.subgraph(service_area_nodes).edges(data='geometry'):
+            if geometry is not None:
+                geometries.append(geometry)
+                edge_nodes.update((u, v))
         
-        # Also add node points
-        for node_id in service_area_nodes:
-            if node_id in self.node_coords:
-                geometries.append(Point(self.node_coords[node_id]))
+        # Also add node points, except those already at the end of a collected edge
+        lone_coords = [self.node_coords[node_id] for node_id in service_area_nodes
+                       if node_id not in edge_nodes and node_id in self.node_coords]
+        geometries.extend(shapely.points(lone_coords).tolist() if lone_coords else [])
         
         if not geometries:
             return None
         
-        # Merge and buffer
-        merged = unary_union(geometries)
-        buffered = merged.buffer(buffer_distance)
+        # Buffer each piece and merge the polygons: GEOS unions small polygons far faster
+        # than it buffers the whole merged network (same shape up to the arc approximation)
+        buffered = shapely.union_all(shapely.buffer(np.array(geometries, dtype=object), buffer_distance))
+        # Prepared once here, so every caller's intersects against it is a vectorized predicate
+        shapely.prepare(buffered)
         
-        return buffered
+        return self._cache_put(self._polygon_cache, cache_key, buffered)
+    
+    def _cache_get(self, cache, key):
+        """Cached value for key (marked as recently used), or None"""
+        with self._cache_lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+            return value
+    
+    def _cache_put(self, cache, key, value):
+        """Store value under key, evicting the least recently used entry, and return it"""
+        with self._cache_lock:
+            cache[key] = value
+            if len(cache) > SERVICE_AREA_CACHE_SIZE:
+                cache.popitem(last=False)
+        return value
     
     def is_point_in_service_area(self, point, service_area_nodes, node_distances, max_distance=700):
         """
@@ -250,6 +314,36 @@ class NetworkAnalyzer:
             return total_dist <= max_distance, total_dist
         
         return False, float('inf')
+    
+    def is_point_in_service_area_batch(self, points, service_area_nodes, node_distances, max_distance=700):
+        """
+        Vectorized is_point_in_service_area: one KDTree query for all points
+        
+        Args:
+            points: (N, 2) array of projected coordinates
+            service_area_nodes: Set of node IDs in service area
+            node_distances: Dict of node_id -> distance from route
+            max_distance: Maximum walking distance
+        
+        Returns:
+            bool array of reachable points, float array of total distances (inf if unreachable)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.coord_tree is None or len(points) == 0:
+            return np.zeros(len(points), dtype=bool), np.full(len(points), np.inf)
+        
+        # Network distance per tree index, inf outside the service area
+        n_service = len(service_area_nodes)
+        node_network_dists = np.full(len(self.node_ids), np.inf)
+        node_network_dists[np.fromiter(map(self.node_index.__getitem__, service_area_nodes),
+                                       dtype=np.intp, count=n_service)] = np.fromiter(
+            (node_distances.get(node_id, 0) for node_id in service_area_nodes), dtype=np.float64, count=n_service)
+        
+        # The KDTree query dominates; the rest is one gather and add (a Numba kernel saves
+        # ~1 ms per million points, and fastmath would drop the inf markers)
+        dists_to_node, idxs = self.coord_tree.query(points, workers=-1)
+        total_dists = dists_to_node + node_network_dists[idxs]
+        return total_dists <= max_distance, total_dists
 
 
 # Singleton instance for reuse
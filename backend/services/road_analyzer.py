@@ -1,21 +1,95 @@
 """
 Analiza atributos de la Red Nacional de Caminos (superficie, administración, tipo)
 """
-from collections import defaultdict
+import numpy as np
 import pandas as pd
+import shapely
+
+
+# CRS métrico (UTM 14N) para medir longitudes, el mismo que usan los demás servicios
+METRIC_CRS = 'EPSG:32614'
+
+
+def _categorias(segments, column, reemplazo, na_values=('N/A', 'n/a', ''), strip=True):
+    """
+    Categoría (texto) de cada segmento en una columna del RNC.
+    Faltantes y na_values (tras strip) se reasignan a reemplazo.
+    
+    Returns:
+        (Series de categorías, máscara NumPy de los valores N/A)
+    """
+    if column not in segments.columns:
+        return pd.Series(reemplazo, index=segments.index), np.ones(len(segments), dtype=bool)
+    
+    valores = segments[column]
+    texto = valores.map(str)
+    comparado = texto.str.strip() if strip else texto
+    na = valores.isna().to_numpy() | comparado.isin(na_values).to_numpy()
+    return texto.mask(na, reemplazo), na
+
+
+def _codificar(categorias):
+    """(códigos enteros pequeños, categorías) de una Series de categorías"""
+    codigos, unicos = pd.factorize(categorias)
+    return codigos.astype(np.min_scalar_type(max(len(unicos) - 1, 0))), np.asarray(unicos, dtype=object)
+
+
+def _segment_attributes(segments):
+    """
+    Categorías normalizadas y longitud en km (medida en METRIC_CRS) de cada segmento
+    del RNC, como arreglos NumPy alineados por posición.
+    
+    Returns:
+        dict con index (índice de segments), length_km, superficie_na, administracion_na
+        y, para superficie, administracion y tipo_vialidad, (códigos, categorías)
+    """
+    # Superficie - N/A se suma a "Con pavimento", solo "Sin pavimento" es terracería
+    sup, na_sup = _categorias(segments, 'COND_PAV', 'Con pavimento')
+    # Administración (N/A se suma a "Municipal")
+    admin, na_admin = _categorias(segments, 'ADMINISTRA', 'Municipal')
+    # Tipo de vialidad (solo vacíos y faltantes son N/A)
+    tipo, _ = _categorias(segments, 'TIPO_VIAL', 'N/A', na_values=('',), strip=False)
+    
+    geometria = segments.geometry
+    if segments.crs != METRIC_CRS:
+        geometria = geometria.to_crs(METRIC_CRS)
+    
+    return {
+        'index': segments.index,
+        'superficie': _codificar(sup),
+        'administracion': _codificar(admin),
+        'tipo_vialidad': _codificar(tipo),
+        'superficie_na': na_sup,
+        'administracion_na': na_admin,
+        # Longitud real del segmento RNC en km
+        'length_km': shapely.length(geometria.to_numpy()) / 1000,
+    }
+
+
+def _km_por_categoria(codificada, posiciones, lengths_km):
+    """Kilómetros por categoría de los segmentos en posiciones, en orden de primera aparición"""
+    codigos, categorias = codificada
+    codigos = codigos[posiciones]
+    km = np.bincount(codigos, weights=lengths_km, minlength=len(categorias))
+    orden = pd.unique(codigos)
+    return dict(zip(categorias[orden].tolist(), km[orden].tolist()))
 
 
 class RoadAnalyzer:
-    def __init__(self, rnc_gdf):
+    def __init__(self, rnc_gdf, segment_attrs=None):
         """
         Args:
-            rnc_gdf: GeoDataFrame de la Red Nacional de Caminos
+            rnc_gdf: GeoDataFrame de la Red Nacional de Caminos (en METRIC_CRS se evita reproyectar)
+            segment_attrs: resultado de segment_attributes() del mismo RNC (opcional, p. ej. de
+                una caché compartida); sin ella se calcula solo para los segmentos usados
         """
-        # Asegurar que el RNC esté en EPSG:4326
-        if rnc_gdf.crs != 'EPSG:4326':
-            rnc_gdf = rnc_gdf.to_crs('EPSG:4326')
-            
+        # Solo se reproyectan los segmentos usados, y solo si no hay atributos precalculados
         self.rnc_gdf = rnc_gdf
+        self.segment_attrs = segment_attrs
+    
+    def segment_attributes(self):
+        """Atributos normalizados de todo el RNC, para reutilizarlos entre análisis"""
+        return _segment_attributes(self.rnc_gdf)
     
     def analyze(self, matched_segments, gpx_linestring):
         """
@@ -29,66 +103,34 @@ class RoadAnalyzer:
         Returns:
             dict con kilometrajes por categoría basados en distancia RNC
         """
-        # Obtener índices únicos de segmentos usados
-        unique_indices = list(set([s['index'] for s in matched_segments]))
+        # Índices únicos de segmentos usados, en orden de primera aparición
+        unique_indices = pd.unique(np.fromiter((s['index'] for s in matched_segments), dtype=np.int64,
+                                               count=len(matched_segments)))
         
-        if not unique_indices:
+        if not len(unique_indices):
             return self._empty_stats()
         
-        # Contar uso de cada segmento
-        segment_usage = defaultdict(int)
-        for seg in matched_segments:
-            segment_usage[seg['index']] += 1
-        
-        total_points = len(matched_segments)
-        
-        # Contadores
-        superficie = defaultdict(float)
-        administracion = defaultdict(float)
-        tipo_vialidad = defaultdict(float)
-        
-        # Contadores de N/A para tracking
-        na_superficie_km = 0
-        na_administracion_km = 0
+        if self.segment_attrs is not None:
+            attrs = self.segment_attrs
+        else:
+            attrs = _segment_attributes(self.rnc_gdf.loc[unique_indices])
+        posiciones = attrs['index'].get_indexer(unique_indices)
+        if (posiciones < 0).any():
+            raise KeyError(f'Segmentos fuera del RNC: {unique_indices[posiciones < 0].tolist()}')
         
-        # Primero calcular la distancia total RNC (suma de longitudes de segmentos únicos)
-        distancia_rnc_km = 0
-        segment_lengths = {}
+        # La distancia total RNC es la suma de las longitudes de los segmentos únicos
+        lengths_km = attrs['length_km'][posiciones]
+        distancia_rnc_km = float(lengths_km.sum())
         
-        for idx in segment_usage.keys():
-            row = self.rnc_gdf.loc[idx]
-            # Longitud real del segmento RNC en km
-            segment_length_km = row.geometry.length * 111  # Aproximación grados a km
-            segment_lengths[idx] = segment_length_km
-            distancia_rnc_km += segment_length_km
+        # Kilómetros por categoría: un bincount sobre los códigos precalculados
+        superficie = _km_por_categoria(attrs['superficie'], posiciones, lengths_km)
+        administracion = _km_por_categoria(attrs['administracion'], posiciones, lengths_km)
+        tipo_vialidad = _km_por_categoria(attrs['tipo_vialidad'], posiciones, lengths_km)
         
-        # Ahora distribuir proporcionalmente según longitud de cada segmento
-        for idx, count in segment_usage.items():
-            row = self.rnc_gdf.loc[idx]
-            segment_length_km = segment_lengths[idx]
-            
-            # Proporción basada en longitud del segmento respecto al total RNC
-            km_segmento = segment_length_km
-            
-            # Superficie - N/A se suma a "Con pavimento", solo "Sin pavimento" es terracería
-            sup = row.get('COND_PAV', 'N/A')
-            if not sup or pd.isna(sup) or str(sup).strip() in ['N/A', 'n/a', '']:
-                na_superficie_km += km_segmento
-                sup = 'Con pavimento'  # N/A se asigna a Pavimentado
-            superficie[str(sup)] += km_segmento
-            
-            # Administración (N/A se suma a "Municipal")
-            admin = row.get('ADMINISTRA', 'N/A')
-            if not admin or pd.isna(admin) or str(admin).strip() in ['N/A', 'n/a', '']:
-                na_administracion_km += km_segmento
-                admin = 'Municipal'  # Reasignar a Municipal
-            administracion[str(admin)] += km_segmento
-            
-            # Tipo de vialidad
-            tipo = row.get('TIPO_VIAL', 'N/A')
-            if not tipo or pd.isna(tipo):
-                tipo = 'N/A'
-            tipo_vialidad[str(tipo)] += km_segmento
+        na_sup = attrs['superficie_na'][posiciones]
+        na_admin = attrs['administracion_na'][posiciones]
+        na_superficie_km = float(lengths_km[na_sup].sum()) if na_sup.any() else 0
+        na_administracion_km = float(lengths_km[na_admin].sum()) if na_admin.any() else 0
         
         return {
             'distancia_rnc_km': round(distancia_rnc_km, 3),
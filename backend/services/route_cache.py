@@ -0,0 +1,88 @@
+"""
+Shared in-memory cache of per-route files (GPX arrays and analysis results),
+keyed by path and modification time so rewritten files are never served stale.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import orjson
+
+from services.gpx_parser import load_gpx_arrays
+
+ROUTE_CACHE_SIZE = 64
+
+
+class LRUCache:
+    """Thread-safe least-recently-used mapping with a fixed number of entries"""
+
+    def __init__(self, maxsize=ROUTE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, predicate):
+        """Drop every entry whose key matches predicate"""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_arrays_cache = LRUCache()
+_results_cache = LRUCache()
+
+
+def _cached(cache, path, load):
+    key = (path, os.stat(path).st_mtime_ns)
+    value = cache.get(key)
+    if value is None:
+        value = load(path)
+        cache.put(key, value)
+    return value
+
+
+def _load_arrays(gpx_path):
+    gpx = load_gpx_arrays(gpx_path)
+    # Shared between requests, so callers must not modify them in place
+    for name in ('lat', 'lon', 'ele', 'time'):
+        gpx[name].flags.writeable = False
+    return gpx
+
+
+def _load_results(results_path):
+    with open(results_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def get_arrays(gpx_path):
+    """load_gpx_arrays of a GPX file, shared across services (read-only arrays)"""
+    return _cached(_arrays_cache, gpx_path, _load_arrays)
+
+
+def get_results(results_path):
+    """Parsed analysis results JSON, shared across services (do not modify)"""
+    return _cached(_results_cache, results_path, _load_results)
+
+
+def invalidate(path):
+    """Forget every cached version of a file"""
+    _arrays_cache.discard(lambda key: key[0] == path)
+    _results_cache.discard(lambda key: key[0] == path)
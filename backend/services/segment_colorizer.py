@@ -1,7 +1,66 @@
 """
 Genera segmentos GeoJSON coloreados según atributos de la RNC
 """
-import json
+import orjson
+import shapely
+
+
+SURFACE_COLORS = {
+    'Con pavimento': '#28a745',  # Verde
+    'Sin pavimento': '#fd7e14',  # Naranja
+    'N/A': '#6c757d',            # Gris
+}
+
+ADMIN_COLORS = {
+    'Federal': '#dc3545',    # Rojo
+    'Estatal': '#007bff',    # Azul
+    'Municipal': '#28a745',  # Verde
+    'N/A': '#6c757d',        # Gris
+}
+
+DEFAULT_COLOR = '#6c757d'
+
+
+def _label(value):
+    """Normaliza un valor de atributo vacío a 'N/A'"""
+    if not value or str(value).strip() == '':
+        return 'N/A'
+    return str(value)
+
+
+def _labels(gdf, column):
+    """Etiqueta de cada fila en una columna, o 'N/A' para todas si no existe"""
+    if column not in gdf.columns:
+        return ['N/A'] * len(gdf)
+    return [_label(value) for value in gdf[column].tolist()]
+
+
+def _fragments(gdf):
+    """Texto GeoJSON de la geometría de cada fila, en una sola llamada a GEOS"""
+    return [fragment or 'null' for fragment in shapely.to_geojson(gdf.geometry.to_numpy()).tolist()]
+
+
+def _geometries(gdf):
+    """Geometrías GeoJSON de todas las filas: una sola serialización en GEOS y un solo parseo"""
+    return orjson.loads('[' + ','.join(_fragments(gdf)) + ']')
+
+
+def _feature_collection_bytes(fragments, labels, name, colors):
+    """
+    FeatureCollection serializada uniendo los fragmentos de shapely.to_geojson,
+    sin pasar las coordenadas por objetos de Python. Las propiedades se serializan
+    una vez por etiqueta distinta y el texto se codifica una sola vez al final.
+    """
+    # Cierre de cada Feature según su etiqueta: propiedades y llave final
+    tails = {
+        label: ',"properties":' + orjson.dumps({name: label, 'color': colors.get(label, DEFAULT_COLOR)}).decode() + '}'
+        for label in set(labels)
+    }
+    features = ','.join([
+        '{"type":"Feature","geometry":' + fragment + tails[label]
+        for fragment, label in zip(fragments, labels)
+    ])
+    return ('{"type":"FeatureCollection","features":[' + features + ']}').encode()
 
 
 class SegmentColorizer:
@@ -17,27 +76,18 @@ class SegmentColorizer:
         Returns:
             GeoJSON FeatureCollection
         """
-        color_map = {
-            'Con pavimento': '#28a745',  # Verde
-            'Sin pavimento': '#fd7e14',  # Naranja
-            'N/A': '#6c757d',            # Gris
-        }
-        
-        features = []
-        for idx, row in matched_segments_gdf.iterrows():
-            superficie = row.get('COND_PAV', 'N/A')
-            if not superficie or str(superficie).strip() == '':
-                superficie = 'N/A'
-            color = color_map.get(str(superficie), '#6c757d')
-            
-            features.append({
+        features = [
+            {
                 'type': 'Feature',
-                'geometry': json.loads(row.geometry.to_json()) if hasattr(row.geometry, 'to_json') else row.geometry.__geo_interface__,
+                'geometry': geometry,
                 'properties': {
-                    'superficie': str(superficie),
-                    'color': color
+                    'superficie': superficie,
+                    'color': SURFACE_COLORS.get(superficie, DEFAULT_COLOR)
                 }
-            })
+            }
+            for geometry, superficie in zip(_geometries(matched_segments_gdf),
+                                            _labels(matched_segments_gdf, 'COND_PAV'))
+        ]
         
         return {
             'type': 'FeatureCollection',
@@ -55,30 +105,76 @@ class SegmentColorizer:
         Returns:
             GeoJSON FeatureCollection
         """
-        color_map = {
-            'Federal': '#dc3545',    # Rojo
-            'Estatal': '#007bff',    # Azul
-            'Municipal': '#28a745',  # Verde
-            'N/A': '#6c757d',        # Gris
-        }
-        
-        features = []
-        for idx, row in matched_segments_gdf.iterrows():
-            administracion = row.get('ADMINISTRA', 'N/A')
-            if not administracion or str(administracion).strip() == '':
-                administracion = 'N/A'
-            color = color_map.get(str(administracion), '#6c757d')
-            
-            features.append({
+        features = [
+            {
                 'type': 'Feature',
-                'geometry': json.loads(row.geometry.to_json()) if hasattr(row.geometry, 'to_json') else row.geometry.__geo_interface__,
+                'geometry': geometry,
                 'properties': {
-                    'administracion': str(administracion),
-                    'color': color
+                    'administracion': administracion,
+                    'color': ADMIN_COLORS.get(administracion, DEFAULT_COLOR)
                 }
-            })
+            }
+            for geometry, administracion in zip(_geometries(matched_segments_gdf),
+                                                _labels(matched_segments_gdf, 'ADMINISTRA'))
+        ]
         
         return {
             'type': 'FeatureCollection',
             'features': features
         }
+    
+    @staticmethod
+    def colorize_both(matched_segments_gdf):
+        """
+        Colorea segmentos por superficie y por administración en una sola pasada.
+        La geometría de cada segmento se convierte una vez y se comparte entre ambas capas.
+        
+        Args:
+            matched_segments_gdf: GeoDataFrame con segmentos matched de la RNC
+        
+        Returns:
+            (FeatureCollection por superficie, FeatureCollection por administración)
+        """
+        surface_features = []
+        admin_features = []
+        for geometry, superficie, administracion in zip(_geometries(matched_segments_gdf),
+                                                        _labels(matched_segments_gdf, 'COND_PAV'),
+                                                        _labels(matched_segments_gdf, 'ADMINISTRA')):
+            surface_features.append({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': {
+                    'superficie': superficie,
+                    'color': SURFACE_COLORS.get(superficie, DEFAULT_COLOR)
+                }
+            })
+            admin_features.append({
+                'type': 'Feature',
+                'geometry': geometry,
+                'properties': {
+                    'administracion': administracion,
+                    'color': ADMIN_COLORS.get(administracion, DEFAULT_COLOR)
+                }
+            })
+        
+        return (
+            {'type': 'FeatureCollection', 'features': surface_features},
+            {'type': 'FeatureCollection', 'features': admin_features}
+        )
+    
+    @staticmethod
+    def colorize_both_bytes(matched_segments_gdf):
+        """
+        colorize_both ya serializado, sin construir los dicts de cada Feature.
+        Los fragmentos de geometría se generan una vez y se comparten entre ambas capas.
+        
+        Returns:
+            (bytes por superficie, bytes por administración)
+        """
+        fragments = _fragments(matched_segments_gdf)
+        return (
+            _feature_collection_bytes(fragments, _labels(matched_segments_gdf, 'COND_PAV'),
+                                      'superficie', SURFACE_COLORS),
+            _feature_collection_bytes(fragments, _labels(matched_segments_gdf, 'ADMINISTRA'),
+                                      'administracion', ADMIN_COLORS)
+        )
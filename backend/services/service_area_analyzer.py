@@ -1,10 +1,75 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import shapely
 from shapely.geometry import LineString, MultiLineString, Point
 from shapely.ops import unary_union
 import os
+from functools import lru_cache
+
+from .network_analyzer import get_network_analyzer, project_to_utm
+from .shapefile_service import IO_ENGINE
+
+# Column indices based on census manzanas structure:
+# 6: Poblacion total, 7: Pob femenina, 9: Pob masculina
+# 11: 0-14, 13: 15-29, 15: 30-59, 17: 60+, 19: discapacidad
+POPULATION_COLUMNS = {
+    'poblacion_total': 6,
+    'poblacion_fem': 7,
+    'poblacion_masc': 9,
+    'pob_0_14': 11,
+    'pob_15_29': 13,
+    'pob_30_59': 15,
+    'pob_60_mas': 17,
+    'pob_discapacidad': 19,
+}
+
+# Columns that may hold the municipality name, in order of preference
+MUNICIPIO_NAME_COLUMNS = ['NOMGEO', 'NOM_MUN', 'NOMBRE', 'NAME', 'nombre', 'name']
+
+# Layers read by ServiceAreaAnalyzer; a new version of any of them rebuilds the shared instance
+SERVICE_AREA_LAYERS = ('manzanas', 'road_network', 'municipalities')
+
+
+def _to_int(val):
+    """Census value to int: '*' (confidential), empty or unparseable values count as 0"""
+    if val is None or val == '*' or val == '':
+        return 0
+    try:
+        return int(float(str(val).replace(',', '')))
+    except:
+        return 0
+
+
+def _parse_population(series):
+    """
+    _to_int of every value in a column as an int64 array.
+    Census columns repeat few distinct values, so each one is parsed only once.
+    """
+    codes, uniques = pd.factorize(series)
+    # Missing values get code -1, which picks the trailing 0
+    parsed = np.array([_to_int(val) for val in uniques] + [0], dtype=np.int64)
+    return parsed[codes]
+
+
+def _population_arrays(manzanas_gdf):
+    """
+    Parsed population columns of a manzanas GeoDataFrame, {key: array} in row order.
+    int32 when the values fit (a manzana never has billions of people); sums still accumulate in int64.
+    """
+    # Get actual column names by index (more reliable than garbled names)
+    cols = list(manzanas_gdf.columns)
+    # One array per column: gathering rows of an (N, 8) matrix and summing along axis 0 is
+    # about 3x slower than eight 1-D gathers and reductions
+    arrays = {}
+    for key, i in POPULATION_COLUMNS.items():
+        if len(cols) > i:
+            values = _parse_population(manzanas_gdf[cols[i]])
+            if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+                values = values.astype(np.int32)
+            arrays[key] = values
+    return arrays
 
-from .network_analyzer import get_network_analyzer
 
 class ServiceAreaAnalyzer:
     """Analyzes service area coverage using road network and Dijkstra algorithm"""
@@ -15,6 +80,9 @@ class ServiceAreaAnalyzer:
         self.rnc_gdf = None
         self.municipios_gdf = None
         self.network_analyzer = None
+        self._manzanas_pop = {}
+        self._municipio_by_name = {}
+        self._municipio_positions_by_name = {}
         self._load_data()
         
         # Initialize network analyzer
@@ -30,16 +98,20 @@ class ServiceAreaAnalyzer:
         
         if os.path.exists(manzanas_path):
             try:
-                self.manzanas_gdf = gpd.read_file(manzanas_path)
+                self.manzanas_gdf = gpd.read_file(manzanas_path, engine=IO_ENGINE)
                 # Ensure projected CRS for distance calculations
                 if self.manzanas_gdf.crs and self.manzanas_gdf.crs.is_geographic:
                     self.manzanas_gdf = self.manzanas_gdf.to_crs(epsg=32614)  # UTM zone 14N for Mexico
+                # Parse the census strings once; aggregations index these arrays
+                self._manzanas_pop = _population_arrays(self.manzanas_gdf)
+                # Build the STRtree now so every intersection query reuses it
+                self.manzanas_gdf.sindex
             except Exception as e:
                 print(f"Error loading manzanas: {e}")
         
         if os.path.exists(rnc_path):
             try:
-                self.rnc_gdf = gpd.read_file(rnc_path)
+                self.rnc_gdf = gpd.read_file(rnc_path, engine=IO_ENGINE)
                 if self.rnc_gdf.crs and self.rnc_gdf.crs.is_geographic:
                     self.rnc_gdf = self.rnc_gdf.to_crs(epsg=32614)
             except Exception as e:
@@ -49,11 +121,15 @@ class ServiceAreaAnalyzer:
         municipios_path = os.path.join(self.data_folder, 'shapefiles', 'municipalities', 'municipalities.shp')
         if os.path.exists(municipios_path):
             try:
-                self.municipios_gdf = gpd.read_file(municipios_path)
+                self.municipios_gdf = gpd.read_file(municipios_path, engine=IO_ENGINE)
                 if self.municipios_gdf.crs and self.municipios_gdf.crs.is_geographic:
                     self.municipios_gdf = self.municipios_gdf.to_crs(epsg=32614)
+                self._municipio_by_name = self._index_municipios(self.municipios_gdf)
             except Exception as e:
                 print(f"Error loading municipios: {e}")
+        
+        if self.manzanas_gdf is not None and self._municipio_by_name:
+            self._municipio_positions_by_name = self._index_municipio_positions()
     
     def analyze(self, route_geometry, buffer_distance_m=700, municipio_name=None, use_network=True):
         """
@@ -73,8 +149,7 @@ class ServiceAreaAnalyzer:
         
         try:
             # Convert route to projected CRS
-            route_gdf = gpd.GeoDataFrame(geometry=[route_geometry], crs='EPSG:4326')
-            route_projected = route_gdf.to_crs(epsg=32614).geometry[0]
+            route_projected = project_to_utm(route_geometry)
             
             # Use network-based service area calculation if available
             if use_network and self.network_analyzer and self.network_analyzer.graph:
@@ -85,13 +160,15 @@ class ServiceAreaAnalyzer:
                 # Fallback to euclidean buffer
                 print("Using euclidean buffer (network analyzer not available)")
                 route_buffer = route_projected.buffer(buffer_distance_m)
-                manzanas_in_buffer = self.manzanas_gdf[self.manzanas_gdf.intersects(route_buffer)].copy()
+                manzanas_in_buffer = self.manzanas_gdf.iloc[self._intersecting_positions(route_buffer)].copy()
             
             # Filter by municipality if specified
+            municipio_positions = None
             if municipio_name and self.municipios_gdf is not None:
-                municipio_geom = self._get_municipio_geometry(municipio_name)
-                if municipio_geom is not None:
-                    manzanas_in_buffer = manzanas_in_buffer[manzanas_in_buffer.intersects(municipio_geom)]
+                municipio_positions = self._municipio_positions(municipio_name)
+                if municipio_positions is not None:
+                    in_municipio = self.manzanas_gdf.index[municipio_positions]
+                    manzanas_in_buffer = manzanas_in_buffer[manzanas_in_buffer.index.isin(in_municipio)]
             
             if len(manzanas_in_buffer) == 0:
                 return self._empty_result("No manzanas found within service area")
@@ -105,31 +182,23 @@ class ServiceAreaAnalyzer:
             # Calculate UNSERVED population in the municipality
             unserved_stats = None
             unserved_manzanas_gdf = None
-            if municipio_name and self.municipios_gdf is not None:
-                municipio_geom = self._get_municipio_geometry(municipio_name)
-                if municipio_geom is not None:
-                    # Get all manzanas in the municipality
-                    all_manzanas_in_municipio = self.manzanas_gdf[
-                        self.manzanas_gdf.intersects(municipio_geom)
-                    ].copy()
-                    
-                    # Get unserved manzanas (in municipality but NOT in service area)
-                    served_indices = set(manzanas_in_buffer.index)
-                    unserved_manzanas_gdf = all_manzanas_in_municipio[
-                        ~all_manzanas_in_municipio.index.isin(served_indices)
-                    ].copy()
-                    
-                    if len(unserved_manzanas_gdf) > 0:
-                        unserved_stats = self._aggregate_population(unserved_manzanas_gdf)
-                        unserved_stats['manzanas_count'] = len(unserved_manzanas_gdf)
-                    else:
-                        unserved_stats = self._empty_stats()
-                        unserved_stats['manzanas_count'] = 0
-                    
-                    # Total municipality stats
-                    total_stats = self._aggregate_population(all_manzanas_in_municipio)
-                    total_stats['manzanas_count'] = len(all_manzanas_in_municipio)
-                    stats['municipio_total'] = total_stats
+            if municipio_positions is not None:
+                # Unserved manzanas: in the municipality but NOT in the service area
+                served_positions = self.manzanas_gdf.index.get_indexer(manzanas_in_buffer.index)
+                unserved_positions = np.setdiff1d(municipio_positions, served_positions, assume_unique=True)
+                unserved_manzanas_gdf = self.manzanas_gdf.iloc[unserved_positions].copy()
+                
+                if len(unserved_positions) > 0:
+                    unserved_stats = self._aggregate_positions(unserved_positions)
+                    unserved_stats['manzanas_count'] = len(unserved_positions)
+                else:
+                    unserved_stats = self._empty_stats()
+                    unserved_stats['manzanas_count'] = 0
+                
+                # Total municipality stats
+                total_stats = self._aggregate_positions(municipio_positions)
+                total_stats['manzanas_count'] = len(municipio_positions)
+                stats['municipio_total'] = total_stats
             
             return {
                 'success': True,
@@ -155,8 +224,8 @@ class ServiceAreaAnalyzer:
         # FIRST: Get manzanas that the route DIRECTLY intersects (always served)
         # Use a small buffer around the route to catch manzanas the route passes through
         route_direct_buffer = route_projected.buffer(50)  # 50m buffer around route
-        manzanas_direct = self.manzanas_gdf[
-            self.manzanas_gdf.intersects(route_direct_buffer)
+        manzanas_direct = self.manzanas_gdf.iloc[
+            self._intersecting_positions(route_direct_buffer)
         ].copy()
         direct_indices = set(manzanas_direct.index)
         print(f"Route directly passes through {len(direct_indices)} manzanas")
@@ -180,50 +249,62 @@ class ServiceAreaAnalyzer:
             return manzanas_direct
         
         # Find manzanas that intersect with the network-based service area
-        manzanas_in_service_area = self.manzanas_gdf[
-            self.manzanas_gdf.intersects(service_area_polygon)
+        manzanas_in_service_area = self.manzanas_gdf.iloc[
+            self._intersecting_positions(service_area_polygon)
         ].copy()
         
         # Filter by centroid reachability, but ALWAYS include direct intersection manzanas
         filtered_indices = set(direct_indices)  # Start with direct intersections
         
-        for idx, row in manzanas_in_service_area.iterrows():
-            if idx in direct_indices:
-                continue  # Already included
-            centroid = row.geometry.centroid
-            is_reachable, dist = self.network_analyzer.is_point_in_service_area(
-                (centroid.x, centroid.y), 
-                service_area_nodes, 
-                node_distances,
-                max_distance=buffer_distance_m
-            )
-            if is_reachable:
-                filtered_indices.add(idx)
+        candidates = manzanas_in_service_area[~manzanas_in_service_area.index.isin(direct_indices)]
+        centroids = shapely.centroid(candidates.geometry.to_numpy())
+        is_reachable, _ = self.network_analyzer.is_point_in_service_area_batch(
+            np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)]),
+            service_area_nodes,
+            node_distances,
+            max_distance=buffer_distance_m
+        )
+        filtered_indices.update(candidates.index[is_reachable].tolist())
         
         result = self.manzanas_gdf.loc[list(filtered_indices)].copy()
         print(f"Network analysis found {len(result)} manzanas ({len(direct_indices)} direct + {len(result) - len(direct_indices)} network)")
         
         return result
     
+    def _intersecting_positions(self, geometry):
+        """Positions of the manzanas intersecting geometry, in layer order (STRtree query, no full scan)"""
+        return np.sort(self.manzanas_gdf.sindex.query(geometry, predicate='intersects'))
+    
+    def _index_municipio_positions(self):
+        """Uppercased municipality name -> sorted positions of its manzanas, from one bulk STRtree query"""
+        names = list(self._municipio_by_name)
+        geometries = np.array([self._municipio_by_name[name] for name in names], dtype=object)
+        municipio_idx, positions = self.manzanas_gdf.sindex.query(geometries, predicate='intersects')
+        order = np.lexsort((positions, municipio_idx))
+        municipio_idx, positions = municipio_idx[order], positions[order]
+        splits = np.searchsorted(municipio_idx, np.arange(len(names) + 1))
+        return {name: positions[splits[i]:splits[i + 1]] for i, name in enumerate(names)}
+    
+    def _municipio_positions(self, municipio_name):
+        """Positions of the manzanas in a municipality (None if unknown), precomputed at load time"""
+        return self._municipio_positions_by_name.get(municipio_name.upper())
+    
     def _aggregate_population(self, manzanas_gdf):
-        """Aggregate population statistics from manzanas"""
-        # Get actual column names by index (more reliable than garbled names)
-        cols = list(manzanas_gdf.columns)
-        
-        # Column indices based on census manzanas structure:
-        # 6: Poblacion total, 7: Pob femenina, 9: Pob masculina
-        # 11: 0-14, 13: 15-29, 15: 30-59, 17: 60+, 19: discapacidad
-        col_mapping = {
-            'poblacion_total': cols[6] if len(cols) > 6 else None,
-            'poblacion_fem': cols[7] if len(cols) > 7 else None,
-            'poblacion_masc': cols[9] if len(cols) > 9 else None,
-            'pob_0_14': cols[11] if len(cols) > 11 else None,
-            'pob_15_29': cols[13] if len(cols) > 13 else None,
-            'pob_30_59': cols[15] if len(cols) > 15 else None,
-            'pob_60_mas': cols[17] if len(cols) > 17 else None,
-            'pob_discapacidad': cols[19] if len(cols) > 19 else None,
-        }
-        
+        """Aggregate population statistics from manzanas (rows of self.manzanas_gdf)"""
+        # Rows of the loaded layer reuse the arrays parsed at load time
+        if self._manzanas_pop and self.manzanas_gdf is not None and manzanas_gdf.columns.equals(self.manzanas_gdf.columns):
+            positions = self.manzanas_gdf.index.get_indexer(manzanas_gdf.index)
+            if not (positions < 0).any():
+                return self._aggregate_positions(positions)
+        return self._population_stats(_population_arrays(manzanas_gdf))
+    
+    def _aggregate_positions(self, positions):
+        """Aggregate population statistics of the manzanas at the given positions of self.manzanas_gdf"""
+        return self._population_stats({key: values[positions] for key, values in self._manzanas_pop.items()})
+    
+    @staticmethod
+    def _population_stats(population):
+        """Stats structure from parsed population columns ({key: array})"""
         stats = {
             'poblacion_total': 0,
             'poblacion_femenina': 0,
@@ -240,40 +321,19 @@ class ServiceAreaAnalyzer:
             }
         }
         
-        # Helper to convert value to int
-        def to_int(val):
-            if val is None or val == '*' or val == '':
-                return 0
-            try:
-                return int(float(str(val).replace(',', '')))
-            except:
-                return 0
+        def total(key):
+            values = population.get(key)
+            return int(values.sum(dtype=np.int64)) if values is not None else 0
         
         # Aggregate each column
-        for _, row in manzanas_gdf.iterrows():
-            # Total population
-            if col_mapping['poblacion_total'] in row.index:
-                stats['poblacion_total'] += to_int(row[col_mapping['poblacion_total']])
-            
-            # By gender
-            if col_mapping['poblacion_fem'] in row.index:
-                stats['poblacion_femenina'] += to_int(row[col_mapping['poblacion_fem']])
-            if col_mapping['poblacion_masc'] in row.index:
-                stats['poblacion_masculina'] += to_int(row[col_mapping['poblacion_masc']])
-            
-            # Age groups
-            if col_mapping['pob_0_14'] in row.index:
-                stats['piramide_poblacional']['0-14']['total'] += to_int(row[col_mapping['pob_0_14']])
-            if col_mapping['pob_15_29'] in row.index:
-                stats['piramide_poblacional']['15-29']['total'] += to_int(row[col_mapping['pob_15_29']])
-            if col_mapping['pob_30_59'] in row.index:
-                stats['piramide_poblacional']['30-59']['total'] += to_int(row[col_mapping['pob_30_59']])
-            if col_mapping['pob_60_mas'] in row.index:
-                stats['piramide_poblacional']['60+']['total'] += to_int(row[col_mapping['pob_60_mas']])
-            
-            # Disability
-            if col_mapping['pob_discapacidad'] in row.index:
-                stats['discapacidad']['total'] += to_int(row[col_mapping['pob_discapacidad']])
+        stats['poblacion_total'] = total('poblacion_total')
+        stats['poblacion_femenina'] = total('poblacion_fem')
+        stats['poblacion_masculina'] = total('poblacion_masc')
+        stats['piramide_poblacional']['0-14']['total'] = total('pob_0_14')
+        stats['piramide_poblacional']['15-29']['total'] = total('pob_15_29')
+        stats['piramide_poblacional']['30-59']['total'] = total('pob_30_59')
+        stats['piramide_poblacional']['60+']['total'] = total('pob_60_mas')
+        stats['discapacidad']['total'] = total('pob_discapacidad')
         
         # Calculate disability percentage
         if stats['poblacion_total'] > 0:
@@ -283,24 +343,28 @@ class ServiceAreaAnalyzer:
         
         return stats
     
+    @staticmethod
+    def _index_municipios(municipios_gdf):
+        """
+        Uppercased municipality name -> geometry (union of the rows sharing the name).
+        A name found in an earlier name column wins over later columns.
+        """
+        by_name = {}
+        for col in MUNICIPIO_NAME_COLUMNS:
+            if col in municipios_gdf.columns:
+                names = municipios_gdf[col].str.upper()
+                for name, geometries in municipios_gdf.geometry.groupby(names, sort=False):
+                    if name not in by_name:
+                        # A single polygon needs no union; several go to GEOS in one call
+                        by_name[name] = (geometries.iloc[0] if len(geometries) == 1
+                                         else shapely.union_all(geometries.to_numpy()))
+        return by_name
+    
     def _get_municipio_geometry(self, municipio_name):
-        """Get the geometry of a municipality by name"""
+        """Get the geometry of a municipality by name (case-insensitive)"""
         if self.municipios_gdf is None:
             return None
-        
-        # Try different column names for municipality name
-        name_columns = ['NOMGEO', 'NOM_MUN', 'NOMBRE', 'NAME', 'nombre', 'name']
-        
-        for col in name_columns:
-            if col in self.municipios_gdf.columns:
-                # Case-insensitive match
-                matches = self.municipios_gdf[
-                    self.municipios_gdf[col].str.upper() == municipio_name.upper()
-                ]
-                if len(matches) > 0:
-                    return matches.geometry.unary_union
-        
-        return None
+        return self._municipio_by_name.get(municipio_name.upper())
     
     def _empty_stats(self):
         """Return empty stats structure"""
@@ -329,3 +393,27 @@ class ServiceAreaAnalyzer:
             'stats': self._empty_stats(),
             'unserved_stats': None
         }
+
+
+def _layer_mtimes(data_folder):
+    """mtime_ns of each layer in SERVICE_AREA_LAYERS (None if missing)"""
+    mtimes = []
+    for layer in SERVICE_AREA_LAYERS:
+        path = os.path.join(data_folder, 'shapefiles', layer, f'{layer}.shp')
+        mtimes.append(os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+    return tuple(mtimes)
+
+
+@lru_cache(maxsize=2)
+def _service_area_analyzer_cached(data_folder, layer_mtimes):
+    return ServiceAreaAnalyzer(data_folder)
+
+
+def get_service_area_analyzer(data_folder):
+    """
+    ServiceAreaAnalyzer shared by every analysis in this process: layers, parsed population
+    and spatial indexes (including the manzanas of each municipality) are built once per file
+    version instead of once per request. analyze() only reads them, so the instance can be used
+    from several threads.
+    """
+    return _service_area_analyzer_cached(data_folder, _layer_mtimes(data_folder))
@@ -1,76 +1,181 @@
+import io
 import os
 import geopandas as gpd
-import json
+import numpy as np
+import orjson
+import pandas as pd
+import shapely
+from pyproj import CRS
 from werkzeug.utils import secure_filename
 import tempfile
 import shutil
+import zipfile
+
+from services.route_cache import LRUCache
+
+try:
+    import pyogrio
+except ImportError:
+    pyogrio = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+
+# GDAL's batched reader/writer, skips Fiona's per-feature Python loop (None: geopandas default)
+IO_ENGINE = 'pyogrio' if pyogrio is not None else None
+
+# Loaded layers kept in memory, keyed by (path, mtime) so a re-upload is never served stale
+GDF_CACHE_SIZE = 4
+
+# Layers are stored in WGS84; equivalent CRSs without an EPSG code (ESRI .prj, OGC:CRS84) count too
+_WGS84 = CRS.from_epsg(4326)
+
+# Decimals kept in served GeoJSON coordinates, 1e-5 degrees is about 1 m
+GEOJSON_PRECISION = 5
+
+
+def _looks_garbled(gdf):
+    """Whether any text attribute has 'Ã', the common sign of UTF-8 decoded with the wrong encoding"""
+    # Every row, not just the first: a wrong .cpg must not pass on an all-ASCII first feature
+    for column in gdf.columns:
+        values = gdf[column]
+        if pd.api.types.is_string_dtype(values.dtype) and values.astype(str).str.contains('Ã', regex=False).any():
+            return True
+    return False
+
+
+def _is_fresh(sidecar_path, shp_path):
+    """Whether a file derived from a shapefile exists and is at least as new as the .shp"""
+    return os.path.exists(sidecar_path) and os.stat(sidecar_path).st_mtime_ns >= os.stat(shp_path).st_mtime_ns
+
+
+def _write_sidecar(path, payload):
+    """Write bytes under a temporary name then rename, so concurrent readers never see a partial file"""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    except OSError:
+        return  # Without the sidecar it is rebuilt next time
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+
+
+def read_shapefile_with_encoding(shp_path):
+    """Read a shapefile trying the encodings used by the INEGI layers"""
+    # Try multiple encodings for Spanish characters
+    encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
+    # With a .cpg GDAL decodes with the declared encoding itself, a single parse when it's right
+    if os.path.exists(os.path.splitext(shp_path)[0] + '.cpg'):
+        encodings.insert(0, None)
+    for encoding in encodings:
+        try:
+            gdf = gpd.read_file(shp_path, encoding=encoding, engine=IO_ENGINE)
+            # Test if encoding worked by checking for garbled characters
+            if not _looks_garbled(gdf):
+                return gdf
+        except Exception:
+            continue
+    
+    # Fallback
+    return gpd.read_file(shp_path, engine=IO_ENGINE)
+
+
+def read_layer(shp_path):
+    """Read a shapefile through its GeoParquet sidecar, rebuilt from the .shp when missing or older"""
+    parquet_path = os.path.splitext(shp_path)[0] + '.parquet'
+    if _is_fresh(parquet_path, shp_path):
+        return gpd.read_parquet(parquet_path)
+    
+    gdf = read_shapefile_with_encoding(shp_path)
+    # Written under a temporary name, unique per call so concurrent threads never share it
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(parquet_path), suffix='.parquet.tmp')
+        os.close(fd)
+    except OSError:
+        return gdf  # Folder not writable, keep reading the shapefile
+    try:
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, parquet_path)
+    except (ImportError, OSError):
+        os.remove(tmp_path)  # pyarrow not installed or write failed, keep reading the shapefile
+    return gdf
+
+
+def read_layer_columns(shp_path, columns):
+    """Those of columns present in a layer, without geometry; only they are read from a fresh GeoParquet sidecar"""
+    parquet_path = os.path.splitext(shp_path)[0] + '.parquet'
+    if pq is not None and _is_fresh(parquet_path, shp_path):
+        names = pq.read_schema(parquet_path).names
+        return pd.read_parquet(parquet_path, columns=[c for c in columns if c in names])
+    
+    gdf = read_layer(shp_path)
+    return pd.DataFrame(gdf[[c for c in columns if c in gdf.columns]])
+
+
+def _has_type_id(gdf, type_ids):
+    """Whether any geometry has one of the shapely type ids, in one vectorized pass"""
+    return bool(np.isin(shapely.get_type_id(gdf.geometry.values), type_ids).any())
+
+
+def _round_coordinates(gdf):
+    """Copy of gdf with coordinates rounded to GEOJSON_PRECISION decimals, for display only"""
+    rounded = shapely.transform(gdf.geometry.values, lambda coords: np.round(coords, GEOJSON_PRECISION))
+    return gdf.set_geometry(gpd.GeoSeries(rounded, index=gdf.index, crs=gdf.crs))
+
 
 class ShapefileService:
     def __init__(self, data_folder):
         self.data_folder = data_folder
         self.shapefiles_folder = os.path.join(data_folder, 'shapefiles')
         os.makedirs(self.shapefiles_folder, exist_ok=True)
+        self._gdf_cache = LRUCache(GDF_CACHE_SIZE)
     
     def save_shapefile(self, files, shapefile_type):
         """Save uploaded shapefile components or KML file"""
-        # Create temp directory for uploaded files
-        temp_dir = tempfile.mkdtemp()
-        shp_file = None
-        kml_file = None
+        # The layer is about to be replaced, drop every cached version of it
+        layer_path = os.path.join(self.shapefiles_folder, shapefile_type, f'{shapefile_type}.shp')
+        self._gdf_cache.discard(lambda key: key[0] == layer_path)
         
         try:
             # Check if it's a KML upload
             for file in files:
                 if file.filename.lower().endswith('.kml'):
+                    # Create temp directory for the KML driver, removed by _process_kml
+                    temp_dir = tempfile.mkdtemp()
                     kml_path = os.path.join(temp_dir, 'data.kml')
                     file.save(kml_path)
-                    kml_file = kml_path
-                    break
+                    return self._process_kml(kml_path, shapefile_type, temp_dir)
             
-            # If KML file found, process it
-            if kml_file:
-                return self._process_kml(kml_file, shapefile_type, temp_dir)
-            
-            # Otherwise, process as shapefile
-            # Get base name from .shp file to ensure all files have matching names
-            base_name = None
-            for file in files:
-                if file.filename.lower().endswith('.shp'):
-                    # Use simple name without secure_filename to preserve matching
-                    base_name = os.path.splitext(file.filename)[0]
-                    break
-            
-            if not base_name:
-                return {'success': False, 'error': 'No se encontró archivo .shp o .kml'}
-            
-            # Save all uploaded files with consistent naming
+            # Otherwise, process as shapefile: keep every component in memory by extension
+            components = {}
             for file in files:
-                original_ext = os.path.splitext(file.filename)[1].lower()
-                # Use a simple base name to avoid encoding issues in filenames
-                new_filename = f"data{original_ext}"
-                filepath = os.path.join(temp_dir, new_filename)
-                file.save(filepath)
-                
-                if original_ext == '.shp':
-                    shp_file = filepath
+                components[os.path.splitext(file.filename)[1].lower()] = file.read()
             
-            if not shp_file:
+            if '.shp' not in components:
                 return {'success': False, 'error': 'No se encontró archivo .shp o .kml'}
             
-            # Remove .cpg file if exists (it may specify wrong encoding)
-            cpg_file = os.path.join(temp_dir, 'data.cpg')
-            if os.path.exists(cpg_file):
-                os.remove(cpg_file)
+            # Replace the .cpg if any (it may specify wrong encoding) with Latin-1
+            # (common for Mexican government data)
+            components['.cpg'] = b'LATIN1'
             
-            # Create .cpg file with Latin-1 encoding (common for Mexican government data)
-            with open(cpg_file, 'w') as f:
-                f.write('LATIN1')
+            # Read shapefile from an in-memory ZIP (GDAL's /vsimem/), no temp files;
+            # a simple base name avoids encoding issues in filenames
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zf:
+                for ext, content in components.items():
+                    zf.writestr(f'data{ext}', content)
+            archive.seek(0)
             
-            # Read shapefile
             gdf = None
             last_error = None
             try:
-                gdf = gpd.read_file(shp_file)
+                gdf = gpd.read_file(archive, engine=IO_ENGINE)
             except Exception as e:
                 last_error = str(e)
             
@@ -78,31 +183,41 @@ class ShapefileService:
                 return {'success': False, 'error': f'Could not read shapefile: {last_error}'}
             
             # Ensure WGS84 projection
+            rewrite = True
             if gdf.crs is None:
                 gdf.set_crs(epsg=4326, inplace=True)
-            elif gdf.crs.to_epsg() != 4326:
+            elif not gdf.crs.equals(_WGS84, ignore_axis_order=True):
                 gdf = gdf.to_crs(epsg=4326)
+            else:
+                rewrite = False
             
             # Validate based on type
             validation = self._validate_shapefile(gdf, shapefile_type)
             if not validation['valid']:
                 return {'success': False, 'error': validation['error']}
             
-            # Save to permanent location
-            dest_folder = os.path.join(self.shapefiles_folder, shapefile_type)
-            if os.path.exists(dest_folder):
-                shutil.rmtree(dest_folder)
-            os.makedirs(dest_folder)
-            
-            dest_path = os.path.join(dest_folder, f'{shapefile_type}.shp')
-            gdf.to_file(dest_path)
+            # Save to permanent location, through a staging folder swapped in once complete
+            staging_folder = self._staging_folder(shapefile_type)
+            if rewrite:
+                gdf.to_file(os.path.join(staging_folder, f'{shapefile_type}.shp'), engine=IO_ENGINE)
+            else:
+                # Already WGS84 with its .prj: keep the uploaded files instead of re-encoding every feature
+                for ext, content in components.items():
+                    with open(os.path.join(staging_folder, f'{shapefile_type}{ext}'), 'wb') as f:
+                        f.write(content)
+            self._publish(staging_folder, shapefile_type)
+            # Build the GeoParquet, preview GeoJSON and municipios sidecars from the written file now,
+            # so no request has to parse the .shp or simplify the geometries
+            self.get_geojson_bytes(shapefile_type)
+            if shapefile_type == 'municipalities':
+                self.get_municipios_list()
             
             # Get bounds
             bounds = gdf.total_bounds.tolist()
             
             return {
                 'success': True,
-                'filename': os.path.basename(shp_file),
+                'filename': 'data.shp',
                 'features_count': len(gdf),
                 'bounds': bounds,
                 'attributes': list(gdf.columns),
@@ -111,9 +226,6 @@ class ShapefileService:
             
         except Exception as e:
             return {'success': False, 'error': str(e)}
-        finally:
-            # Cleanup temp directory
-            shutil.rmtree(temp_dir, ignore_errors=True)
     
     def _process_kml(self, kml_file, shapefile_type, temp_dir):
         """Process KML file and save as shapefile"""
@@ -131,7 +243,7 @@ class ShapefileService:
             # Ensure WGS84 projection
             if gdf.crs is None:
                 gdf.set_crs(epsg=4326, inplace=True)
-            elif gdf.crs.to_epsg() != 4326:
+            elif not gdf.crs.equals(_WGS84, ignore_axis_order=True):
                 gdf = gdf.to_crs(epsg=4326)
             
             # Validate based on type
@@ -139,14 +251,15 @@ class ShapefileService:
             if not validation['valid']:
                 return {'success': False, 'error': validation['error']}
             
-            # Save to permanent location as shapefile
-            dest_folder = os.path.join(self.shapefiles_folder, shapefile_type)
-            if os.path.exists(dest_folder):
-                shutil.rmtree(dest_folder)
-            os.makedirs(dest_folder)
-            
-            dest_path = os.path.join(dest_folder, f'{shapefile_type}.shp')
-            gdf.to_file(dest_path)
+            # Save to permanent location as shapefile, through a staging folder swapped in once complete
+            staging_folder = self._staging_folder(shapefile_type)
+            gdf.to_file(os.path.join(staging_folder, f'{shapefile_type}.shp'), engine=IO_ENGINE)
+            self._publish(staging_folder, shapefile_type)
+            # Build the GeoParquet, preview GeoJSON and municipios sidecars from the written file now,
+            # so no request has to parse the .shp or simplify the geometries
+            self.get_geojson_bytes(shapefile_type)
+            if shapefile_type == 'municipalities':
+                self.get_municipios_list()
             
             # Get bounds
             bounds = gdf.total_bounds.tolist()
@@ -166,6 +279,26 @@ class ShapefileService:
             # Cleanup temp directory
             shutil.rmtree(temp_dir, ignore_errors=True)
     
+    def _staging_folder(self, shapefile_type):
+        """Empty folder next to the layer's where a new version is written before it is published"""
+        staging_folder = os.path.join(self.shapefiles_folder, f'.{shapefile_type}.{os.getpid()}.tmp')
+        shutil.rmtree(staging_folder, ignore_errors=True)  # Left over by a failed upload
+        os.makedirs(staging_folder)
+        return staging_folder
+    
+    def _publish(self, staging_folder, shapefile_type):
+        """
+        Swap a complete staging folder in for the layer's folder with renames, then drop the old one.
+        Between the two renames the layer folder is briefly missing (readers see it as not loaded).
+        """
+        dest_folder = os.path.join(self.shapefiles_folder, shapefile_type)
+        old_folder = f'{staging_folder}.old'
+        shutil.rmtree(old_folder, ignore_errors=True)  # Left over by a crashed upload
+        if os.path.exists(dest_folder):
+            os.replace(dest_folder, old_folder)
+        os.replace(staging_folder, dest_folder)
+        shutil.rmtree(old_folder, ignore_errors=True)
+    
     def _validate_shapefile(self, gdf, shapefile_type):
         """Validate shapefile structure based on type"""
         if len(gdf) == 0:
@@ -173,16 +306,14 @@ class ShapefileService:
         
         if shapefile_type == 'road_network':
             # Should be LineString geometry
-            geom_types = gdf.geometry.geom_type.unique()
-            valid_types = ['LineString', 'MultiLineString']
-            if not any(gt in valid_types for gt in geom_types):
+            if not _has_type_id(gdf, (1, 5)):  # LineString, MultiLineString
+                geom_types = gdf.geometry.geom_type.unique()
                 return {'valid': False, 'error': f'Road network should contain LineString geometries, found: {geom_types}'}
         
         elif shapefile_type == 'municipalities':
             # Should be Polygon geometry
-            geom_types = gdf.geometry.geom_type.unique()
-            valid_types = ['Polygon', 'MultiPolygon']
-            if not any(gt in valid_types for gt in geom_types):
+            if not _has_type_id(gdf, (3, 6)):  # Polygon, MultiPolygon
+                geom_types = gdf.geometry.geom_type.unique()
                 return {'valid': False, 'error': f'Municipalities should contain Polygon geometries, found: {geom_types}'}
         
         elif shapefile_type == 'localities':
@@ -191,47 +322,55 @@ class ShapefileService:
         
         elif shapefile_type in ['sites_public', 'sites_private']:
             # Sites (bases) should be Point geometry
-            geom_types = gdf.geometry.geom_type.unique()
-            valid_types = ['Point', 'MultiPoint']
-            if not any(gt in valid_types for gt in geom_types):
+            if not _has_type_id(gdf, (0, 4)):  # Point, MultiPoint
+                geom_types = gdf.geometry.geom_type.unique()
                 return {'valid': False, 'error': f'Sitios deben contener geometrías de tipo Point, se encontró: {geom_types}'}
         
         return {'valid': True}
     
-    def _read_with_encoding(self, shp_path):
-        """Read shapefile trying multiple encodings"""
-        encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1']
-        for encoding in encodings:
-            try:
-                return gpd.read_file(shp_path, encoding=encoding)
-            except Exception:
-                continue
-        # Last resort - try without encoding param
-        return gpd.read_file(shp_path)
-    
     def get_geojson(self, shapefile_type, simplify=True):
         """Get shapefile as GeoJSON"""
-        shp_path = os.path.join(self.shapefiles_folder, shapefile_type, f'{shapefile_type}.shp')
+        if simplify:
+            return orjson.loads(self.get_geojson_bytes(shapefile_type))
         
-        if not os.path.exists(shp_path):
+        gdf = self.get_geodataframe(shapefile_type)
+        if gdf is None:
             raise FileNotFoundError(f'Shapefile not found: {shapefile_type}')
+        # Full precision: rounding only applies to the pre-baked preview
+        return gdf.to_geo_dict(na='null')
+    
+    def get_geojson_bytes(self, shapefile_type):
+        """Simplified GeoJSON of a layer as UTF-8 bytes, kept in a sidecar next to the .shp and served as-is"""
+        shp_path = os.path.join(self.shapefiles_folder, shapefile_type, f'{shapefile_type}.shp')
+        geojson_path = os.path.splitext(shp_path)[0] + '.geojson'
+        if os.path.exists(shp_path) and _is_fresh(geojson_path, shp_path):
+            with open(geojson_path, 'rb') as f:
+                return f.read()
         
-        gdf = self._read_with_encoding(shp_path)
-        
-        # Simplify geometry for web display if needed
-        if simplify and len(gdf) > 1000:
-            gdf['geometry'] = gdf.geometry.simplify(0.001)
+        gdf = self.get_geodataframe(shapefile_type)
+        if gdf is None:
+            raise FileNotFoundError(f'Shapefile not found: {shapefile_type}')
         
-        return json.loads(gdf.to_json())
+        # Simplify geometry for web display if needed (on a copy, the cached layer is shared)
+        if len(gdf) > 1000:
+            gdf = gdf.set_geometry(gdf.geometry.simplify(0.001))
+        payload = orjson.dumps(_round_coordinates(gdf).to_geo_dict(na='null'), default=str)
+        _write_sidecar(geojson_path, payload)
+        return payload
     
     def get_geodataframe(self, shapefile_type):
-        """Get shapefile as GeoDataFrame"""
+        """Get shapefile as GeoDataFrame, shared between requests (do not modify)"""
         shp_path = os.path.join(self.shapefiles_folder, shapefile_type, f'{shapefile_type}.shp')
         
         if not os.path.exists(shp_path):
             return None
         
-        return self._read_with_encoding(shp_path)
+        key = (shp_path, os.stat(shp_path).st_mtime_ns)
+        gdf = self._gdf_cache.get(key)
+        if gdf is None:
+            gdf = read_layer(shp_path)
+            self._gdf_cache.put(key, gdf)
+        return gdf
     
     def is_loaded(self, shapefile_type):
         """Check if shapefile is loaded"""
@@ -239,15 +378,31 @@ class ShapefileService:
         return os.path.exists(shp_path)
     
     def get_municipios_list(self):
-        """Get list of municipios from NOMGEO field in municipalities shapefile"""
-        gdf = self.get_geodataframe('municipalities')
+        """Get list of municipios from NOMGEO field in municipalities shapefile, kept in a municipios.json sidecar"""
+        shp_path = os.path.join(self.shapefiles_folder, 'municipalities', 'municipalities.shp')
         
-        if gdf is None:
+        if not os.path.exists(shp_path):
             return []
         
+        json_path = os.path.join(os.path.dirname(shp_path), 'municipios.json')
+        if _is_fresh(json_path, shp_path):
+            with open(json_path, 'rb') as f:
+                return orjson.loads(f.read())
+        
+        municipios = self._read_municipios(shp_path)
+        _write_sidecar(json_path, orjson.dumps(municipios, default=str))
+        return municipios
+    
+    def _read_municipios(self, shp_path):
+        """Sorted unique municipio names of the municipalities layer"""
         # Try common column names for municipality name
         name_columns = ['NOMGEO', 'NOM_MUN', 'NOMBRE', 'NAME', 'NOM_ENT', 'MUNICIPIO']
         
+        # The loaded layer if there is one, otherwise just the name columns
+        gdf = self._gdf_cache.get((shp_path, os.stat(shp_path).st_mtime_ns))
+        if gdf is None:
+            gdf = read_layer_columns(shp_path, name_columns)
+        
         for col in name_columns:
             if col in gdf.columns:
                 municipios = gdf[col].dropna().unique().tolist()
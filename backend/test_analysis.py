@@ -1,103 +1,143 @@
-"""Test script to debug analysis services"""
+"""Test script to debug analysis services
+
+Usage: python test_analysis.py [route_id ...]
+Analyzes the given routes (default: the first one, 'all' for every route) in parallel,
+one worker process per CPU.
+"""
 import os
+import sys
 import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import geopandas as gpd
 
-# Load route
-with open('data/routes.json', 'r', encoding='utf-8') as f:
-    db = json.load(f)
-
-routes = db.get('routes', [])
-print(f"Total routes: {len(routes)}")
-
-if not routes:
-    print("No routes found")
-    exit()
-
-route = routes[0]
-route_id = route.get('id')
-print(f"Testing route: {route_id}")
-
-# Test GPX Extractor
-gpx_path = f'data/gpx/{route_id}.gpx'
-print(f"GPX path: {gpx_path}, exists: {os.path.exists(gpx_path)}")
-
-from services.gpx_extractor import GPXExtractor
-
-with open(gpx_path, 'rb') as f:
-    extractor = GPXExtractor(f.read())
-
-metrics = extractor.analyze()
-print(f"\n=== GPX Metrics ===")
-print(f"Distance: {metrics.get('distancia_km')} km")
-print(f"Duration: {metrics.get('duracion_minutos')} min")
-print(f"Points: {metrics.get('puntos_totales')}")
-print(f"Elevation: {metrics.get('elevacion')}")
-print(f"Velocity: {metrics.get('velocidad')}")
-
-linestring = extractor.get_linestring()
-print(f"LineString coords: {len(list(linestring.coords))}")
-print(f"Bounds: {linestring.bounds}")
-
-# Test Map Matcher
-print("\n=== Map Matching ===")
-road_path = 'data/shapefiles/road_network/road_network.shp'
-if os.path.exists(road_path):
-    road_gdf = gpd.read_file(road_path)
-    print(f"Road network loaded: {len(road_gdf)} segments")
-    
-    from services.map_matcher import MapMatcher
-    matcher = MapMatcher(linestring, road_gdf, buffer_tolerance_m=50)
-    match_result = matcher.match()
-    
-    print(f"Matched segments: {len(match_result.get('matched_segments', []))}")
-    print(f"Confidence: {match_result.get('confidence')}%")
-    print(f"Match rate: {match_result.get('match_rate_pct')}%")
-    print(f"Unmatched points: {match_result.get('unmatched_points')}")
-    
-    # Test Road Analyzer
-    print("\n=== Road Analysis ===")
-    from services.road_analyzer import RoadAnalyzer
-    analyzer = RoadAnalyzer(road_gdf)
-    road_stats = analyzer.analyze(match_result.get('matched_segments', []), linestring)
-    print(f"Superficie: {road_stats.get('superficie')}")
-    print(f"Administracion: {road_stats.get('administracion')}")
-else:
-    print("Road network not found")
-
-# Test Locality Detector
-print("\n=== Locality Detection ===")
-localities_path = 'data/shapefiles/localities/localities.shp'
-municipalities_path = 'data/shapefiles/municipalities/municipalities.shp'
-
-if os.path.exists(localities_path):
-    localities_gdf = gpd.read_file(localities_path)
-    print(f"Localities loaded: {len(localities_gdf)}")
-    print(f"Localities columns: {list(localities_gdf.columns)}")
-else:
-    localities_gdf = None
-    print("Localities not found")
-
-if os.path.exists(municipalities_path):
-    municipalities_gdf = gpd.read_file(municipalities_path)
-    print(f"Municipalities loaded: {len(municipalities_gdf)}")
-    print(f"Municipalities columns: {list(municipalities_gdf.columns)}")
-else:
-    municipalities_gdf = None
-    print("Municipalities not found")
-
-if localities_gdf is not None:
-    from services.locality_detector import LocalityDetector
-    detector = LocalityDetector(localities_gdf, municipalities_gdf, buffer_meters=500)
-    locality_result = detector.detect(linestring)
-    
-    print(f"Municipios: {locality_result.get('total_municipios')}")
-    print(f"Urbanas: {locality_result.get('total_urbanas')}")
-    print(f"Rurales: {locality_result.get('total_rurales')}")
-    print(f"Total localidades: {locality_result.get('total_localidades')}")
-    
-    if locality_result.get('municipios'):
-        for mun in locality_result['municipios'][:3]:
-            print(f"  - {mun.get('nombre')}: {len(mun.get('localidades_urbanas', []))} urbanas, {len(mun.get('localidades_rurales', []))} rurales")
-
-print("\n=== Test Complete ===")
+from services.shapefile_service import IO_ENGINE
+
+ROAD_PATH = 'data/shapefiles/road_network/road_network.shp'
+LOCALITIES_PATH = 'data/shapefiles/localities/localities.shp'
+MUNICIPALITIES_PATH = 'data/shapefiles/municipalities/municipalities.shp'
+
+# Base layers, loaded once per worker process by _load_layers
+_layers = {}
+
+
+def _load_layers():
+    """Pool initializer: read the base layers once so routes don't re-read or re-pickle them"""
+    for name, path in (('road', ROAD_PATH), ('localities', LOCALITIES_PATH),
+                       ('municipalities', MUNICIPALITIES_PATH)):
+        _layers[name] = gpd.read_file(path, engine=IO_ENGINE) if os.path.exists(path) else None
+
+
+def analyze_route(route_id):
+    """Run every analysis step on one route and return its report"""
+    out = [f"Testing route: {route_id}"]
+
+    # Test GPX Extractor
+    gpx_path = f'data/gpx/{route_id}.gpx'
+    out.append(f"GPX path: {gpx_path}, exists: {os.path.exists(gpx_path)}")
+
+    from services.gpx_extractor import GPXExtractor
+
+    # From the path: lxml's iterparse streams the file instead of holding all of it in memory
+    extractor = GPXExtractor(gpx_path)
+
+    metrics = extractor.analyze()
+    out.append(f"\n=== GPX Metrics ===")
+    out.append(f"Distance: {metrics.get('distancia_km')} km")
+    out.append(f"Duration: {metrics.get('duracion_minutos')} min")
+    out.append(f"Points: {metrics.get('puntos_totales')}")
+    out.append(f"Elevation: {metrics.get('elevacion')}")
+    out.append(f"Velocity: {metrics.get('velocidad')}")
+
+    linestring = extractor.get_linestring()
+    out.append(f"LineString coords: {len(list(linestring.coords))}")
+    out.append(f"Bounds: {linestring.bounds}")
+
+    # Test Map Matcher
+    out.append("\n=== Map Matching ===")
+    road_gdf = _layers['road']
+    if road_gdf is not None:
+        out.append(f"Road network loaded: {len(road_gdf)} segments")
+
+        from services.map_matcher import MapMatcher
+        matcher = MapMatcher(linestring, road_gdf, buffer_tolerance_m=50)
+        match_result = matcher.match()
+
+        out.append(f"Matched segments: {len(match_result.get('matched_segments', []))}")
+        out.append(f"Confidence: {match_result.get('confidence')}%")
+        out.append(f"Match rate: {match_result.get('match_rate_pct')}%")
+        out.append(f"Unmatched points: {match_result.get('unmatched_points')}")
+
+        # Test Road Analyzer
+        out.append("\n=== Road Analysis ===")
+        from services.road_analyzer import RoadAnalyzer
+        analyzer = RoadAnalyzer(road_gdf)
+        road_stats = analyzer.analyze(match_result.get('matched_segments', []), linestring)
+        out.append(f"Superficie: {road_stats.get('superficie')}")
+        out.append(f"Administracion: {road_stats.get('administracion')}")
+    else:
+        out.append("Road network not found")
+
+    # Test Locality Detector
+    out.append("\n=== Locality Detection ===")
+    localities_gdf = _layers['localities']
+    municipalities_gdf = _layers['municipalities']
+
+    if localities_gdf is not None:
+        out.append(f"Localities loaded: {len(localities_gdf)}")
+        out.append(f"Localities columns: {list(localities_gdf.columns)}")
+    else:
+        out.append("Localities not found")
+
+    if municipalities_gdf is not None:
+        out.append(f"Municipalities loaded: {len(municipalities_gdf)}")
+        out.append(f"Municipalities columns: {list(municipalities_gdf.columns)}")
+    else:
+        out.append("Municipalities not found")
+
+    if localities_gdf is not None:
+        from services.locality_detector import LocalityDetector
+        detector = LocalityDetector(localities_gdf, municipalities_gdf, buffer_meters=500)
+        locality_result = detector.detect(linestring)
+
+        out.append(f"Municipios: {locality_result.get('total_municipios')}")
+        out.append(f"Urbanas: {locality_result.get('total_urbanas')}")
+        out.append(f"Rurales: {locality_result.get('total_rurales')}")
+        out.append(f"Total localidades: {locality_result.get('total_localidades')}")
+
+        if locality_result.get('municipios'):
+            for mun in locality_result['municipios'][:3]:
+                out.append(f"  - {mun.get('nombre')}: {len(mun.get('localidades_urbanas', []))} urbanas, {len(mun.get('localidades_rurales', []))} rurales")
+
+    return '\n'.join(out)
+
+
+def main():
+    # Load routes
+    with open('data/routes.json', 'r', encoding='utf-8') as f:
+        db = json.load(f)
+
+    routes = db.get('routes', [])
+    print(f"Total routes: {len(routes)}")
+
+    if not routes:
+        print("No routes found")
+        return
+
+    route_ids = sys.argv[1:] or [routes[0].get('id')]
+    if route_ids == ['all']:
+        route_ids = [route.get('id') for route in routes]
+
+    max_workers = min(os.cpu_count() or 1, len(route_ids))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_load_layers) as executor:
+        futures = {executor.submit(analyze_route, route_id): route_id for route_id in route_ids}
+        for future in as_completed(futures):
+            try:
+                print(f"\n{future.result()}")
+            except Exception as e:
+                print(f"\nRoute {futures[future]} failed: {e}")
+
+    print("\n=== Test Complete ===")
+
+
+if __name__ == '__main__':
+    main()
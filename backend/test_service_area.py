@@ -34,10 +34,9 @@ route = routes_data['routes'][0]
 print(f"\nTesting with route: {route['nombre']}")
 
 gpx_path = f"data/gpx/{route['id']}.gpx"
-with open(gpx_path, 'rb') as f:
-    gpx_bytes = f.read()
 
-extractor = GPXExtractor(gpx_bytes)
+# From the path: lxml's iterparse streams the file instead of holding all of it in memory
+extractor = GPXExtractor(gpx_path)
 extractor.analyze()
 linestring = extractor.get_linestring()
 
@@ -75,6 +75,7 @@ export const getMunicipiosList = () => api.get('/dashboard/municipios');
 
 // Export
 export const exportRouteJSON = (id) => api.get(`/export/route/${id}/json`);
+export const exportRouteGeoPackage = (id) => api.get(`/export/route/${id}/geopackage`, { responseType: 'blob' });
 export const exportRouteShapefile = (id) => api.get(`/export/route/${id}/shapefile`, { responseType: 'blob' });
 export const exportRoutesCSV = () => api.get('/export/routes/csv', { responseType: 'blob' });
 export const exportRoutesExcel = () => api.get('/export/routes/excel', { responseType: 'blob' });
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Download, FileJson, FileSpreadsheet, Map, CheckCircle, AlertCircle } from 'lucide-react';
-import { getRoutes, exportRouteJSON, exportRouteShapefile, exportRoutesCSV, exportRoutesExcel } from '../api';
+import { getRoutes, exportRouteJSON, exportRouteGeoPackage, exportRoutesCSV, exportRoutesExcel } from '../api';
 
 function ExportModule() {
   const [routes, setRoutes] = useState([]);
@@ -37,16 +37,16 @@ function ExportModule() {
     }
   };
 
-  const handleExportShapefile = async (routeId, routeName) => {
-    setExporting(prev => ({ ...prev, [`shp-${routeId}`]: true }));
+  const handleExportGeoPackage = async (routeId, routeName) => {
+    setExporting(prev => ({ ...prev, [`gpkg-${routeId}`]: true }));
     try {
-      const res = await exportRouteShapefile(routeId);
-      downloadBlob(res.data, `ruta_${routeName || routeId}.zip`);
-      setMessage({ type: 'success', text: 'Shapefile exportado correctamente' });
+      const res = await exportRouteGeoPackage(routeId);
+      downloadBlob(res.data, `ruta_${routeName || routeId}.gpkg`);
+      setMessage({ type: 'success', text: 'GeoPackage exportado correctamente' });
     } catch (err) {
-      setMessage({ type: 'error', text: 'Error al exportar Shapefile' });
+      setMessage({ type: 'error', text: 'Error al exportar GeoPackage' });
     } finally {
-      setExporting(prev => ({ ...prev, [`shp-${routeId}`]: false }));
+      setExporting(prev => ({ ...prev, [`gpkg-${routeId}`]: false }));
     }
   };
 
@@ -166,7 +166,7 @@ function ExportModule() {
                   <th>Municipio</th>
                   <th>Distancia</th>
                   <th>Exportar JSON</th>
-                  <th>Exportar Shapefile</th>
+                  <th>Exportar GeoPackage</th>
                 </tr>
               </thead>
               <tbody>
@@ -194,15 +194,15 @@ function ExportModule() {
                     <td>
                       <button
                         className="btn btn-secondary btn-sm"
-                        onClick={() => handleExportShapefile(route.id, route.nombre)}
-                        disabled={exporting[`shp-${route.id}`]}
+                        onClick={() => handleExportGeoPackage(route.id, route.nombre)}
+                        disabled={exporting[`gpkg-${route.id}`]}
                       >
-                        {exporting[`shp-${route.id}`] ? (
+                        {exporting[`gpkg-${route.id}`] ? (
                           <div className="spinner" style={{ width: '14px', height: '14px', borderWidth: '2px' }} />
                         ) : (
                           <>
                             <Map className="w-3 h-3" />
-                            Shapefile
+                            GeoPackage
                           </>
                         )}
                       </button>
@@ -229,9 +229,9 @@ function ExportModule() {
           </div>
           <div style={{ padding: '1rem', background: '#f9fafb', borderRadius: '8px' }}>
             <Map className="w-6 h-6" style={{ color: '#10b981', marginBottom: '0.5rem' }} />
-            <h4 style={{ fontWeight: 600, marginBottom: '0.5rem' }}>Shapefile</h4>
+            <h4 style={{ fontWeight: 600, marginBottom: '0.5rem' }}>GeoPackage</h4>
             <p style={{ fontSize: '0.8rem', color: '#6b7280' }}>
-              Formato geoespacial con la geometría de la ruta y atributos en la tabla. Compatible con QGIS, ArcGIS.
+              Archivo geoespacial único con la geometría de la ruta y atributos con nombres completos. Compatible con QGIS, ArcGIS.
             </p>
           </div>
           <div style={{ padding: '1rem', background: '#f9fafb', borderRadius: '8px' }}>